@@ -56,9 +56,18 @@ def run_migrations_online():
 
     # Alembic's migration context will use this to run migrations
     with connectable.connect() as connection:
+        if connection.dialect.name == "sqlite":
+            # Batch migrations recreate tables; with foreign keys enforced, dropping
+            # agent_files would cascade-delete every agent
+            connection.exec_driver_sql("PRAGMA foreign_keys=OFF")
+            connection.commit()
+
         context.configure(
             connection=connection,
-            target_metadata=target_metadata
+            target_metadata=target_metadata,
+            # SQLite can only alter tables by recreating them, PostgreSQL alters them in place
+            render_as_batch=connection.dialect.name == "sqlite",
+            compare_type=True,
         )
 
         with context.begin_transaction():
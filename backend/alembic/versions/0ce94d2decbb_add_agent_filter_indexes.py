@@ -0,0 +1,30 @@
+"""add agent filter indexes
+
+Revision ID: 0ce94d2decbb
+Revises: 05f0b12c4479
+Create Date: 2026-10-19 09:02:11.482913
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0ce94d2decbb'
+down_revision: Union[str, None] = '05f0b12c4479'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_mcp_agents_agent_type', 'mcp_agents', ['agent_type'], unique=False)
+    op.create_index('ix_mcp_agents_is_active', 'mcp_agents', ['is_active'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_mcp_agents_is_active', table_name='mcp_agents')
+    op.drop_index('ix_mcp_agents_agent_type', table_name='mcp_agents')
@@ -0,0 +1,68 @@
+"""backfill agent file ids
+
+Revision ID: 32a501fbed06
+Revises: 341dfe894218
+Create Date: 2026-10-19 11:09:12.774591
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '32a501fbed06'
+down_revision: Union[str, None] = '341dfe894218'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+agent_files = sa.table(
+    'agent_files',
+    sa.column('id', sa.Integer()),
+    sa.column('mcp_agents', sa.String()),
+)
+mcp_agents = sa.table(
+    'mcp_agents',
+    sa.column('id', sa.Integer()),
+    sa.column('agent_file_id', sa.Integer()),
+)
+
+
+def upgrade() -> None:
+    """Move the comma-separated agent_files.mcp_agents into mcp_agents.agent_file_id."""
+    bind = op.get_bind()
+    # Ordered by id so an agent listed in several files ends up in the newest one
+    rows = bind.execute(sa.select(agent_files.c.id, agent_files.c.mcp_agents).order_by(agent_files.c.id)).all()
+    for agent_file_id, agent_ids in rows:
+        ids = [int(agent_id) for agent_id in (agent_ids or '').split(',') if agent_id.strip()]
+        if ids:
+            bind.execute(
+                mcp_agents.update().where(mcp_agents.c.id.in_(ids)).values(agent_file_id=agent_file_id)
+            )
+
+    with op.batch_alter_table('agent_files') as batch_op:
+        batch_op.drop_column('mcp_agents')
+
+
+def downgrade() -> None:
+    """Rebuild the comma-separated agent_files.mcp_agents from mcp_agents.agent_file_id."""
+    with op.batch_alter_table('agent_files') as batch_op:
+        batch_op.add_column(sa.Column('mcp_agents', sa.String(), nullable=False, server_default=''))
+
+    bind = op.get_bind()
+    agent_ids = {}
+    rows = bind.execute(
+        sa.select(mcp_agents.c.agent_file_id, mcp_agents.c.id)
+        .where(mcp_agents.c.agent_file_id.isnot(None))
+        .order_by(mcp_agents.c.id)
+    ).all()
+    for agent_file_id, agent_id in rows:
+        agent_ids.setdefault(agent_file_id, []).append(str(agent_id))
+    for agent_file_id, ids in agent_ids.items():
+        bind.execute(
+            agent_files.update().where(agent_files.c.id == agent_file_id).values(mcp_agents=','.join(ids))
+        )
+
+    with op.batch_alter_table('agent_files') as batch_op:
+        batch_op.alter_column('mcp_agents', server_default=None)
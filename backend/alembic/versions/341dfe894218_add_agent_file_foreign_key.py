@@ -0,0 +1,37 @@
+"""add agent file foreign key
+
+Revision ID: 341dfe894218
+Revises: 9b1e4c7d2a53
+Create Date: 2026-10-19 11:02:45.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '341dfe894218'
+down_revision: Union[str, None] = '9b1e4c7d2a53'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table('mcp_agents') as batch_op:
+        batch_op.add_column(sa.Column('agent_file_id', sa.Integer(), nullable=True))
+        batch_op.create_index('ix_mcp_agents_agent_file_id', ['agent_file_id'], unique=False)
+        batch_op.create_foreign_key(
+            'fk_mcp_agents_agent_file_id_agent_files', 'agent_files',
+            ['agent_file_id'], ['id'], ondelete='CASCADE'
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('mcp_agents') as batch_op:
+        batch_op.drop_constraint('fk_mcp_agents_agent_file_id_agent_files', type_='foreignkey')
+        batch_op.drop_index('ix_mcp_agents_agent_file_id')
+        batch_op.drop_column('agent_file_id')
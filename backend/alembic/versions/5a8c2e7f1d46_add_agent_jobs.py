@@ -0,0 +1,55 @@
+"""add agent jobs
+
+Revision ID: 5a8c2e7f1d46
+Revises: e3f0a6c8d215
+Create Date: 2026-10-19 13:02:37.419025
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5a8c2e7f1d46'
+down_revision: Union[str, None] = 'e3f0a6c8d215'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('agent_jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('agent_file_id', sa.Integer(), nullable=False),
+    sa.Column('batch_id', sa.String(), nullable=True),
+    sa.Column('prompt', sa.Text(), nullable=False),
+    sa.Column('priority', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('status', sa.String(), server_default='queued', nullable=False),
+    sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('max_attempts', sa.Integer(), server_default='3', nullable=False),
+    sa.Column('result', sa.Text(), nullable=True),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('worker_id', sa.String(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=False),
+    sa.Column('available_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=False),
+    sa.Column('lease_until', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('started_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('finished_at', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['agent_file_id'], ['agent_files.id'], name='fk_agent_jobs_agent_file_id_agent_files', ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_agent_jobs_id'), 'agent_jobs', ['id'], unique=False)
+    op.create_index(op.f('ix_agent_jobs_agent_file_id'), 'agent_jobs', ['agent_file_id'], unique=False)
+    op.create_index(op.f('ix_agent_jobs_batch_id'), 'agent_jobs', ['batch_id'], unique=False)
+    op.create_index('ix_agent_jobs_status_priority', 'agent_jobs', ['status', 'priority', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_agent_jobs_status_priority', table_name='agent_jobs')
+    op.drop_index(op.f('ix_agent_jobs_batch_id'), table_name='agent_jobs')
+    op.drop_index(op.f('ix_agent_jobs_agent_file_id'), table_name='agent_jobs')
+    op.drop_index(op.f('ix_agent_jobs_id'), table_name='agent_jobs')
+    op.drop_table('agent_jobs')
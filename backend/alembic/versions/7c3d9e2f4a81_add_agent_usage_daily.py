@@ -0,0 +1,43 @@
+"""add agent usage daily
+
+Revision ID: 7c3d9e2f4a81
+Revises: 5a8c2e7f1d46
+Create Date: 2026-10-19 14:21:53.602117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c3d9e2f4a81'
+down_revision: Union[str, None] = '5a8c2e7f1d46'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('agent_usage_daily',
+    sa.Column('agent_file_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('runs', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('rejected_runs', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('steps', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('prompt_tokens', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('completion_tokens', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('wall_seconds', sa.Float(), server_default='0', nullable=False),
+    sa.Column('mcp_cpu_seconds', sa.Float(), server_default='0', nullable=False),
+    sa.Column('mcp_peak_rss_kb', sa.Integer(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['agent_file_id'], ['agent_files.id'], name='fk_agent_usage_daily_agent_file_id_agent_files', ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('agent_file_id', 'day')
+    )
+    op.create_index(op.f('ix_agent_usage_daily_day'), 'agent_usage_daily', ['day'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_agent_usage_daily_day'), table_name='agent_usage_daily')
+    op.drop_table('agent_usage_daily')
@@ -0,0 +1,29 @@
+"""add agent version
+
+Revision ID: 9b1e4c7d2a53
+Revises: 0ce94d2decbb
+Create Date: 2026-10-19 10:14:37.205816
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9b1e4c7d2a53'
+down_revision: Union[str, None] = '0ce94d2decbb'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('mcp_agents', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('mcp_agents') as batch_op:
+        batch_op.drop_column('version')
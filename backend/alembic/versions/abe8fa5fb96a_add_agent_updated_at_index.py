@@ -0,0 +1,28 @@
+"""add agent updated_at index
+
+Revision ID: abe8fa5fb96a
+Revises: 32a501fbed06
+Create Date: 2026-10-19 11:13:58.061733
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'abe8fa5fb96a'
+down_revision: Union[str, None] = '32a501fbed06'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_mcp_agents_updated_at', 'mcp_agents', ['updated_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_mcp_agents_updated_at', table_name='mcp_agents')
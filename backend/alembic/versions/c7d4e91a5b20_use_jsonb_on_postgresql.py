@@ -0,0 +1,53 @@
+"""use jsonb on postgresql
+
+Revision ID: c7d4e91a5b20
+Revises: abe8fa5fb96a
+Create Date: 2026-10-19 12:04:51.530146
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7d4e91a5b20'
+down_revision: Union[str, None] = 'abe8fa5fb96a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+JSON_COLUMNS = {
+    'mcp_agents': ['args', 'env'],
+    'agent_types': ['args', 'env_keys'],
+}
+
+
+def _convert(from_type: sa.types.TypeEngine, to_type: sa.types.TypeEngine, cast: str) -> None:
+    bind = op.get_bind()
+    # SQLite stores JSON as text either way, only PostgreSQL has a binary JSON type
+    if bind.dialect.name != 'postgresql':
+        return
+    tables = set(sa.inspect(bind).get_table_names())
+    for table, columns in JSON_COLUMNS.items():
+        if table not in tables:
+            continue
+        for column in columns:
+            op.alter_column(
+                table, column,
+                type_=to_type,
+                existing_type=from_type,
+                existing_nullable=False,
+                postgresql_using=f'{column}::{cast}',
+            )
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    _convert(sa.JSON(), postgresql.JSONB(), 'jsonb')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    _convert(postgresql.JSONB(), sa.JSON(), 'json')
@@ -0,0 +1,44 @@
+"""add agent registry tables
+
+Revision ID: e3f0a6c8d215
+Revises: c7d4e91a5b20
+Create Date: 2026-10-19 12:11:07.884410
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e3f0a6c8d215'
+down_revision: Union[str, None] = 'c7d4e91a5b20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('workers',
+    sa.Column('worker_id', sa.String(), nullable=False),
+    sa.Column('address', sa.String(), nullable=True),
+    sa.Column('last_seen', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('worker_id')
+    )
+    op.create_index(op.f('ix_workers_last_seen'), 'workers', ['last_seen'], unique=False)
+    op.create_table('agent_owners',
+    sa.Column('agent_file_id', sa.Integer(), nullable=False),
+    sa.Column('worker_id', sa.String(), nullable=False),
+    sa.Column('claimed_at', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('agent_file_id')
+    )
+    op.create_index(op.f('ix_agent_owners_worker_id'), 'agent_owners', ['worker_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_agent_owners_worker_id'), table_name='agent_owners')
+    op.drop_table('agent_owners')
+    op.drop_index(op.f('ix_workers_last_seen'), table_name='workers')
+    op.drop_table('workers')
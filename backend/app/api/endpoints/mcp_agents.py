@@ -1,22 +1,45 @@
-from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import ORJSONResponse, PlainTextResponse
+from sse_starlette.sse import EventSourceResponse
 from sqlalchemy.orm import Session
-from typing import List, Dict
-from app.db.session import get_db
+from typing import TYPE_CHECKING, Any, List, Dict, Optional
+from app.db.session import SessionLocal, get_db
 from app.services.mcp_agent_service import MCPAgentService
-from app.models.schemas import MCPAgentCreate, MCPAgentUpdate, MCPAgentInDB, ChatMessage, MCPAgentBase
+from app.models.schemas import (
+    MCPAgentCreate, MCPAgentUpdate, MCPAgentInDB, ChatMessage, MCPAgentBase,
+    MCPAgentBulkUpdate, MCPAgentBulkUpdateResult, AgentFileBulkDeleteResult, AgentJobCreate, AgentJobInDB,
+    FanOutRequest, FanOutResponse, AgentRunReport
+)
 from app.core.config import settings
 import json
 import os
 import logging
-from dotenv import load_dotenv
-from mcp_use import MCPAgent, MCPClient
-from langchain_groq import ChatGroq
-from app.core.logging_config import setup_logging
+import time
+from app.core.ws_codec import MessageTooBigError, negotiate_codec
+from app.core.http_cache import is_not_modified, make_etag
+from app.core.loop_monitor import dump_tasks, label_task, labelled_tasks, loop_monitor
+from app.core.sampling_profiler import sampling_profiler
 from app.models.agent_file import AgentFile
+from app.services.agent_registry import WorkerForwarder, get_agent_registry
+from app.services.connection_manager import ConnectionManager
+from app.services.change_feed import change_feed
+from app.services.config_reconciler import ConfigReconciler
+from app.services.agent_hibernation import AgentHibernator
+from app.services.agent_runs import RunCancelledError, agent_runs, current_run
+from app.services.agent_usage import QuotaExceededError, agent_usage
+from app.services.agent_supervisor import AgentSupervisor
+from app.services.fan_out import FanOut
+from app.services.job_queue import JOB_STATUSES, JobQueue
+from app.services.secret_store import secret_resolver
+import asyncio
+from collections import deque
+
+if TYPE_CHECKING:
+    from mcp_use import MCPAgent
+    from app.services.cassettes import Cassette
+    from app.services.tool_selector import ToolSelectingMCPAgent
 
-# Setup logging
-loggers = setup_logging()
-logger = loggers['mcp_agents']
+logger = logging.getLogger(__name__)
 
 
 router = APIRouter(
@@ -30,8 +53,266 @@ router = APIRouter(
 )
 
 # Global registries for active agents and connections
-active_agents: Dict[int, MCPAgent] = {}
-active_connections: Dict[int, List[WebSocket]] = {}
+active_agents: Dict[int, "MCPAgent"] = {}
+connection_manager = ConnectionManager(settings.WS_MAX_CONNECTIONS, settings.WS_MAX_CONNECTIONS_PER_AGENT)
+active_connections: Dict[int, List[WebSocket]] = connection_manager.connections
+
+# Shared record of which worker owns each agent, so several uvicorn workers can serve the same agents
+agent_registry = get_agent_registry()
+
+
+async def _run_local_agent(agent_file_id: int, message: str, memory: bool = True) -> str:
+    if agent_file_id not in active_agents:
+        raise RuntimeError(f"Agent {agent_file_id} is not running on worker {agent_registry.worker_id}")
+    # The forwarding worker closes the connection to cancel, which cancels this run
+    return await agent_runs.execute(
+        agent_file_id, active_agents[agent_file_id].run(message, memory=memory), "forwarded"
+    )
+
+
+worker_forwarder = WorkerForwarder(agent_registry, _run_local_agent)
+
+# Applies regenerated config files to running agents, restarting only the affected MCP servers
+config_reconciler = ConfigReconciler(
+    active_agents,
+    change_feed,
+    agent_runs.cancel_agent_runs,
+    poll_interval=settings.AGENT_CONFIG_POLL_INTERVAL,
+    drain_timeout=settings.AGENT_CONFIG_RELOAD_DRAIN_TIMEOUT,
+)
+
+
+def _agent_runtime():
+    """
+    Import the agent and LLM libraries. mcp_use and LangChain dominate the
+    application import time, so they are only loaded once an agent starts.
+    """
+    from langchain_groq import ChatGroq
+    from app.services.tool_cache import CachedMCPClient, CachedLangChainAdapter
+    from app.services.tool_selector import ToolSelectingMCPAgent
+    return ChatGroq, CachedMCPClient, CachedLangChainAdapter, ToolSelectingMCPAgent
+
+
+def _llm_options() -> dict:
+    # GROQ_API_KEY comes from the settings (environment or .env, read once), possibly as a secret
+    # reference; without it ChatGroq falls back to the process environment
+    if not settings.GROQ_API_KEY:
+        return {}
+    return {"api_key": secret_resolver.resolve(settings.GROQ_API_KEY)}
+
+
+def _open_cassette(agent_file: str) -> Optional["Cassette"]:
+    """The cassette of the agent file when recording or replaying (``CASSETTE_MODE``)."""
+    if not settings.CASSETTE_MODE:
+        return None
+    from app.services.cassettes import open_cassette
+    return open_cassette(os.path.splitext(agent_file)[0])
+
+
+async def _launch_agent(agent_file_id: int, agent_file: str) -> "ToolSelectingMCPAgent":
+    """Create the MCP agent for an agent file and register it in ``active_agents``."""
+    # Import off the event loop, the first import takes seconds
+    ChatGroq, CachedMCPClient, CachedLangChainAdapter, ToolSelectingMCPAgent = await asyncio.to_thread(_agent_runtime)
+    if agent_file_id in active_agents:
+        # Started by a concurrent request while the libraries were loading
+        return active_agents[agent_file_id]
+
+    # Get agent config file path based on the file name in the agent file
+    config_file = os.path.join("configs", agent_file)
+    logger.debug(f"Looking for config file at: {config_file}")
+
+    if not os.path.exists(config_file):
+        logger.error(f"Config file not found: {config_file}")
+        raise FileNotFoundError(
+            f"Config file not found: {config_file}. Please ensure the config file exists in the configs directory."
+        )
+
+    # Initialize MCP client and agent
+    logger.debug("Initializing MCP client and agent")
+    client = CachedMCPClient.from_config_file(config_file)
+    client.cassette = await asyncio.to_thread(_open_cassette, agent_file)
+    if client.cassette is not None and client.cassette.replaying:
+        # The recorded responses stand in for the LLM, no API key needed
+        llm = client.cassette.chat_model()
+    else:
+        llm = ChatGroq(model="qwen-qwq-32b", **await asyncio.to_thread(_llm_options))
+        if client.cassette is not None:
+            llm = client.cassette.chat_model(llm)
+
+    mcp_agent = ToolSelectingMCPAgent(
+        client=client,
+        llm=llm,
+        max_steps=75,
+        memory_enabled=True,
+        tool_index_name=os.path.splitext(agent_file)[0],
+    )
+    # Reuse converted tool schemas across agents and restarts
+    mcp_agent.adapter = CachedLangChainAdapter(disallowed_tools=mcp_agent.disallowed_tools)
+
+    # Store the agent instance in the global registry
+    active_agents[agent_file_id] = mcp_agent
+    logger.debug(f"Agent {agent_file_id} started and stored in active_agents")
+    logger.debug(f"Current active agents: {list(active_agents.keys())}")
+    change_feed.publish("agent.started", agent_file_id=agent_file_id, worker=agent_registry.worker_id)
+    return mcp_agent
+
+
+async def _autostart_agent(agent_file_id: int, agent_file: str) -> None:
+    owner = await asyncio.to_thread(agent_registry.claim, agent_file_id)
+    if not agent_registry.is_local(owner):
+        logger.debug(f"Agent {agent_file_id} is already running on worker {owner}")
+        return
+
+    mcp_agent = None
+    started = time.perf_counter()
+    try:
+        mcp_agent = await _launch_agent(agent_file_id, agent_file)
+        # Connect the MCP servers now so the first message does not pay for it
+        with labelled_tasks(agent=agent_file_id):
+            await mcp_agent.initialize()
+        agent_hibernator.record_cold_start(time.perf_counter() - started)
+    except BaseException:
+        # Also clean up when the supervisor gives up waiting and cancels the start
+        active_agents.pop(agent_file_id, None)
+        await asyncio.to_thread(agent_registry.release, agent_file_id)
+        if mcp_agent is not None:
+            await mcp_agent.close()
+        raise
+
+
+async def _stop_local_agent(agent_file_id: int) -> None:
+    agent_runs.cancel_agent_runs(agent_file_id, "agent stopped")
+    mcp_agent = active_agents.pop(agent_file_id)
+    try:
+        await mcp_agent.close()
+    except Exception as e:
+        logger.error(f"Error closing agent {agent_file_id}: {str(e)}", exc_info=True)
+    await asyncio.to_thread(agent_registry.release, agent_file_id)
+    config_reconciler.forget(agent_file_id)
+    agent_hibernator.forget(agent_file_id)
+    logger.debug(f"Agent {agent_file_id} stopped and removed from active_agents")
+    change_feed.publish("agent.stopped", agent_file_id=agent_file_id, worker=agent_registry.worker_id)
+
+
+async def close_all_agents() -> None:
+    """Stop every agent running on this worker, used on shutdown while the event loop still runs."""
+    await asyncio.gather(*(_stop_local_agent(agent_file_id) for agent_file_id in list(active_agents)))
+
+
+# Closes the MCP sessions of idle agents and keeps their memory on disk until the next message
+agent_hibernator = AgentHibernator(
+    active_agents,
+    settings.AGENT_HIBERNATION_DIR,
+    idle_after=settings.AGENT_HIBERNATE_AFTER,
+    interval=settings.AGENT_HIBERNATION_INTERVAL,
+)
+
+# Keeps agent files with is_active agents running on this worker
+agent_supervisor = AgentSupervisor(
+    active_agents,
+    agent_registry,
+    change_feed,
+    start=_autostart_agent,
+    stop=_stop_local_agent,
+    concurrency=settings.AGENT_AUTOSTART_CONCURRENCY,
+    timeout=settings.AGENT_AUTOSTART_TIMEOUT,
+    interval=settings.AGENT_RECONCILE_INTERVAL,
+    max_backoff=settings.AGENT_AUTOSTART_MAX_BACKOFF,
+)
+
+_start_locks: Dict[int, asyncio.Lock] = {}
+
+
+def _get_agent_file_name(agent_file_id: int) -> Optional[str]:
+    with SessionLocal() as db:
+        return MCPAgentService(db).get_agent_file_for_agent(agent_file_id)
+
+
+async def _forward(owner: str, agent_file_id: int, message: str, memory: bool = True) -> str:
+    run = current_run.get()
+    if run is not None:
+        # The owner runs the agent and accounts for its usage
+        run.forwarded = True
+    return await worker_forwarder.forward(owner, agent_file_id, message, memory)
+
+
+async def _prompt_agent(agent_file_id: int, prompt: str, memory: bool = True) -> str:
+    """
+    Run a prompt on an agent wherever it runs now, starting it on this worker if
+    it runs nowhere, e.g. after it was stopped or its owner went away. Only
+    prompts with ``memory`` see and extend the agent's conversation memory.
+    """
+    async with _start_locks.setdefault(agent_file_id, asyncio.Lock()):
+        if agent_file_id not in active_agents and await asyncio.to_thread(agent_registry.get_owner, agent_file_id) is None:
+            agent_file = await asyncio.to_thread(_get_agent_file_name, agent_file_id)
+            if not agent_file:
+                raise ValueError(f"Agent file {agent_file_id} not found")
+            agent_supervisor.resume(agent_file_id)
+            await _autostart_agent(agent_file_id, agent_file)
+
+    mcp_agent = active_agents.get(agent_file_id)
+    if mcp_agent is not None:
+        return await mcp_agent.run(prompt, memory=memory)
+    owner = await asyncio.to_thread(agent_registry.get_owner, agent_file_id)
+    if owner is None or agent_registry.is_local(owner):
+        raise RuntimeError(f"Agent {agent_file_id} is not running")
+    return await _forward(owner, agent_file_id, prompt, memory)
+
+
+async def _run_agent_prompt(agent_file_id: int, prompt: str, source: str = "job") -> str:
+    """
+    Run a prompt on an agent wherever it runs, starting it on this worker if it
+    runs nowhere. The prompt stays out of the agent's chat memory and runs with
+    its own tools and executor, so jobs and fan-out prompts may run next to a chat.
+    """
+    return await agent_runs.execute(agent_file_id, _prompt_agent(agent_file_id, prompt, memory=False), source)
+
+
+async def _run_interactive_prompt(agent_file_id: int, prompt: str) -> str:
+    """Run a prompt a client is waiting for, queued jobs of the agent wait meanwhile."""
+    async with job_queue.interactive(agent_file_id):
+        return await _run_agent_prompt(agent_file_id, prompt, "fanout")
+
+
+def _get_agent_file_names(agent_file_ids: List[int]) -> Dict[int, str]:
+    with SessionLocal() as db:
+        return MCPAgentService(db).get_agent_file_names(agent_file_ids)
+
+
+async def _prepare_fan_out(request: FanOutRequest) -> FanOut:
+    if len(request.agent_file_ids) > settings.FANOUT_MAX_AGENTS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {settings.FANOUT_MAX_AGENTS} agent files can be asked at once"
+        )
+    names = await asyncio.to_thread(_get_agent_file_names, request.agent_file_ids)
+    missing = [agent_file_id for agent_file_id in request.agent_file_ids if agent_file_id not in names]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Agent files not found: {missing}")
+
+    default_timeout = request.timeout or settings.FANOUT_TIMEOUT
+    return FanOut(
+        _run_interactive_prompt,
+        request.prompt,
+        {agent_file_id: names[agent_file_id] for agent_file_id in request.agent_file_ids},
+        {agent_file_id: request.timeouts.get(agent_file_id, default_timeout) for agent_file_id in request.agent_file_ids},
+    )
+
+
+# Runs queued batch prompts next to, and yielding to, interactive chat
+job_queue = JobQueue(
+    _run_agent_prompt,
+    change_feed,
+    worker_id=agent_registry.worker_id,
+    workers=settings.JOB_WORKERS,
+    per_agent_limit=settings.JOB_MAX_PER_AGENT,
+    yield_to_chat=settings.JOB_YIELD_TO_CHAT,
+    retry_delay=settings.JOB_RETRY_DELAY,
+    poll_interval=settings.JOB_POLL_INTERVAL,
+    lease=settings.JOB_LEASE,
+    retention=settings.JOB_RETENTION,
+    deprioritized=agent_usage.deprioritized_agents,
+)
 
 
 @router.post("/",
@@ -58,6 +339,8 @@ def create_agents(agents: List[MCPAgentBase], db: Session = Depends(get_db)):
         logger.debug(f"Creating new agents with data: {agents}")
         service = MCPAgentService(db)
         created_agents = service.create_agents(agents)  # Only returns created agents
+        for created_agent in created_agents:
+            change_feed.publish("agent.created", agent_id=created_agent.id, name=created_agent.name)
         return [agent.to_dict() for agent in created_agents]  # Return only agent details
     except Exception as e:
         logger.error(f"Error creating agents: {str(e)}", exc_info=True)
@@ -67,47 +350,102 @@ def create_agents(agents: List[MCPAgentBase], db: Session = Depends(get_db)):
         )
 
 @router.get("/",
-            response_model=List[MCPAgentInDB],
+            # Agents are projected to the requested `fields`, so their keys vary
+            response_model=List[Dict[str, Any]],
+            response_class=ORJSONResponse,
             summary="List all MCP agents",
-            description="Retrieve a list of all MCP agents with optional pagination.",
-            response_description="List of MCP agents with file name"
+            description="Retrieve a list of MCP agents with cursor pagination, filters and optional field selection.",
+            response_description="List of MCP agents with file name, with the fields of an agent or only the requested `fields`",
+            responses={304: {"description": "Not modified, the agents still match the `If-None-Match` ETag"}}
             )
 def get_agents(
+        request: Request,
         skip: int = 0,
-        limit: int = 100,
+        limit: int = Query(100, ge=1, le=1000),
+        cursor: Optional[int] = None,
+        agent_type: Optional[str] = None,
+        is_active: Optional[bool] = None,
+        file_id: Optional[int] = None,
+        fields: Optional[str] = None,
+        include_total: bool = False,
         db: Session = Depends(get_db)
 ):
     """
-    Retrieve a list of all MCP agents with their configuration file names.
+    Retrieve a list of MCP agents with their configuration file names.
 
-    - **skip**: Number of records to skip (for pagination)
+    - **cursor**: Return agents with an id greater than this value (use the `X-Next-Cursor` header of the previous page)
+    - **skip**: Number of records to skip, only used without a cursor (deprecated, slower on deep pages)
     - **limit**: Maximum number of records to return (for pagination)
+    - **agent_type** / **is_active** / **file_id**: Optional filters
+    - **fields**: Comma-separated list of fields to return, e.g. `fields=name,agent_type`
+    - **include_total**: Return the number of matching agents in the `X-Total-Count` header
 
-    Returns a list of MCP agents.
+    Returns a list of MCP agents, or 304 Not Modified when the `If-None-Match` header matches the current ETag.
     """
     service = MCPAgentService(db)
-    agents = service.get_agents(skip=skip, limit=limit)
-    return agents
+    field_list = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+
+    # Answer conditional requests from a cheap aggregate query before listing anything
+    etag = make_etag(
+        sorted(request.query_params.multi_items()),
+        service.get_agents_version(agent_type=agent_type, is_active=is_active, file_id=file_id)
+    )
+    if is_not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    headers = {"ETag": etag}
+
+    try:
+        agents, next_cursor, total = service.get_agents(
+            skip=skip,
+            limit=limit,
+            cursor=cursor,
+            agent_type=agent_type,
+            is_active=is_active,
+            file_id=file_id,
+            fields=field_list,
+            include_total=include_total
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = str(next_cursor)
+    if total is not None:
+        headers["X-Total-Count"] = str(total)
+
+    # Rows are already plain dicts of JSON-compatible values, serialize them directly with orjson
+    # instead of validating every row through MCPAgentInDB and the generic encoder
+    return ORJSONResponse(content=agents, headers=headers)
 
 @router.get("/{agent_id}", 
     response_model=MCPAgentInDB,
+    response_class=ORJSONResponse,
     summary="Get agent details",
     description="Retrieve detailed information about a specific MCP agent by its ID.",
-    response_description="MCP agent details"
+    response_description="MCP agent details",
+    responses={304: {"description": "Not modified, the agent still matches the `If-None-Match` ETag"}}
 )
-def get_agent(agent_id: int, db: Session = Depends(get_db)):
+def get_agent(agent_id: int, request: Request, db: Session = Depends(get_db)):
     """
     Retrieve detailed information about a specific MCP agent.
     
     - **agent_id**: The ID of the agent to retrieve
     
-    Returns the agent details if found, or a 404 error if not found.
+    Returns the agent details if found, 304 Not Modified when the `If-None-Match` header matches
+    the current ETag, or a 404 error if not found.
     """
     service = MCPAgentService(db)
-    agent = service.get_agent(agent_id)
+    agent = service.get_agent_details(agent_id)
     if not agent:
         raise HTTPException(status_code=404, detail="Agent not found")
-    return agent
+
+    etag = make_etag(agent.id, agent.version, agent.file_id)
+    if is_not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return ORJSONResponse(
+        content={field: getattr(agent, field) for field in MCPAgentService.AGENT_LIST_FIELDS},
+        headers={"ETag": etag}
+    )
 
 @router.put("/{agent_id}", 
     response_model=MCPAgentInDB,
@@ -128,8 +466,60 @@ def update_agent(agent_id: int, agent: MCPAgentUpdate, db: Session = Depends(get
     updated_agent = service.update_agent(agent_id, agent)
     if not updated_agent:
         raise HTTPException(status_code=404, detail="Agent not found")
+    change_feed.publish("agent.updated", agent_id=agent_id, fields=sorted(agent.model_dump(exclude_unset=True)))
+    if updated_agent.file_id:
+        change_feed.publish("agent_file.updated", agent_file_id=updated_agent.file_id)
     return updated_agent
 
+@router.patch("/bulk",
+    response_model=MCPAgentBulkUpdateResult,
+    summary="Bulk update agents",
+    description="Apply the same changes to every agent matching a filter in a single transaction.",
+    response_description="IDs of the updated agents and regenerated config files"
+)
+def bulk_update_agents(bulk_update: MCPAgentBulkUpdate, db: Session = Depends(get_db)):
+    """
+    Update every agent matching the filter, e.g. deactivate all agents of a type.
+
+    - **filter**: `ids`, `agent_type`, `is_active` and/or `file_id` (at least one is required)
+    - **update**: Fields to set on every matching agent
+
+    Config files are regenerated once per affected agent file.
+    """
+    service = MCPAgentService(db)
+    try:
+        result = service.bulk_update_agents(bulk_update.filter, bulk_update.update)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    fields = sorted(bulk_update.update.model_dump(exclude_unset=True))
+    for agent_id in result["agent_ids"]:
+        change_feed.publish("agent.updated", agent_id=agent_id, fields=fields)
+    for agent_file_id in result["agent_file_ids"]:
+        change_feed.publish("agent_file.updated", agent_file_id=agent_file_id)
+    return result
+
+@router.delete("/bulk",
+    response_model=AgentFileBulkDeleteResult,
+    summary="Bulk delete agent files",
+    description="Delete several MCP agent files and all their agents in a single transaction.",
+    response_description="Number of deleted agent files and agents"
+)
+def bulk_delete_agent_files(file_ids: List[int] = Query(..., description="IDs of the agent files to delete"),
+                            db: Session = Depends(get_db)):
+    """
+    Delete several MCP agent files and all agents associated with them.
+
+    - **file_ids**: The IDs of the agent files to delete, e.g. `?file_ids=1&file_ids=2`
+
+    Returns the deleted agent file IDs and the requested IDs that were not found.
+    """
+    service = MCPAgentService(db)
+    result = service.delete_agent_files(file_ids)
+    for agent_file_id in result["agent_file_ids"]:
+        change_feed.publish("agent_file.deleted", agent_file_id=agent_file_id)
+    return result
+
 @router.delete("/{agent_file_id}",
     status_code=status.HTTP_204_NO_CONTENT,
     summary="Delete agent file and associated agents",
@@ -147,6 +537,7 @@ def delete_agent_file(agent_file_id: int, db: Session = Depends(get_db)):
     service = MCPAgentService(db)
     if not service.delete_agent_file(agent_file_id):
         raise HTTPException(status_code=404, detail="Agent file not found")
+    change_feed.publish("agent_file.deleted", agent_file_id=agent_file_id)
     return {"message": "Agent file and associated agents deleted successfully"}
 
 
@@ -172,12 +563,19 @@ async def start_agent(agent_file_id: int, db: Session = Depends(get_db)):
         if not agent:
             logger.error(f"Agent {agent_file_id} not found in database")
             raise HTTPException(status_code=404, detail="Agent not found")
+        agent_supervisor.resume(agent_file_id)
 
         # Check if agent is already running
         if agent_file_id in active_agents:
             logger.debug(f"Agent {agent_file_id} is already running")
             return {"message": "Agent is already running"}
 
+        # Another worker may already own this agent
+        owner = await asyncio.to_thread(agent_registry.claim, agent_file_id)
+        if not agent_registry.is_local(owner):
+            logger.debug(f"Agent {agent_file_id} is already running on worker {owner}")
+            return {"message": "Agent is already running", "worker": owner}
+
         # Get the associated agent file based on agent_id
         agent_file = service.get_agent_file_for_agent(agent_file_id)
         if not agent_file:
@@ -186,38 +584,7 @@ async def start_agent(agent_file_id: int, db: Session = Depends(get_db)):
                 detail="Agent file not found"
             )
 
-        # Load environment variables
-        load_dotenv()
-        os.environ["GROQ_API_KEY"] = os.getenv("GROQ_API_KEY")
-        logger.debug("Environment variables loaded")
-
-        # Get agent config file path based on the file name in the agent file
-        config_file = os.path.join("configs", agent_file)
-        logger.debug(f"Looking for config file at: {config_file}")
-
-        if not os.path.exists(config_file):
-            logger.error(f"Config file not found: {config_file}")
-            raise HTTPException(
-                status_code=400,
-                detail=f"Config file not found: {config_file}. Please ensure the config file exists in the configs directory."
-            )
-
-        # Initialize MCP client and agent
-        logger.debug("Initializing MCP client and agent")
-        client = MCPClient.from_config_file(config_file)
-        llm = ChatGroq(model="qwen-qwq-32b")
-
-        mcp_agent = MCPAgent(
-            client=client,
-            llm=llm,
-            max_steps=75,
-            memory_enabled=True,
-        )
-
-        # Store the agent instance in the global registry
-        active_agents[agent_file_id] = mcp_agent
-        logger.debug(f"Agent {agent_file_id} started and stored in active_agents")
-        logger.debug(f"Current active agents: {list(active_agents.keys())}")
+        await _launch_agent(agent_file_id, agent_file)
 
         return {"message": "Agent started successfully"}
 
@@ -226,9 +593,331 @@ async def start_agent(agent_file_id: int, db: Session = Depends(get_db)):
         # Clean up if agent was partially started
         if agent_file_id in active_agents:
             del active_agents[agent_file_id]
+        await asyncio.to_thread(agent_registry.release, agent_file_id)
         raise HTTPException(status_code=400, detail=f"Failed to start agent: {str(e)}")
 
 
+@router.post("/{agent_file_id}/stop",
+             status_code=status.HTTP_200_OK,
+             summary="Stop agent",
+             description="Stop a running MCP agent and close its MCP server sessions.",
+             response_description="Success message"
+             )
+async def stop_agent(agent_file_id: int):
+    """
+    Stop a running MCP agent.
+
+    - **agent_file_id**: The ID of the agent file to stop
+
+    Returns a success message, or a message telling that the agent is not running on this worker.
+    """
+    if agent_file_id not in active_agents:
+        owner = await asyncio.to_thread(agent_registry.get_owner, agent_file_id)
+        if owner and not agent_registry.is_local(owner):
+            return {"message": "Agent is running on another worker", "worker": owner}
+        return {"message": "Agent is not running"}
+
+    # Stopped by hand, so the supervisor must not start it again
+    agent_supervisor.suspend(agent_file_id)
+    await _stop_local_agent(agent_file_id)
+
+    return {"message": "Agent stopped successfully"}
+
+
+@router.post("/{agent_file_id}/reload",
+             status_code=status.HTTP_200_OK,
+             summary="Reload agent configuration",
+             description="Apply the agent's current config file to the running agent, restarting only the MCP servers whose configuration changed.",
+             response_description="Servers that were added, removed, restarted or kept"
+             )
+async def reload_agent(agent_file_id: int):
+    """
+    Hot-reload a running agent from its config file.
+
+    - **agent_file_id**: The ID of the agent file to reload
+
+    Config files are regenerated on every agent update and running agents are reloaded automatically;
+    this endpoint forces a reconciliation, e.g. after editing a config file by hand.
+    The agent keeps its conversation memory.
+    """
+    if agent_file_id not in active_agents:
+        owner = await asyncio.to_thread(agent_registry.get_owner, agent_file_id)
+        if owner and not agent_registry.is_local(owner):
+            return {"message": "Agent is running on another worker", "worker": owner}
+        raise HTTPException(status_code=404, detail="Agent is not running")
+
+    try:
+        diff = await config_reconciler.reconcile(agent_file_id)
+    except Exception as e:
+        logger.error(f"Error reloading agent {agent_file_id}: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=400, detail=f"Failed to reload agent: {str(e)}")
+
+    if diff is None:
+        raise HTTPException(status_code=404, detail="Agent config file not found")
+    return {
+        "message": "Agent is up to date" if diff.is_empty else "Agent reloaded successfully",
+        **diff.to_dict(),
+        "stats": config_reconciler.stats()
+    }
+
+
+@router.post("/{agent_file_id}/hibernate",
+             status_code=status.HTTP_200_OK,
+             summary="Hibernate agent",
+             description="Close the MCP server sessions of a running agent and keep its conversation memory on disk until the next message.",
+             response_description="Success message"
+             )
+async def hibernate_agent(agent_file_id: int):
+    """
+    Hibernate a running agent now instead of waiting for it to be idle for `AGENT_HIBERNATE_AFTER` seconds.
+
+    - **agent_file_id**: The ID of the agent file to hibernate
+
+    The agent stays running: the next message restores its MCP sessions and memory.
+    Returns a 409 error while the agent answers a message or before it connected its MCP servers.
+    """
+    if agent_file_id not in active_agents:
+        owner = await asyncio.to_thread(agent_registry.get_owner, agent_file_id)
+        if owner and not agent_registry.is_local(owner):
+            return {"message": "Agent is running on another worker", "worker": owner}
+        raise HTTPException(status_code=404, detail="Agent is not running")
+
+    if active_agents[agent_file_id].hibernated:
+        return {"message": "Agent is already hibernated"}
+    if not await agent_hibernator.hibernate(agent_file_id):
+        raise HTTPException(status_code=409, detail="Agent is busy or not connected")
+    return {"message": "Agent hibernated successfully"}
+
+
+@router.post("/{agent_file_id}/jobs",
+             response_model=List[AgentJobInDB],
+             status_code=status.HTTP_202_ACCEPTED,
+             summary="Submit prompts as jobs",
+             description="Queue a single prompt or a batch of prompts for an agent file. Jobs run in the background and their results are stored.",
+             response_description="The queued jobs"
+             )
+def submit_jobs(agent_file_id: int, jobs: AgentJobCreate, db: Session = Depends(get_db)):
+    """
+    Queue prompts for an agent file.
+
+    - **agent_file_id**: The ID of the agent file to run the prompts on
+    - **prompt** / **prompts**: One prompt, or a batch of prompts sharing a `batch_id`
+    - **priority**: Jobs with a higher priority run first (default 0, use negative values for bulk work)
+    - **max_attempts**: Runs before a failing job is given up
+
+    The agent is started if it is not running. Poll `GET /jobs/{job_id}` or `GET /{agent_file_id}/jobs?batch_id=...`,
+    or subscribe to the `job.*` events of `GET /events/stream`, to collect the results.
+    """
+    if not MCPAgentService(db).get_agent(agent_file_id):
+        raise HTTPException(status_code=404, detail="Agent file not found")
+
+    prompts = jobs.all_prompts()
+    if len(prompts) > settings.JOB_MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {settings.JOB_MAX_BATCH_SIZE} prompts can be submitted at once"
+        )
+
+    created = job_queue.submit(
+        agent_file_id, prompts, jobs.priority, jobs.max_attempts or settings.JOB_MAX_ATTEMPTS
+    )
+    return ORJSONResponse(content=created, status_code=status.HTTP_202_ACCEPTED)
+
+
+@router.get("/{agent_file_id}/jobs",
+            response_model=List[AgentJobInDB],
+            summary="List jobs of an agent file",
+            description="Retrieve the jobs of an agent file with their status and results, with cursor pagination.",
+            response_description="List of jobs"
+            )
+def list_jobs(
+        agent_file_id: int,
+        status_filter: Optional[str] = Query(None, alias="status"),
+        batch_id: Optional[str] = None,
+        cursor: Optional[int] = None,
+        limit: int = Query(100, ge=1, le=1000),
+):
+    """
+    Retrieve the jobs of an agent file, oldest first.
+
+    - **status**: Only jobs in this status (queued, running, succeeded, failed or cancelled)
+    - **batch_id**: Only the jobs submitted together with this batch id
+    - **cursor**: Return jobs with an id greater than this value (use the `X-Next-Cursor` header of the previous page)
+    - **limit**: Maximum number of jobs to return
+    """
+    if status_filter is not None and status_filter not in JOB_STATUSES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown job status: {status_filter}")
+
+    jobs, next_cursor = job_queue.list(agent_file_id, status_filter, batch_id, cursor, limit)
+    headers = {"X-Next-Cursor": str(next_cursor)} if next_cursor is not None else {}
+    return ORJSONResponse(content=jobs, headers=headers)
+
+
+@router.get("/jobs/stats",
+            summary="Get job queue statistics",
+            description="Retrieve the number of jobs per status and the jobs running on this worker.",
+            response_description="Job queue statistics"
+            )
+def get_job_stats():
+    """
+    Retrieve job queue statistics.
+
+    - **jobs**: Number of stored jobs per status, across all workers
+    - **running** / **running_per_agent** / **interactive**: Jobs running on this worker, and agents answering chat messages
+    - **succeeded** / **failed** / **retried** / **recovered** / **cancelled**: Job outcomes on this worker since startup
+    """
+    return job_queue.stats()
+
+
+@router.get("/jobs/{job_id}",
+            response_model=AgentJobInDB,
+            summary="Get a job",
+            description="Retrieve the status of a job, and its result once it finished.",
+            response_description="The job"
+            )
+def get_job(job_id: int):
+    """
+    Retrieve a job.
+
+    - **job_id**: The ID of the job
+
+    The `result` is set once the status is `succeeded`, `error` holds the error of the last failed run.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return ORJSONResponse(content=job)
+
+
+@router.delete("/jobs/{job_id}",
+               response_model=AgentJobInDB,
+               summary="Cancel a job",
+               description="Cancel a job that is queued or running.",
+               response_description="The cancelled job"
+               )
+def cancel_job(job_id: int):
+    """
+    Cancel a queued or running job.
+
+    - **job_id**: The ID of the job
+
+    A running job's agent run is cancelled, on other workers within a maintenance interval.
+    Returns 409 if the job already finished.
+    """
+    job = job_queue.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] != "cancelled":
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Job is {job['status']}")
+    return ORJSONResponse(content=job)
+
+
+@router.post("/fanout/run",
+             response_model=FanOutResponse,
+             summary="Ask several agents at once",
+             description="Send one prompt to several agent files concurrently and return their combined answers.",
+             response_description="Every agent's result and the merged answers"
+             )
+async def fan_out_prompt(request: FanOutRequest):
+    """
+    Send one prompt to several agent files concurrently.
+
+    - **prompt**: The prompt every agent answers
+    - **agent_file_ids**: The agent files to ask, agents that are not running are started
+    - **timeout** / **timeouts**: Seconds each agent may take, as a default and per agent file
+
+    Returns once the slowest agent answered or timed out. An agent that fails or times out
+    only fails its own result, the others are still returned.
+    """
+    fan_out = await _prepare_fan_out(request)
+    return ORJSONResponse(content=await fan_out.run())
+
+
+@router.post("/fanout/stream",
+             summary="Ask several agents at once, streaming answers",
+             description="Send one prompt to several agent files concurrently and stream each answer as soon as it is ready.",
+             response_description="text/event-stream of result events and a final done event"
+             )
+async def stream_fan_out_prompt(request: FanOutRequest):
+    """
+    Send one prompt to several agent files concurrently, over server-sent events.
+
+    Takes the same body as `POST /fanout/run`. A `result` event is sent for every agent file
+    as soon as it answered, failed or timed out, followed by a `done` event with the combined
+    response. Disconnecting cancels the agents that are still running.
+    """
+    fan_out = await _prepare_fan_out(request)
+    return EventSourceResponse(fan_out.stream())
+
+
+@router.get("/events/stream",
+            summary="Stream agent changes",
+            description="Server-sent events feed of agent create/update/delete/start/stop events, so clients can stop polling.",
+            response_description="text/event-stream of change events"
+            )
+async def stream_agent_events(request: Request):
+    """
+    Subscribe to agent change events over server-sent events.
+
+    Events: `agent.created`, `agent.updated`, `agent_file.updated`, `agent_file.deleted`, `agent.started`,
+    `agent.stopped`, `agent.reloaded`, and `job.queued`, `job.started`, `job.retrying`, `job.succeeded`,
+    `job.failed`, `job.cancelled` for submitted jobs.
+    Reconnecting clients send `Last-Event-ID` to replay recent events they missed on this worker.
+    """
+    last_event_id = request.headers.get("last-event-id")
+    return EventSourceResponse(
+        change_feed.subscribe(int(last_event_id) if last_event_id and last_event_id.isdigit() else None)
+    )
+
+
+def _parse_deadline(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        deadline = float(value)
+    except ValueError:
+        raise ValueError(f"Invalid deadline: {value}")
+    if deadline <= 0:
+        raise ValueError("The deadline must be positive")
+    return deadline
+
+
+def _is_cancel_frame(data: str) -> bool:
+    if not data.lstrip().startswith("{"):
+        return False
+    try:
+        frame = json.loads(data)
+    except ValueError:
+        return False
+    return isinstance(frame, dict) and frame.get("type") == "cancel"
+
+
+async def _run_chat_message(agent_file_id: int, data: str) -> str:
+    # Queued jobs of this agent wait while it answers
+    async with job_queue.interactive(agent_file_id):
+        # The agent may have been stopped, reloaded or moved since the connection was opened
+        return await _prompt_agent(agent_file_id, data)
+
+
+async def _send_run_result(codec, websocket: WebSocket, agent_file_id: int, run) -> None:
+    try:
+        response = await run.wait()
+    except RunCancelledError as e:
+        await codec.send(websocket, AgentRunReport(agent_id=agent_file_id, **e.report))
+        return
+    except QuotaExceededError as e:
+        logger.warning(f"Rejected message for agent {agent_file_id}: {str(e)}")
+        response = f"Error processing message: {str(e)}"
+    except Exception as e:
+        logger.error(f"Error processing message for agent {agent_file_id}: {str(e)}", exc_info=True)
+        response = f"Error processing message: {str(e)}"
+    else:
+        logger.info(f"Got response from agent {agent_file_id}: {response}")
+
+    await codec.send(websocket, ChatMessage(agent_id=agent_file_id, message=response))
+    logger.info(f"Sent response to client for agent {agent_file_id}")
+
+
 @router.websocket("/ws/{agent_file_id}")
 async def websocket_endpoint(
     websocket: WebSocket,
@@ -239,9 +928,16 @@ async def websocket_endpoint(
     WebSocket endpoint for real-time chat with an MCP agent.
     
     - **agent_id**: The ID of the agent to chat with
+    - **encoding** / **compression**: Optional query parameters (``orjson``, ``zstd`` or ``deflate``),
+      alternatively offer the ``mcp.orjson``, ``mcp.orjson.deflate`` or ``mcp.orjson.zstd`` subprotocols
+    - **deadline**: Optional query parameter, seconds each message may run (defaults to ``AGENT_RUN_DEADLINE``)
     
     Establishes a WebSocket connection for real-time chat. Messages sent to this endpoint
-    will be processed by the MCP agent and responses will be sent back.
+    will be processed by the MCP agent and responses will be sent back, one message at a time.
+
+    Sending ``{"type": "cancel"}`` cancels the message being processed and drops the ones
+    waiting behind it; disconnecting does the same. Cancelled runs and runs that exceed their
+    deadline are answered with a ``run.cancelled`` frame reporting the steps executed and abandoned.
     """
     try:
         logger.debug(f"WebSocket connection attempt for agent {agent_file_id}")
@@ -259,8 +955,8 @@ async def websocket_endpoint(
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Agent not found in database")
             return
 
-        # Check if agent is running
-        if agent_file_id not in active_agents:
+        # Check if agent is running on this worker or another one
+        if agent_file_id not in active_agents and await asyncio.to_thread(agent_registry.get_owner, agent_file_id) is None:
             logger.error(f"Agent {agent_file_id} not found in active_agents")
             # Try to start the agent
             try:
@@ -272,61 +968,107 @@ async def websocket_endpoint(
                 await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Failed to start agent. Please try again.")
                 return
 
-        # Double check if agent is now running
-        if agent_file_id not in active_agents:
+        # Double check if agent is now running, messages are forwarded when another worker owns it
+        owner = agent_registry.worker_id if agent_file_id in active_agents else await asyncio.to_thread(agent_registry.get_owner, agent_file_id)
+        if owner is None or (agent_registry.is_local(owner) and agent_file_id not in active_agents):
             logger.error(f"Agent {agent_file_id} still not found in active_agents after start attempt")
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Agent failed to start. Please try again.")
             return
         
+        # Negotiate the frame encoding and compression, JSON text frames by default
+        try:
+            codec = negotiate_codec(websocket, settings.WS_MAX_MESSAGE_BYTES)
+        except ValueError as e:
+            logger.error(f"Unsupported WebSocket protocol for agent {agent_file_id}: {str(e)}")
+            await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA, reason=str(e))
+            return
+
+        try:
+            deadline = _parse_deadline(websocket.query_params.get("deadline"))
+        except ValueError as e:
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=str(e))
+            return
+
         # Accept the connection
         logger.debug(f"Accepting WebSocket connection for agent {agent_file_id}")
-        await websocket.accept()
+        await websocket.accept(subprotocol=codec.subprotocol)
         logger.debug(f"WebSocket connection accepted for agent {agent_file_id}")
+
+        # Enforce connection caps, accepting first so the client sees a clean 1013
+        rejection = connection_manager.check_capacity(agent_file_id)
+        if rejection:
+            logger.warning(f"Rejecting WebSocket connection for agent {agent_file_id}: {rejection}")
+            await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason=rejection)
+            return
         
         # Add to active connections
-        if agent_file_id not in active_connections:
-            active_connections[agent_file_id] = []
-        active_connections[agent_file_id].append(websocket)
+        connection_manager.add(agent_file_id, websocket)
         logger.debug(f"Added WebSocket connection to active_connections for agent {agent_file_id}")
+        # Tasks of this connection and its runs show up under it in the task dump
+        client = websocket.client
+        connection_id = f"{client.host}:{client.port}" if client else hex(id(websocket))
+        label_task(agent=agent_file_id, websocket=connection_id)
         
+        idle = False
+        pending = deque()
+        run = None
+        receiving = None
         try:
             while True:
-                # Receive message
-                data = await websocket.receive_text()
-                logger.info(f"Received message from agent {agent_file_id}: {data}")
-                
-                # Process message with MCP agent
-                try:
+                # Messages are answered one at a time, in order
+                if run is None and pending:
+                    data = pending.popleft()
                     logger.info(f"Processing message with MCP agent {agent_file_id}")
-                    response = await active_agents[agent_file_id].run(data)
-                    logger.info(f"Got response from agent {agent_file_id}: {response}")
-                    
-                    # Create message object
-                    message = ChatMessage(
-                        agent_id=agent_file_id,
-                        message=response
+                    run = agent_runs.start(
+                        agent_file_id, _run_chat_message(agent_file_id, data), "websocket", deadline,
+                        session=f"websocket:{connection_id}"
                     )
-                    
-                    # Send response back to the client
-                    await websocket.send_json(message.model_dump(mode="json"))
-                    logger.info(f"Sent response to client for agent {agent_file_id}")
-                    
-                except Exception as e:
-                    logger.error(f"Error processing message for agent {agent_file_id}: {str(e)}", exc_info=True)
-                    error_message = ChatMessage(
-                        agent_id=agent_file_id,
-                        message=f"Error processing message: {str(e)}"
-                    )
-                    await websocket.send_json(error_message.model_dump(mode="json"))
+
+                # Keep receiving while a message runs, so cancel frames and disconnects are seen right away
+                if receiving is None:
+                    receiving = asyncio.create_task(codec.receive(websocket))
+                waiting = {receiving} if run is None else {receiving, run.task}
+                # Drop connections that stay silent for too long, unless they wait for an answer
+                timeout = (settings.WS_IDLE_TIMEOUT or None) if run is None else None
+                done, _ = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logger.debug(f"Closing idle WebSocket connection for agent {agent_file_id}")
+                    idle = True
+                    await websocket.close(code=status.WS_1001_GOING_AWAY, reason="Idle timeout")
+                    break
+
+                if run is not None and run.task in done:
+                    await _send_run_result(codec, websocket, agent_file_id, run)
+                    run = None
+
+                if receiving in done:
+                    try:
+                        data = receiving.result()
+                    except MessageTooBigError as e:
+                        logger.warning(f"Closing WebSocket connection for agent {agent_file_id}: {str(e)}")
+                        await websocket.close(code=status.WS_1009_MESSAGE_TOO_BIG, reason=str(e))
+                        break
+                    receiving = None
+                    if _is_cancel_frame(data):
+                        logger.info(f"Client cancelled {len(pending) + (run is not None)} messages for agent {agent_file_id}")
+                        pending.clear()
+                        if run is not None:
+                            run.cancel("cancelled by the client")
+                        continue
+                    logger.info(f"Received message from agent {agent_file_id}: {data}")
+                    pending.append(data)
                 
         except WebSocketDisconnect:
             logger.debug(f"WebSocket disconnected for agent {agent_file_id}")
-            # Remove connection on disconnect
-            if agent_file_id in active_connections:
-                active_connections[agent_file_id].remove(websocket)
-                if not active_connections[agent_file_id]:
-                    del active_connections[agent_file_id]
-                logger.debug(f"Removed WebSocket connection for agent {agent_file_id}")
+        finally:
+            # Nobody is left to read the answer
+            if run is not None:
+                run.cancel("client disconnected")
+            if receiving is not None:
+                receiving.cancel()
+            # Remove connection on disconnect, idle timeout or error
+            connection_manager.remove(agent_file_id, websocket, idle=idle)
+            logger.debug(f"Removed WebSocket connection for agent {agent_file_id}")
                     
     except Exception as e:
         logger.error(f"WebSocket error for agent {agent_file_id}: {str(e)}", exc_info=True)
@@ -335,8 +1077,7 @@ async def websocket_endpoint(
         except:
             pass
 
-AGENT_TYPES_FILE_PATH = os.path.join("configs", "agent-types.json")
-print(AGENT_TYPES_FILE_PATH)
+AGENT_TYPES_FILE_PATH = settings.AGENT_TYPES_FILE
 
 @router.get("/types/{agent_id}",
             summary="Get MCP agent type configuration",
@@ -379,4 +1120,275 @@ async def get_agent_type_configuration(agent_id: int):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Error decoding agent types configuration file"
-        )
\ No newline at end of file
+        )
+
+
+def _tool_services():
+    # Importing these loads mcp_use and LangChain, which blocks for seconds before the first agent start
+    from app.services.tool_cache import tool_cache, tool_call_limiter
+    from app.services.tool_outputs import tool_output_store
+    from app.services.tool_results import tool_result_cache
+    from app.services.tool_selector import tool_selector
+    return tool_cache, tool_call_limiter, tool_output_store, tool_result_cache, tool_selector
+
+
+@router.get("/tools/stats",
+            summary="Get tool cache, pre-selection and tool call statistics",
+            description="Retrieve hit counts of the MCP tool schema and tool result caches, the estimated prompt token reduction from semantic tool pre-selection, the concurrency of tool calls and the spilling of huge tool outputs.",
+            response_description="Tool cache and pre-selection statistics"
+            )
+async def get_tool_stats():
+    """
+    Retrieve statistics about MCP tool handling.
+
+    - **cache**: Tool schema cache entries, hits and misses
+    - **selection**: Number of pre-selections and estimated tool definition tokens before and after selection
+    - **calls**: Tool calls made, calls that waited for their server's concurrency limit and calls in flight (now and at peak)
+    - **results**: Cached read-only tool results, hit rate, expirations and evictions, hits and misses per tool
+    - **outputs**: Huge tool outputs spilled to disk, bytes stored and pages read by the LLM
+    """
+    tool_cache, tool_call_limiter, tool_output_store, tool_result_cache, tool_selector = \
+        await asyncio.to_thread(_tool_services)
+
+    return {
+        "cache": tool_cache.stats(),
+        "selection": tool_selector.stats(),
+        "calls": tool_call_limiter.stats(),
+        "results": tool_result_cache.stats(),
+        "outputs": tool_output_store.stats()
+    }
+
+
+@router.post("/tools/invalidate",
+             summary="Invalidate cached tool results",
+             description="Drop cached results of read-only MCP tools, e.g. after changing data the agents read.",
+             response_description="Number of dropped results"
+             )
+async def invalidate_tool_results(tool: Optional[str] = Query(None, description="Only drop the results of this tool")):
+    """
+    Drop cached tool results so the next calls go to the MCP servers again.
+
+    - **tool**: Tool name, all tools when omitted
+    """
+    _, _, _, tool_result_cache, _ = await asyncio.to_thread(_tool_services)
+
+    return {"invalidated": tool_result_cache.invalidate(tool)}
+
+
+@router.get("/supervisor/status",
+            summary="Get agent auto-start progress",
+            description="Retrieve how far this worker has converged towards running every agent file with active agents.",
+            response_description="Convergence progress of the agent supervisor"
+            )
+async def get_supervisor_status():
+    """
+    Retrieve the convergence progress of the agent supervisor.
+
+    - **converged**: Whether every agent file with an active agent is running (here or on another worker)
+    - **desired** / **running**: Agent files that should run and the ones that do
+    - **starting** / **pending** / **failed** / **suspended**: Agent files not running yet and why
+    - **time_to_converge_seconds**: Time from startup until all desired agents were first running
+    """
+    return agent_supervisor.status()
+
+
+@router.get("/hibernation/stats",
+            summary="Get agent hibernation statistics",
+            description="Retrieve the hibernated agents of this worker and how long restoring them takes compared to a cold start.",
+            response_description="Hibernation statistics"
+            )
+async def get_hibernation_stats():
+    """
+    Retrieve hibernation statistics of this worker.
+
+    - **idle_after**: Seconds without a message before an agent is hibernated, 0 when disabled
+    - **hibernated**: Agent files currently hibernated
+    - **hibernations** / **restores**: Agents hibernated and woken up again
+    - **snapshot_bytes**: Total size of the memory snapshots written
+    - **restore_seconds**: Average time to restore a hibernated agent from its snapshot, before its MCP servers are back
+    - **restore_to_first_tool_result_seconds**: Average time from a restore until the first tool call returned, including the LLM planning it
+    - **cold_start_seconds**: Average time to start a new agent and connect its MCP servers
+    """
+    return agent_hibernator.stats()
+
+
+@router.get("/runs/stats",
+            summary="Get agent run statistics",
+            description="Retrieve the agent runs in flight on this worker and how much work cancelled runs executed and abandoned.",
+            response_description="Agent run statistics"
+            )
+async def get_run_stats():
+    """
+    Retrieve agent run statistics for this worker.
+
+    - **active**: Runs in flight with their progress
+    - **runs**: Finished runs per outcome (succeeded, failed, cancelled, deadline_exceeded, rejected over quota)
+    - **steps_executed** / **steps_abandoned**: Agent steps that completed, and steps cut off by cancellations
+    - **tool_calls_executed** / **tool_calls_abandoned**: MCP tool calls that completed, and calls cancelled in flight
+    """
+    return {**agent_runs.stats(), "active": agent_runs.active()}
+
+
+@router.get("/usage/stats",
+            summary="Get agent usage",
+            description="Retrieve the LLM tokens, run time and MCP server resources agents used since this worker started.",
+            response_description="Agent usage"
+            )
+async def get_usage_stats(agent_id: Optional[int] = Query(None, description="Only the usage of this agent file")):
+    """
+    Retrieve the usage of the agents run on this worker.
+
+    - **agents**: Per agent file, runs, rejected runs, steps, prompt and completion tokens, wall time,
+      CPU seconds and peak RSS of its MCP server processes, and its running MCP processes and their RSS
+    - **tokens_today** / **token_quota** / **over_quota**: Tokens used today (UTC) across all workers and the daily quota
+    - **sessions**: Usage per websocket connection, job or fan-out of the most recent sessions
+    """
+    return agent_usage.stats(agent_id)
+
+
+@router.get("/usage/daily",
+            summary="Get daily agent usage",
+            description="Retrieve the persisted daily usage rollups of the agents, across all workers.",
+            response_description="Daily usage per agent, newest first"
+            )
+def get_usage_daily(
+        agent_id: Optional[int] = Query(None, description="Only the usage of this agent file"),
+        days: int = Query(7, ge=1, le=366, description="Number of days, today (UTC) included"),
+):
+    """
+    Retrieve the daily usage rollups, written every `USAGE_FLUSH_INTERVAL` seconds.
+
+    - **agent_file_id** / **day**: The agent file and the UTC day
+    - **runs** / **rejected_runs** / **steps** / **prompt_tokens** / **completion_tokens** / **wall_seconds**: Agent run usage
+    - **mcp_cpu_seconds** / **mcp_peak_rss_kb**: CPU time and peak RSS of the agent's MCP server processes
+    """
+    return agent_usage.daily(agent_id, days)
+
+
+@router.post("/secrets/invalidate",
+             summary="Invalidate cached secrets",
+             description="Drop the cached secret values so rotated secrets are fetched again on the next agent or MCP server start.",
+             response_description="Secret cache statistics before the invalidation"
+             )
+async def invalidate_secrets():
+    """
+    Drop every cached secret value on this worker.
+
+    Running MCP servers keep the environment they were started with; restart
+    or reload an agent to hand it the rotated values.
+
+    - **backend**: Secrets backend in use
+    - **cached** / **hits** / **misses**: Secret cache statistics before the invalidation
+    """
+    stats = secret_resolver.stats()
+    secret_resolver.invalidate()
+    return stats
+
+
+@router.get("/connections/stats",
+            summary="Get WebSocket connection statistics",
+            description="Retrieve current WebSocket connections per agent together with churn metrics for this worker.",
+            response_description="WebSocket connection statistics"
+            )
+async def get_connection_stats():
+    """
+    Retrieve WebSocket connection statistics for this worker.
+
+    - **current** / **per_agent** / **peak**: Open connections
+    - **opened** / **closed** / **idle_closed** / **rejected**: Connection churn since startup
+    - **avg_duration_seconds**: Average lifetime of closed connections
+    - **max_rss_kb**: Peak resident memory of the worker process
+    """
+    return connection_manager.stats()
+
+
+@router.get("/loop/stats",
+            summary="Get event-loop lag statistics",
+            description="Retrieve how late the event loop of this worker runs and the recent stalls with the code that blocked it.",
+            response_description="Event-loop lag statistics"
+            )
+async def get_loop_stats():
+    """
+    Retrieve event-loop lag statistics for this worker.
+
+    - **interval** / **threshold**: Seconds between lag measurements, and the lag logged as a slow callback
+    - **lag**: Current, average, 99th percentile and maximum lag in seconds
+    - **slow_callbacks** / **blocked_seconds**: Stalls at or above the threshold and their total duration
+    - **recent**: The last stalls with the stack of the event loop thread sampled while it was blocked
+    """
+    return loop_monitor.stats()
+
+
+@router.post("/loop/threshold",
+             summary="Set the slow callback threshold",
+             description="Change how long the event loop may be blocked before the stall is logged, until the worker restarts.",
+             response_description="Event-loop lag statistics with the new threshold"
+             )
+async def set_loop_threshold(seconds: float = Query(..., gt=0, description="Seconds the event loop may be blocked")):
+    """
+    Change the slow callback threshold of this worker.
+
+    - **seconds**: Stalls of the event loop this long or longer are logged with the blocking stack
+    """
+    loop_monitor.set_threshold(seconds)
+    logger.info(f"Slow callback threshold set to {seconds:g}s")
+    return loop_monitor.stats()
+
+
+@router.get("/debug/tasks",
+            summary="Dump asyncio tasks",
+            description="List the asyncio tasks of this worker per agent and WebSocket connection, with where each one is suspended.",
+            response_description="Asyncio tasks grouped per agent and connection"
+            )
+async def get_debug_tasks(
+    agent_id: Optional[int] = Query(None, description="Only list the tasks of this agent file"),
+    depth: int = Query(8, ge=1, le=50, description="Awaited coroutines listed per task")
+):
+    """
+    List the asyncio tasks of this worker.
+
+    - **total**: Tasks of the event loop, before filtering
+    - **agents**: Per agent file, its ``tasks`` (runs, MCP sessions) and the tasks of each of its ``websockets``
+    - **other**: Tasks not working for an agent (supervisor, job queue, HTTP requests)
+
+    Every task lists its name, labels and the chain of coroutines it is suspended in.
+    """
+    return dump_tasks(agent_id, depth)
+
+
+@router.post("/debug/profile",
+             summary="Capture a CPU profile",
+             description="Sample the stacks of every thread of this worker for a few seconds and report where the time went.",
+             response_description="Functions with the most samples, or collapsed stacks"
+             )
+async def capture_profile(
+    seconds: float = Query(10, gt=0, description="Seconds to sample, capped at DEBUG_PROFILE_MAX_SECONDS"),
+    interval_ms: float = Query(5, ge=1, le=1000, description="Milliseconds between samples"),
+    top: int = Query(30, ge=1, le=500, description="Functions listed per ranking"),
+    format: str = Query("json", pattern="^(json|folded)$", description="``folded`` returns collapsed stacks for flame graphs")
+):
+    """
+    Capture a CPU profile of the live worker by sampling.
+
+    The event loop keeps serving requests while the profile is captured. Only
+    one profile runs at a time, a second request gets a 409.
+
+    - **samples**: Sampling rounds taken
+    - **threads**: Samples per thread, and the ones where it was busy rather than waiting for work
+    - **self** / **cumulative**: Functions the busy samples were taken in, and under
+    """
+    if sampling_profiler.running:
+        raise HTTPException(status_code=409, detail="A profile is already being captured")
+    try:
+        samples, threads, stacks = await asyncio.to_thread(sampling_profiler.profile, seconds, interval_ms / 1000)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    if format == "folded":
+        return PlainTextResponse(sampling_profiler.folded(stacks))
+    return {
+        "seconds": min(seconds, sampling_profiler.max_seconds),
+        "samples": samples,
+        "threads": threads,
+        **sampling_profiler.summary(stacks, top),
+    }
@@ -0,0 +1,25 @@
+import hashlib
+import json
+
+from fastapi import Request
+
+
+def make_etag(*parts) -> str:
+    """Build a weak ETag from the values that identify a representation."""
+    digest = hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()
+    return f'W/"{digest}"'
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    """Check the request's If-None-Match header against an ETag (weak comparison)."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+
+    def strip_weak(tag: str) -> str:
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+
+    return strip_weak(etag) in {strip_weak(tag) for tag in header.split(",")}
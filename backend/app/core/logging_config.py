@@ -3,6 +3,25 @@ import os
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
 
+from app.core.config import settings
+
+
+class TruncatingFilter(logging.Filter):
+    """Caps the size of log messages, agent responses and tool outputs can be megabytes."""
+
+    def __init__(self, max_chars: int):
+        super().__init__()
+        self.max_chars = max_chars
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.max_chars:
+            message = record.getMessage()
+            if len(message) > self.max_chars:
+                record.msg = f"{message[:self.max_chars]}... [{len(message) - self.max_chars} more characters]"
+                record.args = None
+        return True
+
+
 def setup_logging():
     # Get the project root directory
     project_root = Path(__file__).parent.parent.parent
@@ -21,6 +40,8 @@ def setup_logging():
         '%(asctime)s - %(levelname)s - %(message)s'
     )
 
+    truncating_filter = TruncatingFilter(settings.LOG_MAX_MESSAGE_CHARS)
+
     # Create file handler
     file_handler = RotatingFileHandler(
         str(log_file),
@@ -29,11 +50,13 @@ def setup_logging():
     )
     file_handler.setLevel(logging.INFO)
     file_handler.setFormatter(file_formatter)
+    file_handler.addFilter(truncating_filter)
 
     # Create console handler
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)
     console_handler.setFormatter(console_formatter)
+    console_handler.addFilter(truncating_filter)
 
     # Get root logger
     root_logger = logging.getLogger()
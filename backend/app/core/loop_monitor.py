@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from weakref import WeakKeyDictionary
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Labels of the current task (agent, websocket, run, server), inherited by the tasks it creates
+task_labels: ContextVar[Dict[str, str]] = ContextVar("task_labels", default={})
+# Labels per task, Task.get_context() only exists from Python 3.12 on
+_labels: "WeakKeyDictionary[asyncio.Task, Dict[str, str]]" = WeakKeyDictionary()
+
+
+def track_task_labels() -> None:
+    """Record the labels of every task the running loop creates, so ``dump_tasks`` can group them."""
+    loop = asyncio.get_running_loop()
+    create = loop.get_task_factory()
+
+    def factory(loop, coro, **kwargs):
+        task = create(loop, coro, **kwargs) if create else asyncio.Task(coro, loop=loop, **kwargs)
+        context = kwargs.get("context")
+        labels = task_labels.get() if context is None else context.get(task_labels, {})
+        if labels:
+            _labels[task] = labels
+        return task
+
+    loop.set_task_factory(factory)
+
+
+def label_task(**labels: Optional[object]) -> None:
+    """Label the current task and the tasks it creates from now on, None removes a label."""
+    merged = {**task_labels.get(), **labels}
+    merged = {name: str(value) for name, value in merged.items() if value is not None}
+    task_labels.set(merged)
+    task = asyncio.current_task()
+    if task is not None:
+        _labels[task] = merged
+
+
+@contextmanager
+def labelled_tasks(**labels: Optional[object]):
+    """Label the tasks created inside the block, for code that runs in a task it does not own."""
+    token = task_labels.set(task_labels.get())
+    label_task(**labels)
+    try:
+        yield
+    finally:
+        task_labels.reset(token)
+
+
+def _await_chain(coro, depth: int) -> List[str]:
+    """Where a task is suspended: its coroutine and the coroutines it awaits, outermost first."""
+    chain = []
+    while coro is not None and len(chain) < depth:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "ag_frame", None)
+        if frame is None:
+            break
+        chain.append(f"{frame.f_code.co_qualname} ({frame.f_code.co_filename}:{frame.f_lineno})")
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "ag_await", None)
+    return chain
+
+
+def dump_tasks(agent_file_id: Optional[int] = None, depth: int = 8) -> dict:
+    """
+    The asyncio tasks of the running loop grouped per agent, and per websocket
+    within an agent, from the labels their context carries.
+    """
+    agents: Dict[str, dict] = {}
+    other = []
+    tasks = asyncio.all_tasks()
+    for task in tasks:
+        labels = _labels.get(task, {})
+        if agent_file_id is not None and labels.get("agent") != str(agent_file_id):
+            continue
+        entry = {
+            "name": task.get_name(),
+            "labels": labels,
+            "awaiting": _await_chain(task.get_coro(), depth),
+        }
+        if "agent" not in labels:
+            other.append(entry)
+            continue
+        group = agents.setdefault(labels["agent"], {"tasks": [], "websockets": {}})
+        if "websocket" in labels:
+            group["websockets"].setdefault(labels["websocket"], []).append(entry)
+        else:
+            group["tasks"].append(entry)
+    return {"total": len(tasks), "agents": agents, "other": other}
+
+
+def _format_stack(frame, limit: int = 20) -> List[str]:
+    # Import machinery frames only hide which import blocked the loop
+    stack = [entry for entry in traceback.extract_stack(frame) if not entry.filename.startswith("<frozen ")]
+    return [f"{entry.filename}:{entry.lineno} in {entry.name}" for entry in stack[-limit:]]
+
+
+class LoopMonitor:
+    """
+    Measures how late the event loop wakes up a task sleeping ``interval``
+    seconds, which is how long callbacks kept it blocked.
+
+    Lags of ``threshold`` seconds or more are counted and logged together with
+    what blocked the loop: a watchdog thread samples the stack of the event
+    loop thread while the loop is overdue, since nothing running on the loop
+    can observe it while it is blocked. The threshold is also handed to
+    asyncio, which logs slow callbacks itself when debug mode is on.
+    """
+
+    def __init__(self, interval: float, threshold: float, window: int = 1200):
+        self.interval = interval
+        self.threshold = threshold
+        self._lags: deque = deque(maxlen=window)
+        self.recent: deque = deque(maxlen=20)
+        self.slow_callbacks = 0
+        self.blocked_seconds = 0.0
+        self.max_lag = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self._loop_thread: Optional[int] = None
+        self._expected = 0.0
+        self._stack: Optional[List[str]] = None
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop.slow_callback_duration = self.threshold
+        self._loop_thread = threading.get_ident()
+        self._expected = time.monotonic() + self.interval
+        self._task = asyncio.create_task(self._run(), name="loop-monitor")
+        self._stopping.clear()
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._stopping.set()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self._watchdog.join(timeout=1)
+        self._watchdog = None
+
+    def set_threshold(self, threshold: float) -> None:
+        self.threshold = threshold
+        if self._loop is not None:
+            self._loop.slow_callback_duration = threshold
+
+    async def _run(self) -> None:
+        while True:
+            self._expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self._record(max(0.0, time.monotonic() - self._expected))
+
+    def _watch(self) -> None:
+        while not self._stopping.wait(self.threshold / 2):
+            # Capture the stack once per stall, halfway to the threshold so short stalls are caught too
+            if self._stack is None and time.monotonic() - self._expected >= self.threshold / 2:
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is not None:
+                    self._stack = _format_stack(frame)
+
+    def _record(self, lag: float) -> None:
+        stack, self._stack = self._stack, None
+        self._lags.append(lag)
+        self.max_lag = max(self.max_lag, lag)
+        if lag < self.threshold:
+            return
+
+        self.slow_callbacks += 1
+        self.blocked_seconds += lag
+        self.recent.append({
+            "at": datetime.now(timezone.utc).isoformat(),
+            "seconds": round(lag, 3),
+            "stack": stack or [],
+        })
+        logger.warning(
+            f"Event loop blocked for {lag:.3f}s"
+            + (":\n  " + "\n  ".join(stack) if stack else " (blocking code not sampled)")
+        )
+
+    def stats(self) -> dict:
+        lags = sorted(self._lags)
+        return {
+            "running": self._task is not None,
+            "interval": self.interval,
+            "threshold": self.threshold,
+            # Seconds, over the last measurements (interval * window seconds)
+            "lag": {
+                "current": round(self._lags[-1], 4) if lags else None,
+                "average": round(sum(lags) / len(lags), 4) if lags else None,
+                "p99": round(lags[int(len(lags) * 0.99)], 4) if lags else None,
+                "max": round(self.max_lag, 4),
+            },
+            "slow_callbacks": self.slow_callbacks,
+            "blocked_seconds": round(self.blocked_seconds, 3),
+            "recent": list(self.recent),
+        }
+
+
+loop_monitor = LoopMonitor(settings.LOOP_MONITOR_INTERVAL, settings.LOOP_SLOW_CALLBACK_THRESHOLD)
@@ -0,0 +1,115 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from app.core.config import settings
+
+# Python frames threads sit in while they wait for work, not counted as busy
+_IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("thread.py", "_worker"),
+    ("queue.py", "get"),
+    ("unix_events.py", "_do_waitpid"),
+}
+
+
+def _location(code) -> str:
+    filename = code.co_filename
+    if "site-packages" + os.sep in filename:
+        filename = filename.split("site-packages" + os.sep, 1)[1]
+    elif filename.startswith(os.getcwd() + os.sep):
+        filename = os.path.relpath(filename)
+    return f"{code.co_qualname} ({filename}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    Profiles the live process by sampling the stack of every thread.
+
+    Unlike cProfile, which only sees the thread it is enabled in and slows down
+    every call, sampling covers the event loop and the threads running blocking
+    work (sync endpoints, database calls, ``asyncio.to_thread``) at a cost
+    independent of the code being profiled. Samples of threads waiting for
+    work are counted per thread but left out of the function rankings.
+    """
+
+    def __init__(self, max_seconds: float):
+        self.max_seconds = max_seconds
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def profile(self, seconds: float, interval: float = 0.005) -> Tuple[int, Dict[str, Dict[str, int]], Counter]:
+        """
+        Sample for ``seconds`` (capped at ``max_seconds``), blocking the calling
+        thread. Returns the number of samples, busy and total samples per thread
+        and the busy stacks, root first, with their sample counts.
+        """
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("A profile is already being captured")
+        try:
+            return self._sample(min(seconds, self.max_seconds), interval)
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def _sample(seconds: float, interval: float) -> Tuple[int, Dict[str, Dict[str, int]], Counter]:
+        own = threading.get_ident()
+        threads: Dict[str, Dict[str, int]] = {}
+        stacks: Counter = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                name = names.get(ident, str(ident))
+                counts = threads.setdefault(name, {"samples": 0, "busy": 0})
+                counts["samples"] += 1
+                if (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in _IDLE_FRAMES:
+                    continue
+                counts["busy"] += 1
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stacks[(name, tuple(reversed(stack)))] += 1
+            samples += 1
+            time.sleep(interval)
+        return samples, threads, stacks
+
+    @staticmethod
+    def summary(stacks: Counter, top: int) -> Dict[str, List[dict]]:
+        """The functions most samples were taken in (self) and under (cumulative)."""
+        own: Counter = Counter()
+        cumulative: Counter = Counter()
+        for (_, stack), count in stacks.items():
+            own[stack[-1]] += count
+            for code in set(stack):
+                cumulative[code] += count
+        busy = sum(stacks.values()) or 1
+        return {
+            name: [
+                {"function": _location(code), "samples": count, "percent": round(100 * count / busy, 1)}
+                for code, count in counter.most_common(top)
+            ]
+            for name, counter in (("self", own), ("cumulative", cumulative))
+        }
+
+    @staticmethod
+    def folded(stacks: Counter) -> str:
+        """Stacks in the collapsed format of flamegraph.pl and speedscope, one ``thread;root;...;leaf count`` per line."""
+        return "\n".join(
+            ";".join([name] + [_location(code) for code in stack]) + f" {count}"
+            for (name, stack), count in stacks.most_common()
+        ) + "\n"
+
+
+sampling_profiler = SamplingProfiler(settings.DEBUG_PROFILE_MAX_SECONDS)
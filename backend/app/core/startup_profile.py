@@ -0,0 +1,84 @@
+"""
+Import-time profile of the application, used to keep startup fast.
+
+    python -m app.core.startup_profile [--runs 5] [--budget 1.5] [--top 15]
+
+Imports ``app.main`` in fresh interpreters with ``-X importtime``, prints the
+slowest modules and exits with status 1 when the median import time exceeds
+the budget or when one of the libraries that must load lazily (on the first
+agent start) was imported.
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+BACKEND_DIR = Path(__file__).resolve().parents[2]
+
+# Heavy libraries that are only needed once an agent runs
+LAZY_MODULES = ("mcp_use", "langchain", "langchain_core", "langchain_groq", "fastembed", "numpy")
+
+_IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$")
+
+
+def profile_import(module: str = "app.main") -> Tuple[float, Dict[str, int]]:
+    """Import ``module`` in a fresh interpreter, return its import time in seconds and cumulative microseconds per module."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR,
+        env={**os.environ, "PYTHONPATH": str(BACKEND_DIR)},
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    cumulative: Dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match:
+            cumulative[match.group(4)] = int(match.group(2))
+    return cumulative.get(module, 0) / 1e6, cumulative
+
+
+def eagerly_imported(cumulative: Dict[str, int]) -> List[str]:
+    return sorted({name.split(".")[0] for name in cumulative if name.split(".")[0] in LAZY_MODULES})
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=1.5, help="Maximum median import time in seconds")
+    parser.add_argument("--top", type=int, default=15, help="Number of slowest modules to print")
+    args = parser.parse_args()
+
+    timings = []
+    cumulative: Dict[str, int] = {}
+    for _ in range(args.runs):
+        seconds, cumulative = profile_import()
+        timings.append(seconds)
+
+    median = statistics.median(timings)
+    print(f"import app.main: median {median:.3f}s over {args.runs} runs (min {min(timings):.3f}s, max {max(timings):.3f}s)")
+    print("\nSlowest top-level imports (cumulative, last run):")
+    top_level = {name: micros for name, micros in cumulative.items() if "." not in name and name != "app"}
+    for name, micros in sorted(top_level.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"  {micros / 1e3:9.1f} ms  {name}")
+
+    failed = False
+    eager = eagerly_imported(cumulative)
+    if eager:
+        print(f"\nFAIL: imported at startup but must load lazily: {', '.join(eager)}")
+        failed = True
+    if median > args.budget:
+        print(f"\nFAIL: median import time {median:.3f}s exceeds the {args.budget:.3f}s budget")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
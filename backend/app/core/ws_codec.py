@@ -0,0 +1,122 @@
+import json
+import zlib
+from typing import Optional
+
+import orjson
+import zstandard
+from fastapi import WebSocket, WebSocketDisconnect
+from pydantic import BaseModel
+
+# Websocket subprotocols understood by the chat endpoint, in order of preference.
+# "mcp.json" keeps the original text JSON frames; the others send binary frames
+# with orjson encoded payloads, optionally compressed.
+SUBPROTOCOLS = {
+    "mcp.orjson.zstd": ("orjson", "zstd"),
+    "mcp.orjson.deflate": ("orjson", "deflate"),
+    "mcp.orjson": ("orjson", None),
+    "mcp.json": ("json", None),
+}
+
+ENCODINGS = ("json", "orjson")
+COMPRESSIONS = ("zstd", "deflate")
+
+
+class MessageTooBigError(Exception):
+    """An incoming message decompresses to more than the message size limit."""
+
+
+class WebSocketCodec:
+    """
+    Encodes outgoing chat messages and decodes incoming ones for a websocket.
+
+    - **json**: text frames produced by the standard encoder (default)
+    - **orjson**: binary frames holding orjson encoded UTF-8 JSON
+    - **compression**: ``zstd`` or ``deflate`` (zlib format), only with binary frames
+
+    Incoming messages may be text frames, or binary frames holding UTF-8 text
+    compressed with the negotiated compression. Compressed messages are
+    decompressed up to ``max_message_bytes`` (0 disables the limit), larger
+    ones raise ``MessageTooBigError``.
+    """
+
+    def __init__(self, encoding: str = "json", compression: Optional[str] = None,
+                 subprotocol: Optional[str] = None, max_message_bytes: int = 0):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unsupported websocket encoding: {encoding}")
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(f"Unsupported websocket compression: {compression}")
+        if compression and encoding == "json":
+            # Compressed payloads can only travel in binary frames
+            encoding = "orjson"
+
+        self.encoding = encoding
+        self.compression = compression
+        self.subprotocol = subprotocol
+        self.max_message_bytes = max_message_bytes
+        self._zstd_compressor = zstandard.ZstdCompressor(level=3) if compression == "zstd" else None
+        self._zstd_decompressor = zstandard.ZstdDecompressor() if compression == "zstd" else None
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.compression == "zstd":
+            return self._zstd_compressor.compress(data)
+        if self.compression == "deflate":
+            return zlib.compress(data)
+        return data
+
+    def _decompress(self, data: bytes) -> bytes:
+        # One byte past the limit tells a message that is too big from one that just fits
+        limit = self.max_message_bytes + 1 if self.max_message_bytes else -1
+        if self.compression == "zstd":
+            # Streamed frames leave the content size out of their header, and a declared size is no limit
+            with self._zstd_decompressor.stream_reader(data) as reader:
+                output = reader.read(limit)
+        elif self.compression == "deflate":
+            decompressor = zlib.decompressobj()
+            output = decompressor.decompress(data, max(limit, 0))
+            # Stopped before the end of the stream without reaching the limit
+            if not decompressor.eof and len(output) != limit:
+                raise zlib.error("Incomplete or truncated stream")
+        else:
+            return data
+        if self.max_message_bytes and len(output) > self.max_message_bytes:
+            raise MessageTooBigError(f"Message exceeds {self.max_message_bytes} bytes once decompressed")
+        return output
+
+    def encode(self, message: BaseModel):
+        if self.encoding == "json":
+            return json.dumps(message.model_dump(mode="json"), separators=(",", ":"), ensure_ascii=False)
+        # orjson serializes datetimes natively, so skip pydantic's JSON mode
+        return self._compress(orjson.dumps(message.model_dump()))
+
+    async def send(self, websocket: WebSocket, message: BaseModel) -> None:
+        payload = self.encode(message)
+        if isinstance(payload, bytes):
+            await websocket.send_bytes(payload)
+        else:
+            await websocket.send_text(payload)
+
+    async def receive(self, websocket: WebSocket) -> str:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+        if message.get("text") is not None:
+            return message["text"]
+        return self._decompress(message["bytes"]).decode("utf-8")
+
+
+def negotiate_codec(websocket: WebSocket, max_message_bytes: int = 0) -> WebSocketCodec:
+    """
+    Pick the codec for a websocket connection.
+
+    The client either offers subprotocols (``Sec-WebSocket-Protocol``) or
+    passes ``encoding`` and ``compression`` query parameters. Without either
+    the original JSON text protocol is used.
+    """
+    offered = websocket.scope.get("subprotocols") or []
+    for subprotocol, (encoding, compression) in SUBPROTOCOLS.items():
+        if subprotocol in offered:
+            return WebSocketCodec(encoding, compression, subprotocol=subprotocol, max_message_bytes=max_message_bytes)
+
+    encoding = websocket.query_params.get("encoding", "json")
+    compression = websocket.query_params.get("compression") or None
+    return WebSocketCodec(encoding, compression, max_message_bytes=max_message_bytes)
@@ -0,0 +1,86 @@
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import inspect
+
+from app.db.base_class import Base
+from app.db.session import engine
+# Register the tables on Base.metadata
+from app.models.agent_file import AgentFile  # noqa: F401
+from app.models.mcp_agent import MCPAgent  # noqa: F401
+from app.models.worker import AgentOwner, Worker  # noqa: F401
+from app.models.agent_job import AgentJob  # noqa: F401
+from app.models.agent_usage import AgentUsageDay  # noqa: F401
+
+logger = logging.getLogger(__name__)
+
+BACKEND_DIR = Path(__file__).resolve().parents[2]
+
+# Last revision of the original migration chain. Databases the application
+# created with ``create_all`` before migrations were tracked match it.
+LEGACY_REVISION = "05f0b12c4479"
+
+# Arbitrary key of the PostgreSQL advisory lock held while migrating
+MIGRATION_LOCK_ID = 7_284_913
+
+
+@contextmanager
+def _migration_lock() -> Iterator[None]:
+    """Keep hosts deploying at the same time from migrating a shared PostgreSQL database concurrently."""
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect() as connection:
+        # Waiting for another host's migration is not bound by DB_STATEMENT_TIMEOUT
+        connection.exec_driver_sql("SET statement_timeout = 0")
+        connection.exec_driver_sql(f"SELECT pg_advisory_lock({MIGRATION_LOCK_ID})")
+        try:
+            yield
+        finally:
+            connection.exec_driver_sql(f"SELECT pg_advisory_unlock({MIGRATION_LOCK_ID})")
+
+
+def _alembic_config() -> Config:
+    config = Config(str(BACKEND_DIR / "alembic.ini"))
+    config.set_main_option("script_location", str(BACKEND_DIR / "alembic"))
+    return config
+
+
+def init_db() -> None:
+    """
+    Bring the database schema up to date. Run once per deploy, before the API starts.
+
+    The first revisions of the migration chain drop the tables they find and
+    cannot build an empty database, so new databases get the current schema
+    directly and are stamped with the head revision. Existing databases are
+    upgraded through the migrations.
+    """
+    with _migration_lock():
+        _init_db()
+
+
+def _init_db() -> None:
+    config = _alembic_config()
+    tables = set(inspect(engine).get_table_names())
+
+    if not tables - {"alembic_version"}:
+        logger.info("Creating database schema")
+        Base.metadata.create_all(bind=engine)
+        command.stamp(config, "head")
+        return
+
+    if "alembic_version" not in tables:
+        logger.info(f"Untracked database, stamping it with revision {LEGACY_REVISION}")
+        command.stamp(config, LEGACY_REVISION)
+
+    logger.info("Upgrading database schema")
+    command.upgrade(config, "head")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    init_db()
@@ -0,0 +1,107 @@
+"""
+Throwaway PostgreSQL server for running and testing the API against PostgreSQL
+without Docker or a system-wide installation.
+
+    python -m app.db.local_postgres [--data-dir cache/pgdata] [--fresh] [-- command ...]
+
+Starts an embedded server from the ``pgserver`` package (``pip install
+pgserver``), or from ``initdb``/``pg_ctl`` found on the PATH, listening on a
+Unix socket only. The schema is brought up to date with ``app.db.init_db`` and
+``command`` (for example ``uvicorn app.main:app --workers 4``) runs with
+``SQLALCHEMY_DATABASE_URI`` and ``AGENT_REGISTRY_BACKEND=database`` pointing
+at it, and a generated ``AGENT_REGISTRY_FORWARD_TOKEN`` unless one is set. Without a command the URI is printed and the server runs until
+interrupted. The server is stopped on exit, the data directory is kept.
+"""
+import argparse
+import os
+import secrets
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import List, Optional
+
+BACKEND_DIR = Path(__file__).resolve().parents[2]
+
+
+class LocalPostgres:
+    def __init__(self, data_dir: Path):
+        self.data_dir = data_dir
+        self._server = None
+
+    def start(self) -> str:
+        """Start the server and return its SQLAlchemy URI."""
+        try:
+            import pgserver
+        except ImportError:
+            return self._start_pg_ctl()
+        self._server = pgserver.get_server(self.data_dir, cleanup_mode="stop")
+        # pgserver reports a libpq URI, e.g. postgresql://postgres:@/postgres?host=<socket dir>
+        return self._server.get_uri().replace("postgresql://", "postgresql+psycopg://", 1)
+
+    def _start_pg_ctl(self) -> str:
+        pg_ctl = shutil.which("pg_ctl")
+        initdb = shutil.which("initdb")
+        if not pg_ctl or not initdb:
+            raise RuntimeError("No embedded PostgreSQL available, install pgserver or put pg_ctl and initdb on the PATH")
+
+        if not (self.data_dir / "PG_VERSION").exists():
+            self.data_dir.mkdir(parents=True, exist_ok=True)
+            subprocess.run([initdb, "-D", str(self.data_dir), "-U", "postgres", "--auth=trust"], check=True)
+        subprocess.run(
+            [
+                pg_ctl, "-D", str(self.data_dir), "-l", str(self.data_dir / "server.log"), "-w",
+                # No TCP listener, only a socket in the data directory
+                "-o", f"-c listen_addresses='' -k {self.data_dir}",
+                "start",
+            ],
+            check=True,
+        )
+        self._server = pg_ctl
+        return f"postgresql+psycopg://postgres@/postgres?host={self.data_dir}"
+
+    def stop(self) -> None:
+        if isinstance(self._server, str):
+            subprocess.run([self._server, "-D", str(self.data_dir), "-m", "fast", "-w", "stop"], check=False)
+        elif self._server is not None:
+            self._server.cleanup()
+        self._server = None
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-dir", default="cache/pgdata")
+    parser.add_argument("--fresh", action="store_true", help="Delete the data directory first")
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="Command to run against the server")
+    args = parser.parse_args(argv)
+
+    data_dir = (BACKEND_DIR / args.data_dir).resolve()
+    if args.fresh and data_dir.exists():
+        shutil.rmtree(data_dir)
+
+    server = LocalPostgres(data_dir)
+    uri = server.start()
+    env = {**os.environ, "SQLALCHEMY_DATABASE_URI": uri, "AGENT_REGISTRY_BACKEND": "database"}
+    # The workers forward messages to each other over TCP, which requires a token
+    env.setdefault("AGENT_REGISTRY_FORWARD_TOKEN", secrets.token_urlsafe(32))
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    try:
+        subprocess.run([sys.executable, "-m", "app.db.init_db"], cwd=BACKEND_DIR, env=env, check=True)
+        if not command:
+            print(f"PostgreSQL running, SQLALCHEMY_DATABASE_URI={uri}")
+            print("Press Ctrl+C to stop")
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                return 0
+        return subprocess.run(command, cwd=BACKEND_DIR, env=env).returncode
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
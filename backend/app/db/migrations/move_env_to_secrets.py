@@ -0,0 +1,34 @@
+from app.db.session import SessionLocal
+from app.models.agent_file import AgentFile
+from app.models.mcp_agent import MCPAgent
+from app.services.mcp_agent_service import MCPAgentService
+from app.services.secret_store import secret_resolver
+
+def move_env_to_secrets():
+    """Move plain text env values of existing agents into the secret store and rewrite their config files."""
+    db = SessionLocal()
+
+    try:
+        moved = 0
+        for agent in db.query(MCPAgent).all():
+            env = secret_resolver.store_env(agent.name, agent.env or {})
+            if env != agent.env:
+                moved += sum(1 for key in env if env[key] != agent.env[key])
+                agent.env = env
+                agent.version = MCPAgent.version + 1
+        db.commit()
+
+        # Config files hold a copy of the env, rewrite them with the references
+        service = MCPAgentService(db)
+        for agent_file in db.query(AgentFile).all():
+            service._regenerate_agent_file_config(agent_file)
+        print(f"Moved {moved} env values into the {secret_resolver.stats()['backend']} secret store")
+
+    except Exception as e:
+        print(f"Error moving env values into the secret store: {str(e)}")
+        db.rollback()
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    move_env_to_secrets()
@@ -0,0 +1,5 @@
+from sqlalchemy import JSON
+from sqlalchemy.dialects.postgresql import JSONB
+
+# JSON on SQLite, binary JSONB (indexable, no reparsing on read) on PostgreSQL
+JSONType = JSON().with_variant(JSONB(), "postgresql")
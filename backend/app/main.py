@@ -5,16 +5,16 @@ from fastapi.openapi.utils import get_openapi
 from fastapi.staticfiles import StaticFiles
 from app.api.endpoints import mcp_agents
 from app.core.config import settings
-from app.db.session import engine
-from app.db.base_class import Base
 from app.core.logging_config import setup_logging
+from app.core.loop_monitor import loop_monitor, track_task_labels
+from app.services.agent_usage import agent_usage
+from app.services.tool_outputs import tool_output_store
 
 # Setup logging
 loggers = setup_logging()
 logger = loggers['mcp_agents']
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
+# The database schema is created and upgraded by `python -m app.db.init_db`
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
@@ -69,6 +69,11 @@ async def root():
 # Log registered routes on startup
 @app.on_event("startup")
 async def startup_event():
+    # Group tasks per agent and connection in task dumps, and measure event-loop lag from startup on
+    track_task_labels()
+    if settings.LOOP_MONITOR_ENABLED:
+        loop_monitor.start()
+
     logger.info("Application startup - registering routes")
     for route in app.routes:
         if hasattr(route, "methods"):
@@ -76,6 +81,34 @@ async def startup_event():
         else:
             logger.info(f"WebSocket Route: {route.path}")
 
+    # Join the agent registry so messages for agents owned by other workers can be forwarded
+    await mcp_agents.worker_forwarder.start()
+
+    # Reload running agents when their config files are regenerated
+    mcp_agents.config_reconciler.start()
+
+    # Bring agents marked as active to running so the first message does not pay for a cold start
+    if settings.AGENT_AUTOSTART_ENABLED:
+        mcp_agents.agent_supervisor.start()
+
+    # Run queued jobs, including the ones a previous process left behind
+    mcp_agents.job_queue.start()
+    mcp_agents.agent_hibernator.start()
+    agent_usage.start(mcp_agents.active_agents)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await mcp_agents.job_queue.stop()
+    await mcp_agents.agent_hibernator.stop()
+    await mcp_agents.agent_supervisor.stop()
+    await mcp_agents.config_reconciler.stop()
+    await mcp_agents.close_all_agents()
+    # After the agents, so the usage of runs cancelled on shutdown is written too
+    await agent_usage.stop()
+    await mcp_agents.worker_forwarder.stop()
+    tool_output_store.clear()
+    await loop_monitor.stop()
+
 # Custom OpenAPI schema
 def custom_openapi():
     if app.openapi_schema:
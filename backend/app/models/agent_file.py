@@ -1,4 +1,5 @@
 from sqlalchemy import Column, Integer, String
+from sqlalchemy.orm import relationship
 from app.db.base_class import Base
 
 class AgentFile(Base):
@@ -6,15 +7,16 @@ class AgentFile(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, nullable=False)  # File name with timestamp
-    mcp_agents = Column(String, nullable=False)  # Comma-separated list of MCP agent IDs
 
-    def __init__(self, name: str, mcp_agents: str):
+    # The database deletes the agents through ON DELETE CASCADE
+    agents = relationship("MCPAgent", back_populates="agent_file", passive_deletes=True, order_by="MCPAgent.id")
+
+    def __init__(self, name: str):
         self.name = name
-        self.mcp_agents = mcp_agents
 
     def to_dict(self):
         return {
             "id": self.id,
             "name": self.name,
-            "mcp_agents": self.mcp_agents
+            "mcp_agents": ",".join(str(agent.id) for agent in self.agents)
         }
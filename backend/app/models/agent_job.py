@@ -0,0 +1,48 @@
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, String, Text
+from sqlalchemy.sql import func
+from app.db.base_class import Base
+
+class AgentJob(Base):
+    """A prompt queued for an agent file and, once it ran, its result."""
+
+    __tablename__ = "agent_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    agent_file_id = Column(Integer, ForeignKey("agent_files.id", ondelete="CASCADE"), index=True, nullable=False)
+    batch_id = Column(String, index=True, nullable=True)  # Shared by the jobs submitted together
+    prompt = Column(Text, nullable=False)
+    priority = Column(Integer, nullable=False, server_default="0")  # Higher runs first
+    status = Column(String, nullable=False, server_default="queued")  # queued, running, succeeded, failed, cancelled
+    attempts = Column(Integer, nullable=False, server_default="0")
+    max_attempts = Column(Integer, nullable=False, server_default="3")
+    result = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+    worker_id = Column(String, nullable=True)  # Worker running the job
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    available_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)  # Not run before, for retries
+    lease_until = Column(DateTime(timezone=True), nullable=True)  # Running jobs past their lease are retried elsewhere
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        # Dispatch order of queued jobs
+        Index("ix_agent_jobs_status_priority", "status", "priority", "id"),
+    )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "agent_file_id": self.agent_file_id,
+            "batch_id": self.batch_id,
+            "prompt": self.prompt,
+            "priority": self.priority,
+            "status": self.status,
+            "attempts": self.attempts,
+            "max_attempts": self.max_attempts,
+            "result": self.result,
+            "error": self.error,
+            "worker_id": self.worker_id,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None
+        }
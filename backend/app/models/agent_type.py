@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String, JSON
+from sqlalchemy import Column, Integer, String
 from app.db.base_class import Base
+from app.db.types import JSONType
 
 class AgentType(Base):
     __tablename__ = "agent_types"
@@ -7,8 +8,8 @@ class AgentType(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, nullable=False)  # Unique name for the agent type (e.g., "slack")
     command = Column(String, nullable=False)  # The command used to run the agent (e.g., "npx")
-    args = Column(JSON, nullable=False)  # An array of strings (command arguments)
-    env_keys = Column(JSON, nullable=False)  # An array of strings (environment variable keys)
+    args = Column(JSONType, nullable=False)  # An array of strings (command arguments)
+    env_keys = Column(JSONType, nullable=False)  # An array of strings (environment variable keys)
 
     def __init__(self, name: str, command: str, args: list, env_keys: list):
         self.name = name
@@ -0,0 +1,32 @@
+from sqlalchemy import Column, Date, Float, ForeignKey, Integer
+from app.db.base_class import Base
+
+class AgentUsageDay(Base):
+    """Resources used by the runs and MCP servers of an agent file on one UTC day, summed over all workers."""
+
+    __tablename__ = "agent_usage_daily"
+
+    agent_file_id = Column(Integer, ForeignKey("agent_files.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True, index=True)
+    runs = Column(Integer, nullable=False, server_default="0")
+    rejected_runs = Column(Integer, nullable=False, server_default="0")  # Refused because the agent file was over its quota
+    steps = Column(Integer, nullable=False, server_default="0")
+    prompt_tokens = Column(Integer, nullable=False, server_default="0")
+    completion_tokens = Column(Integer, nullable=False, server_default="0")
+    wall_seconds = Column(Float, nullable=False, server_default="0")
+    mcp_cpu_seconds = Column(Float, nullable=False, server_default="0")  # CPU time of the agent's MCP server processes
+    mcp_peak_rss_kb = Column(Integer, nullable=False, server_default="0")  # Largest combined RSS of those processes
+
+    def to_dict(self):
+        return {
+            "agent_file_id": self.agent_file_id,
+            "day": self.day.isoformat(),
+            "runs": self.runs,
+            "rejected_runs": self.rejected_runs,
+            "steps": self.steps,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "wall_seconds": round(self.wall_seconds, 3),
+            "mcp_cpu_seconds": round(self.mcp_cpu_seconds, 3),
+            "mcp_peak_rss_kb": self.mcp_peak_rss_kb,
+        }
@@ -1,6 +1,8 @@
-from sqlalchemy import Column, Integer, String, JSON, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey
+from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.db.base_class import Base
+from app.db.types import JSONType
 from datetime import datetime
 
 class MCPAgent(Base):
@@ -8,13 +10,18 @@ class MCPAgent(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, index=True, nullable=False)
-    agent_type = Column(String, nullable=False)  # e.g., "slack", "browser", etc.
+    agent_type = Column(String, index=True, nullable=False)  # e.g., "slack", "browser", etc.
     command = Column(String, nullable=False)
-    args = Column(JSON, nullable=False)
-    env = Column(JSON, nullable=False)
-    is_active = Column(Boolean, default=True)
+    args = Column(JSONType, nullable=False)
+    env = Column(JSONType, nullable=False)
+    is_active = Column(Boolean, default=True, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
-    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=datetime.utcnow, nullable=False, index=True)
+    # Agents are deleted together with the agent file (config file) that contains them
+    agent_file_id = Column(Integer, ForeignKey("agent_files.id", ondelete="CASCADE"), index=True, nullable=True)
+    version = Column(Integer, nullable=False, server_default="1")  # Incremented on every update, used for ETags
+
+    agent_file = relationship("AgentFile", back_populates="agents")
     
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, model_validator
 from typing import List, Dict, Optional, Any
 from datetime import datetime
 
@@ -89,6 +89,219 @@ class MCPAgentUpdate(BaseModel):
             }
         }
 
+class MCPAgentBulkFilter(BaseModel):
+    # A misspelled criterion would otherwise widen the set of matched agents
+    model_config = ConfigDict(extra="forbid")
+
+    ids: Optional[List[int]] = Field(
+        None,
+        description="Only agents with these IDs",
+        example=[1, 2]
+    )
+    agent_type: Optional[str] = Field(
+        None,
+        description="Only agents of this type",
+        example="slack"
+    )
+    is_active: Optional[bool] = Field(
+        None,
+        description="Only active or inactive agents",
+        example=True
+    )
+    file_id: Optional[int] = Field(
+        None,
+        description="Only agents of this config file",
+        example=1
+    )
+
+class MCPAgentBulkChanges(BaseModel):
+    # Fields that cannot be changed in bulk (e.g. name) are rejected instead of ignored
+    model_config = ConfigDict(extra="forbid")
+
+    agent_type: Optional[str] = Field(
+        None,
+        description="Type of the agent",
+        example="slack"
+    )
+    command: Optional[str] = Field(
+        None,
+        description="Command to run the agent",
+        example="python"
+    )
+    args: Optional[list[str]] = Field(
+        None,
+        description="Command line arguments",
+        example=["app.py"]
+    )
+    env: Optional[Dict[str, str]] = Field(
+        None,
+        description="Environment variables",
+        example={"API_KEY": "your-api-key"}
+    )
+    is_active: Optional[bool] = Field(
+        None,
+        description="Whether the agent is active",
+        example=False
+    )
+
+class MCPAgentBulkUpdate(BaseModel):
+    filter: MCPAgentBulkFilter = Field(
+        ...,
+        description="Agents to update, at least one criterion is required"
+    )
+    update: MCPAgentBulkChanges = Field(
+        ...,
+        description="Fields to set on every matching agent (only provided fields will be updated)"
+    )
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "filter": {"agent_type": "slack"},
+                "update": {"is_active": False}
+            }
+        }
+
+class MCPAgentBulkUpdateResult(BaseModel):
+    matched: int = Field(..., description="Number of updated agents", example=2)
+    agent_ids: List[int] = Field(..., description="IDs of the updated agents", example=[1, 2])
+    agent_file_ids: List[int] = Field(..., description="Config files that were regenerated", example=[1])
+
+class AgentFileBulkDeleteResult(BaseModel):
+    deleted_files: int = Field(..., description="Number of deleted agent files", example=2)
+    deleted_agents: int = Field(..., description="Number of deleted agents", example=3)
+    agent_file_ids: List[int] = Field(..., description="IDs of the deleted agent files", example=[1, 2])
+    not_found: List[int] = Field(..., description="Requested agent file IDs that did not exist", example=[])
+
+class AgentJobCreate(BaseModel):
+    prompt: Optional[str] = Field(
+        None,
+        description="A single prompt to run",
+        example="Summarize yesterday's messages in #general"
+    )
+    prompts: Optional[List[str]] = Field(
+        None,
+        description="Several prompts to run as one batch, each becomes a job",
+        example=["Summarize #general", "Summarize #random"]
+    )
+    priority: int = Field(
+        0,
+        ge=-100,
+        le=100,
+        description="Jobs with a higher priority run first",
+        example=0
+    )
+    max_attempts: Optional[int] = Field(
+        None,
+        ge=1,
+        le=10,
+        description="Runs before a failing job is given up, defaults to JOB_MAX_ATTEMPTS",
+        example=3
+    )
+
+    @model_validator(mode="after")
+    def check_prompts(self):
+        if (self.prompt is None) == (self.prompts is None):
+            raise ValueError("Provide either prompt or prompts")
+        if self.prompts is not None and not self.prompts:
+            raise ValueError("prompts must not be empty")
+        return self
+
+    def all_prompts(self) -> List[str]:
+        return [self.prompt] if self.prompt is not None else list(self.prompts)
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "prompts": ["Summarize #general", "Summarize #random"],
+                "priority": -10
+            }
+        }
+
+class AgentJobInDB(BaseModel):
+    id: int = Field(..., description="Job identifier", example=1)
+    agent_file_id: int = Field(..., description="Agent file running the job", example=1)
+    batch_id: Optional[str] = Field(None, description="Shared by the jobs submitted together")
+    prompt: str = Field(..., description="Prompt sent to the agent")
+    priority: int = Field(..., description="Jobs with a higher priority run first", example=0)
+    status: str = Field(..., description="queued, running, succeeded, failed or cancelled", example="succeeded")
+    attempts: int = Field(..., description="Runs so far", example=1)
+    max_attempts: int = Field(..., description="Runs before the job is given up", example=3)
+    result: Optional[str] = Field(None, description="Agent response of a succeeded job")
+    error: Optional[str] = Field(None, description="Error of the last failed run")
+    worker_id: Optional[str] = Field(None, description="Worker that ran the job last")
+    created_at: Optional[datetime] = Field(None, description="Timestamp when the job was submitted")
+    started_at: Optional[datetime] = Field(None, description="Timestamp when the last run started")
+    finished_at: Optional[datetime] = Field(None, description="Timestamp when the job succeeded, failed or was cancelled")
+
+class AgentRunReport(BaseModel):
+    type: str = Field("run.cancelled", description="Frame type, tells the report apart from chat messages")
+    agent_id: int = Field(..., description="ID of the agent", example=1)
+    run_id: str = Field(..., description="Identifier of the run", example="3f9c2a1b7d4e")
+    status: str = Field(..., description="cancelled or deadline_exceeded", example="cancelled")
+    reason: Optional[str] = Field(None, description="Why the run was stopped", example="cancelled by the client")
+    elapsed: float = Field(..., description="Seconds the run took until it stopped", example=8.4)
+    steps_executed: int = Field(..., description="Agent steps that completed", example=3)
+    steps_abandoned: int = Field(..., description="Agent steps that were in flight when the run stopped", example=1)
+    tool_calls_executed: int = Field(..., description="MCP tool calls that completed", example=4)
+    tool_calls_abandoned: int = Field(..., description="MCP tool calls that were in flight when the run stopped", example=1)
+    prompt_tokens: int = Field(0, description="LLM prompt tokens used until the run stopped", example=5120)
+    completion_tokens: int = Field(0, description="LLM completion tokens used until the run stopped", example=230)
+    timestamp: datetime = Field(default_factory=datetime.utcnow, description="Timestamp of the report")
+
+class FanOutRequest(BaseModel):
+    prompt: str = Field(
+        ...,
+        min_length=1,
+        description="Prompt sent to every agent file",
+        example="What happened on the payments service yesterday?"
+    )
+    agent_file_ids: List[int] = Field(
+        ...,
+        min_length=1,
+        description="Agent files to ask, each at most once",
+        example=[1, 2, 3]
+    )
+    timeout: Optional[float] = Field(
+        None,
+        gt=0,
+        description="Seconds each agent may take to answer, defaults to FANOUT_TIMEOUT",
+        example=60
+    )
+    timeouts: Dict[int, float] = Field(
+        default_factory=dict,
+        description="Per agent file timeouts in seconds, overriding timeout",
+        example={"3": 180}
+    )
+
+    @model_validator(mode="after")
+    def check_agent_files(self):
+        if len(set(self.agent_file_ids)) != len(self.agent_file_ids):
+            raise ValueError("agent_file_ids must not contain duplicates")
+        unknown = set(self.timeouts) - set(self.agent_file_ids)
+        if unknown:
+            raise ValueError(f"timeouts given for agent files not in agent_file_ids: {sorted(unknown)}")
+        if any(timeout <= 0 for timeout in self.timeouts.values()):
+            raise ValueError("timeouts must be positive")
+        return self
+
+class FanOutResult(BaseModel):
+    agent_file_id: int = Field(..., description="Agent file that answered", example=1)
+    agent_file: str = Field(..., description="Name of the agent file", example="mcp_agents_20250101_120000.json")
+    status: str = Field(..., description="succeeded, failed or timeout", example="succeeded")
+    response: Optional[str] = Field(None, description="Agent response if it succeeded")
+    error: Optional[str] = Field(None, description="Error if the agent failed or timed out")
+    elapsed: float = Field(..., description="Seconds the agent took", example=4.2)
+
+class FanOutResponse(BaseModel):
+    prompt: str = Field(..., description="Prompt sent to every agent file")
+    results: List[FanOutResult] = Field(..., description="One result per agent file, in the requested order")
+    combined: str = Field(..., description="Succeeded responses merged into one text, one section per agent file")
+    succeeded: int = Field(..., description="Agents that answered", example=2)
+    failed: int = Field(..., description="Agents that raised an error", example=0)
+    timed_out: int = Field(..., description="Agents that did not answer in time", example=1)
+    elapsed: float = Field(..., description="Seconds until the slowest agent finished", example=12.5)
+
 class MCPAgentInDB(MCPAgentBase):
     id: int = Field(
         ...,
@@ -0,0 +1,20 @@
+from sqlalchemy import Column, Float, Integer, String
+from app.db.base_class import Base
+
+class Worker(Base):
+    """A worker process of any host, as seen by the "database" agent registry."""
+
+    __tablename__ = "workers"
+
+    worker_id = Column(String, primary_key=True)  # "<hostname>:<pid>"
+    address = Column(String, nullable=True)  # Where other workers forward messages to, e.g. "tcp://host:port"
+    last_seen = Column(Float, nullable=False, index=True)  # Unix time of the last heartbeat
+
+class AgentOwner(Base):
+    """The worker running an agent."""
+
+    __tablename__ = "agent_owners"
+
+    agent_file_id = Column(Integer, primary_key=True)
+    worker_id = Column(String, nullable=False, index=True)
+    claimed_at = Column(Float, nullable=False)
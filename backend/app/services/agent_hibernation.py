@@ -0,0 +1,154 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from app.services.tool_selector import ToolSelectingMCPAgent
+
+logger = logging.getLogger(__name__)
+
+
+def write_snapshot(path: str, snapshot: dict) -> int:
+    """Write a gzipped hibernation snapshot, returns its size."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    data = gzip.compress(json.dumps(snapshot, separators=(",", ":")).encode())
+    # Write to a temporary file first so a crash never leaves a torn snapshot
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+def read_snapshot(path: str) -> dict:
+    """Read a hibernation snapshot and delete it, it is only restored once."""
+    with open(path, "rb") as file:
+        snapshot = json.loads(gzip.decompress(file.read()))
+    os.unlink(path)
+    return snapshot
+
+
+class AgentHibernator:
+    """
+    Hibernates agents that received no message for ``idle_after`` seconds.
+
+    A hibernated agent stays in ``active_agents`` and keeps its registry claim,
+    so it still counts as running for the supervisor and other workers, but its
+    MCP server subprocesses are gone and its conversation memory lives in a
+    gzipped snapshot under ``snapshot_dir``. The next message restores it,
+    which skips loading the libraries, creating the LLM client and discovering
+    tools, and keeps the memory a stop and start would lose.
+
+    Restoring the snapshot takes milliseconds, but the MCP servers restart in
+    the background, so the first tool call after a restore waits for its
+    server about as long as a cold start takes. ``stats`` reports the time to
+    restore, the time from the restore to the first tool result and the time
+    of cold starts.
+    """
+
+    def __init__(self, agents: Dict[int, "ToolSelectingMCPAgent"], snapshot_dir: str,
+                 idle_after: int, interval: int):
+        self.agents = agents
+        self.snapshot_dir = snapshot_dir
+        self.idle_after = idle_after
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self._snapshots: Dict[int, str] = {}
+        self.hibernations = 0
+        self.restores = 0
+        self.snapshot_bytes = 0
+        self.restore_seconds: List[float] = []
+        self.first_tool_result_seconds: List[float] = []
+        self.cold_start_seconds: List[float] = []
+
+    def start(self) -> None:
+        if self.idle_after and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Memory of hibernated agents does not outlive the process, like the memory of running ones
+        for agent_file_id in list(self._snapshots):
+            self.forget(agent_file_id)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.hibernate_idle()
+            except Exception as e:
+                logger.error(f"Hibernating idle agents failed: {str(e)}", exc_info=True)
+
+    async def hibernate_idle(self) -> List[int]:
+        now = time.monotonic()
+        idle = [
+            agent_file_id for agent_file_id, agent in list(self.agents.items())
+            if not agent.hibernated and not agent.busy and now - agent.last_used >= self.idle_after
+        ]
+        return [agent_file_id for agent_file_id in idle if await self.hibernate(agent_file_id)]
+
+    async def hibernate(self, agent_file_id: int) -> bool:
+        """Hibernate a running agent, returns False if it is busy, not connected or already hibernated."""
+        agent = self.agents.get(agent_file_id)
+        if agent is None or agent.hibernated:
+            return False
+
+        path = os.path.join(self.snapshot_dir, f"{os.getpid()}-{agent_file_id}.json.gz")
+        started = time.perf_counter()
+        size = await agent.hibernate(
+            path,
+            on_restore=lambda seconds: self._restored(agent_file_id, seconds),
+            on_first_tool_result=self._first_tool_result,
+        )
+        if size is None:
+            return False
+
+        self._snapshots[agent_file_id] = path
+        self.hibernations += 1
+        self.snapshot_bytes += size
+        logger.info(
+            f"Hibernated agent {agent_file_id} in {time.perf_counter() - started:.3f}s ({size} bytes snapshot)"
+        )
+        return True
+
+    def _restored(self, agent_file_id: int, seconds: float) -> None:
+        self._snapshots.pop(agent_file_id, None)
+        self.restores += 1
+        self.restore_seconds = (self.restore_seconds + [seconds])[-100:]
+        logger.info(f"Restored agent {agent_file_id} from hibernation in {seconds:.3f}s")
+
+    def _first_tool_result(self, seconds: float) -> None:
+        self.first_tool_result_seconds = (self.first_tool_result_seconds + [seconds])[-100:]
+
+    def record_cold_start(self, seconds: float) -> None:
+        self.cold_start_seconds = (self.cold_start_seconds + [seconds])[-100:]
+
+    def forget(self, agent_file_id: int) -> None:
+        """Delete the snapshot of an agent that is stopped while hibernated."""
+        path = self._snapshots.pop(agent_file_id, None)
+        if path is not None and os.path.exists(path):
+            os.unlink(path)
+
+    @staticmethod
+    def _average(values: List[float]) -> Optional[float]:
+        return round(sum(values) / len(values), 3) if values else None
+
+    def stats(self) -> dict:
+        return {
+            "idle_after": self.idle_after,
+            "hibernated": sorted(agent_file_id for agent_file_id, agent in self.agents.items() if agent.hibernated),
+            "hibernations": self.hibernations,
+            "restores": self.restores,
+            "snapshot_bytes": self.snapshot_bytes,
+            # Averages over the last 100 restores and cold starts (start and connect) on this worker
+            "restore_seconds": self._average(self.restore_seconds),
+            "restore_to_first_tool_result_seconds": self._average(self.first_tool_result_seconds),
+            "cold_start_seconds": self._average(self.cold_start_seconds),
+        }
@@ -0,0 +1,474 @@
+import asyncio
+import hmac
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Iterator, Optional
+
+from sqlalchemy import delete, exists, or_, select, update
+from sqlalchemy.engine import Engine
+
+from app.core.config import settings
+from app.models.worker import AgentOwner, Worker
+
+logger = logging.getLogger(__name__)
+
+
+class AgentRegistry(ABC):
+    """
+    Records which worker process owns each running agent.
+
+    Every uvicorn worker keeps its own ``active_agents`` dict; the registry is
+    the shared view used to decide whether a request should start an agent
+    locally or be forwarded to the worker that already runs it.
+    """
+
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    @abstractmethod
+    def register_worker(self, address: Optional[str]) -> None:
+        """
+        Announce this worker and the address other workers can forward to.
+
+        Agents still recorded for this worker id, left behind by an earlier
+        process with the same pid that did not shut down cleanly, are released.
+        """
+
+    @abstractmethod
+    def heartbeat(self) -> None:
+        """Mark this worker as alive."""
+
+    @abstractmethod
+    def unregister_worker(self) -> None:
+        """Remove this worker and release every agent it owns."""
+
+    @abstractmethod
+    def claim(self, agent_file_id: int) -> str:
+        """
+        Claim an agent for this worker.
+
+        Returns the id of the owning worker: this worker's id if the claim
+        succeeded, or the id of another live worker that already owns it.
+        """
+
+    @abstractmethod
+    def release(self, agent_file_id: int) -> None:
+        """Release an agent owned by this worker."""
+
+    @abstractmethod
+    def get_owner(self, agent_file_id: int) -> Optional[str]:
+        """Return the live worker owning an agent, if any."""
+
+    @abstractmethod
+    def get_address(self, worker_id: str) -> Optional[str]:
+        """Return the forwarding address of a worker."""
+
+    @abstractmethod
+    def owners(self) -> Dict[int, str]:
+        """Return a mapping of agent file ids to their owning workers."""
+
+    def is_local(self, worker_id: Optional[str]) -> bool:
+        return worker_id == self.worker_id
+
+
+class InProcessAgentRegistry(AgentRegistry):
+    """Registry for single-worker deployments, every agent is owned locally."""
+
+    def __init__(self):
+        super().__init__()
+        self._owners: Dict[int, str] = {}
+
+    def register_worker(self, address: Optional[str]) -> None:
+        pass
+
+    def heartbeat(self) -> None:
+        pass
+
+    def unregister_worker(self) -> None:
+        self._owners.clear()
+
+    def claim(self, agent_file_id: int) -> str:
+        self._owners[agent_file_id] = self.worker_id
+        return self.worker_id
+
+    def release(self, agent_file_id: int) -> None:
+        self._owners.pop(agent_file_id, None)
+
+    def get_owner(self, agent_file_id: int) -> Optional[str]:
+        return self._owners.get(agent_file_id)
+
+    def get_address(self, worker_id: str) -> Optional[str]:
+        return None
+
+    def owners(self) -> Dict[int, str]:
+        return dict(self._owners)
+
+
+class SQLiteAgentRegistry(AgentRegistry):
+    """
+    Registry shared by all workers on a host through a local SQLite file.
+
+    Workers heartbeat into the ``workers`` table; ownership held by a worker
+    that has not been seen for ``ttl`` seconds is considered stale and can be
+    claimed by another worker.
+    """
+
+    def __init__(self, path: str, ttl: int):
+        super().__init__()
+        self.path = Path(path)
+        self.ttl = ttl
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS workers ("
+                "worker_id TEXT PRIMARY KEY, address TEXT, last_seen REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS agent_owners ("
+                "agent_file_id INTEGER PRIMARY KEY, worker_id TEXT NOT NULL, claimed_at REAL NOT NULL)"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # Autocommit mode, transactions are opened explicitly where needed
+        conn = sqlite3.connect(str(self.path), timeout=5, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _live_owner(self, conn: sqlite3.Connection, agent_file_id: int) -> Optional[str]:
+        row = conn.execute(
+            "SELECT o.worker_id FROM agent_owners o JOIN workers w ON w.worker_id = o.worker_id "
+            "WHERE o.agent_file_id = ? AND w.last_seen >= ?",
+            (agent_file_id, time.time() - self.ttl),
+        ).fetchone()
+        return row[0] if row else None
+
+    def register_worker(self, address: Optional[str]) -> None:
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM agent_owners WHERE worker_id = ?", (self.worker_id,))
+            conn.execute(
+                "INSERT OR REPLACE INTO workers (worker_id, address, last_seen) VALUES (?, ?, ?)",
+                (self.worker_id, address, time.time()),
+            )
+            conn.execute("COMMIT")
+
+    def heartbeat(self) -> None:
+        with self._connect() as conn:
+            conn.execute("UPDATE workers SET last_seen = ? WHERE worker_id = ?", (time.time(), self.worker_id))
+            # Drop workers that stopped heartbeating long ago along with their agents
+            stale = time.time() - self.ttl * 10
+            conn.execute(
+                "DELETE FROM agent_owners WHERE worker_id IN (SELECT worker_id FROM workers WHERE last_seen < ?)",
+                (stale,),
+            )
+            conn.execute("DELETE FROM workers WHERE last_seen < ?", (stale,))
+
+    def unregister_worker(self) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM agent_owners WHERE worker_id = ?", (self.worker_id,))
+            conn.execute("DELETE FROM workers WHERE worker_id = ?", (self.worker_id,))
+
+    def claim(self, agent_file_id: int) -> str:
+        with self._connect() as conn:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                owner = self._live_owner(conn, agent_file_id)
+                if owner and owner != self.worker_id:
+                    conn.execute("ROLLBACK")
+                    return owner
+                conn.execute(
+                    "INSERT OR REPLACE INTO agent_owners (agent_file_id, worker_id, claimed_at) VALUES (?, ?, ?)",
+                    (agent_file_id, self.worker_id, time.time()),
+                )
+                conn.execute("COMMIT")
+                return self.worker_id
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+
+    def release(self, agent_file_id: int) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM agent_owners WHERE agent_file_id = ? AND worker_id = ?",
+                (agent_file_id, self.worker_id),
+            )
+
+    def get_owner(self, agent_file_id: int) -> Optional[str]:
+        with self._connect() as conn:
+            return self._live_owner(conn, agent_file_id)
+
+    def get_address(self, worker_id: str) -> Optional[str]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT address FROM workers WHERE worker_id = ?", (worker_id,)).fetchone()
+        return row[0] if row else None
+
+    def owners(self) -> Dict[int, str]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT o.agent_file_id, o.worker_id FROM agent_owners o JOIN workers w ON w.worker_id = o.worker_id "
+                "WHERE w.last_seen >= ?",
+                (time.time() - self.ttl,),
+            ).fetchall()
+        return {agent_file_id: worker_id for agent_file_id, worker_id in rows}
+
+
+class DatabaseAgentRegistry(AgentRegistry):
+    """
+    Registry shared by the workers of every host through the application database.
+
+    Same model as ``SQLiteAgentRegistry`` on the ``workers`` and
+    ``agent_owners`` tables; claims are a single upsert that only takes over
+    rows owned by this worker or by a worker past its ``ttl``, which keeps
+    them atomic on PostgreSQL without locking the table.
+    """
+
+    def __init__(self, engine: Engine, ttl: int):
+        super().__init__()
+        self.engine = engine
+        self.ttl = ttl
+        if engine.dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        elif engine.dialect.name == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            raise ValueError(f"The database agent registry does not support {engine.dialect.name}")
+        self._insert = insert
+
+    def _live_workers(self, cutoff: float):
+        return select(Worker.worker_id).where(Worker.last_seen >= cutoff)
+
+    def register_worker(self, address: Optional[str]) -> None:
+        statement = self._insert(Worker).values(worker_id=self.worker_id, address=address, last_seen=time.time())
+        statement = statement.on_conflict_do_update(
+            index_elements=[Worker.worker_id],
+            set_={"address": statement.excluded.address, "last_seen": statement.excluded.last_seen},
+        )
+        with self.engine.begin() as conn:
+            conn.execute(delete(AgentOwner).where(AgentOwner.worker_id == self.worker_id))
+            conn.execute(statement)
+
+    def heartbeat(self) -> None:
+        with self.engine.begin() as conn:
+            conn.execute(update(Worker).where(Worker.worker_id == self.worker_id).values(last_seen=time.time()))
+            # Drop workers that stopped heartbeating long ago along with their agents
+            stale = time.time() - self.ttl * 10
+            stale_workers = select(Worker.worker_id).where(Worker.last_seen < stale)
+            conn.execute(delete(AgentOwner).where(AgentOwner.worker_id.in_(stale_workers)))
+            conn.execute(delete(Worker).where(Worker.last_seen < stale))
+
+    def unregister_worker(self) -> None:
+        with self.engine.begin() as conn:
+            conn.execute(delete(AgentOwner).where(AgentOwner.worker_id == self.worker_id))
+            conn.execute(delete(Worker).where(Worker.worker_id == self.worker_id))
+
+    def claim(self, agent_file_id: int) -> str:
+        cutoff = time.time() - self.ttl
+        statement = self._insert(AgentOwner).values(
+            agent_file_id=agent_file_id, worker_id=self.worker_id, claimed_at=time.time()
+        )
+        # On conflict, the existing row is only replaced if its owner is this worker or is no longer alive
+        statement = statement.on_conflict_do_update(
+            index_elements=[AgentOwner.agent_file_id],
+            set_={"worker_id": statement.excluded.worker_id, "claimed_at": statement.excluded.claimed_at},
+            where=or_(
+                AgentOwner.worker_id == self.worker_id,
+                ~exists().where(Worker.worker_id == AgentOwner.worker_id, Worker.last_seen >= cutoff),
+            ),
+        ).returning(AgentOwner.worker_id)
+
+        with self.engine.begin() as conn:
+            if conn.execute(statement).first() is not None:
+                return self.worker_id
+            owner = conn.execute(
+                select(AgentOwner.worker_id).where(AgentOwner.agent_file_id == agent_file_id)
+            ).scalar()
+        return owner or self.worker_id
+
+    def release(self, agent_file_id: int) -> None:
+        with self.engine.begin() as conn:
+            conn.execute(
+                delete(AgentOwner).where(
+                    AgentOwner.agent_file_id == agent_file_id, AgentOwner.worker_id == self.worker_id
+                )
+            )
+
+    def get_owner(self, agent_file_id: int) -> Optional[str]:
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select(AgentOwner.worker_id).where(
+                    AgentOwner.agent_file_id == agent_file_id,
+                    AgentOwner.worker_id.in_(self._live_workers(time.time() - self.ttl)),
+                )
+            ).scalar()
+
+    def get_address(self, worker_id: str) -> Optional[str]:
+        with self.engine.connect() as conn:
+            return conn.execute(select(Worker.address).where(Worker.worker_id == worker_id)).scalar()
+
+    def owners(self) -> Dict[int, str]:
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(AgentOwner.agent_file_id, AgentOwner.worker_id).where(
+                    AgentOwner.worker_id.in_(self._live_workers(time.time() - self.ttl))
+                )
+            ).all()
+        return {agent_file_id: worker_id for agent_file_id, worker_id in rows}
+
+
+def get_agent_registry() -> AgentRegistry:
+    backend = settings.AGENT_REGISTRY_BACKEND
+    if backend == "memory":
+        return InProcessAgentRegistry()
+    if backend == "sqlite":
+        return SQLiteAgentRegistry(settings.AGENT_REGISTRY_PATH, settings.AGENT_REGISTRY_TTL)
+    if backend == "database":
+        from app.db.session import engine
+        return DatabaseAgentRegistry(engine, settings.AGENT_REGISTRY_TTL)
+    raise ValueError(f"Unknown agent registry backend: {backend}")
+
+
+class WorkerForwarder:
+    """
+    Forwards chat messages to the worker that owns an agent.
+
+    Each worker listens on a Unix socket under ``AGENT_REGISTRY_SOCKET_DIR``,
+    or on TCP (``AGENT_REGISTRY_FORWARD_BIND`` and ``AGENT_REGISTRY_FORWARD_PORT``)
+    when the registry spans hosts, and answers newline-delimited JSON requests
+    of the form ``{"agent_file_id": ..., "message": ..., "memory": ...}`` by
+    running the message on its local agent through ``handler``. Requests must
+    carry ``AGENT_REGISTRY_FORWARD_TOKEN`` as ``token`` when it is set, the TCP
+    listener does not start without it. Closing the connection before
+    the answer arrived cancels the run.
+    """
+
+    def __init__(self, registry: AgentRegistry, handler: Callable[[int, str, bool], Awaitable[str]]):
+        self.registry = registry
+        self.handler = handler
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._socket_path: Optional[Path] = None
+
+    async def start(self) -> None:
+        address = None
+        if isinstance(self.registry, SQLiteAgentRegistry) and hasattr(asyncio, "start_unix_server"):
+            socket_dir = Path(settings.AGENT_REGISTRY_SOCKET_DIR)
+            socket_dir.mkdir(parents=True, exist_ok=True)
+            self._socket_path = socket_dir / f"{os.getpid()}.sock"
+            if self._socket_path.exists():
+                self._socket_path.unlink()
+            self._server = await asyncio.start_unix_server(
+                self._handle, path=str(self._socket_path), limit=2 ** 26
+            )
+            address = str(self._socket_path)
+            logger.info(f"Worker {self.registry.worker_id} accepting forwarded messages on {address}")
+        elif isinstance(self.registry, DatabaseAgentRegistry):
+            if not settings.AGENT_REGISTRY_FORWARD_TOKEN:
+                # Anyone reaching the port could run prompts on the agents
+                raise RuntimeError(
+                    "AGENT_REGISTRY_FORWARD_TOKEN must be set to forward messages between hosts over TCP"
+                )
+            bind = settings.AGENT_REGISTRY_FORWARD_BIND
+            self._server = await asyncio.start_server(
+                self._handle, host=bind, port=settings.AGENT_REGISTRY_FORWARD_PORT, limit=2 ** 26
+            )
+            port = self._server.sockets[0].getsockname()[1]
+            host = settings.AGENT_REGISTRY_FORWARD_HOST
+            if not host:
+                host = socket.gethostname() if bind in ("", "0.0.0.0", "::") else bind
+            address = f"tcp://{host}:{port}"
+            logger.info(f"Worker {self.registry.worker_id} accepting forwarded messages on {address}")
+
+        await asyncio.to_thread(self.registry.register_worker, address)
+        self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self) -> None:
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._socket_path and self._socket_path.exists():
+            self._socket_path.unlink()
+        await asyncio.to_thread(self.registry.unregister_worker)
+
+    async def _heartbeat_loop(self) -> None:
+        while True:
+            await asyncio.sleep(settings.AGENT_REGISTRY_HEARTBEAT)
+            try:
+                await asyncio.to_thread(self.registry.heartbeat)
+            except Exception as e:
+                logger.error(f"Agent registry heartbeat failed: {e}")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            line = await reader.readline()
+            if not line:
+                return
+            request = json.loads(line)
+            token = settings.AGENT_REGISTRY_FORWARD_TOKEN
+            if token and not hmac.compare_digest(str(request.get("token", "")), token):
+                logger.warning("Rejected a forwarded message with an invalid token")
+                response = {"error": "Invalid forwarding token"}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+                return
+            handling = asyncio.create_task(
+                self.handler(request["agent_file_id"], request["message"], request.get("memory", True))
+            )
+            # The forwarding worker closes the connection when its client went away, stop the run then
+            closed = asyncio.create_task(reader.read(1))
+            try:
+                await asyncio.wait({handling, closed}, return_when=asyncio.FIRST_COMPLETED)
+                if not handling.done():
+                    logger.info(f"Forwarding worker went away, cancelling the run of agent {request['agent_file_id']}")
+                    return
+                response = {"message": handling.result()}
+            except Exception as e:
+                logger.error(f"Error handling forwarded message: {str(e)}", exc_info=True)
+                response = {"error": str(e)}
+            finally:
+                closed.cancel()
+                if not handling.done():
+                    handling.cancel()
+                    await asyncio.gather(handling, return_exceptions=True)
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def forward(self, worker_id: str, agent_file_id: int, message: str, memory: bool = True) -> str:
+        address = await asyncio.to_thread(self.registry.get_address, worker_id)
+        if not address:
+            raise RuntimeError(f"Worker {worker_id} does not accept forwarded messages")
+
+        if address.startswith("tcp://"):
+            host, port = address[len("tcp://"):].rsplit(":", 1)
+            reader, writer = await asyncio.open_connection(host, int(port), limit=2 ** 26)
+        else:
+            reader, writer = await asyncio.open_unix_connection(address, limit=2 ** 26)
+        request = {"agent_file_id": agent_file_id, "message": message, "memory": memory}
+        if settings.AGENT_REGISTRY_FORWARD_TOKEN:
+            request["token"] = settings.AGENT_REGISTRY_FORWARD_TOKEN
+        try:
+            writer.write(json.dumps(request).encode() + b"\n")
+            await writer.drain()
+            response = json.loads(await reader.readline())
+        finally:
+            writer.close()
+
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response["message"]
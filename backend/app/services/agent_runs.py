@@ -0,0 +1,206 @@
+import asyncio
+import inspect
+import logging
+import time
+import uuid
+from contextvars import ContextVar
+from typing import Awaitable, Dict, List, Optional
+
+from app.core.config import settings
+from app.core.loop_monitor import label_task
+from app.services.agent_usage import QuotaExceededError, agent_usage
+
+logger = logging.getLogger(__name__)
+
+# The run the current task works for, read by the agent executor and the MCP tools to count their work
+current_run: ContextVar[Optional["AgentRun"]] = ContextVar("current_run", default=None)
+
+
+class RunCancelledError(Exception):
+    """Raised when waiting for a run that was cancelled or exceeded its deadline."""
+
+    def __init__(self, report: dict):
+        super().__init__(
+            f"Run {report['status'].replace('_', ' ')} after {report['steps_executed']} steps"
+            + (f" ({report['reason']})" if report["reason"] else "")
+        )
+        self.report = report
+
+
+class AgentRun:
+    """
+    A prompt running on an agent in its own task, so it can be cancelled.
+
+    Cancelling the task propagates into the in-flight LLM request and MCP tool
+    calls. The counters record how much work finished and how much was in
+    flight when the run stopped.
+    """
+
+    def __init__(self, agent_file_id: int, source: str, deadline: Optional[float], session: Optional[str] = None):
+        self.run_id = uuid.uuid4().hex[:12]
+        self.agent_file_id = agent_file_id
+        self.source = source
+        self.session = session
+        self.deadline = deadline
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+        self.status = "running"
+        self.reason: Optional[str] = None
+        self.expired = False
+        self.steps_started = 0
+        self.steps_completed = 0
+        self.tool_calls_started = 0
+        self.tool_calls_completed = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # Set when the agent runs on another worker, which accounts for the run's usage
+        self.forwarded = False
+        self.task: Optional[asyncio.Task] = None
+
+    def cancel(self, reason: str) -> bool:
+        """Cancel the run, returns False if it already finished."""
+        if self.task is None or self.task.done():
+            return False
+        if self.reason is None:
+            self.reason = reason
+        return self.task.cancel()
+
+    def expire(self) -> None:
+        if self.cancel(f"deadline of {self.deadline:g} seconds exceeded"):
+            self.expired = True
+
+    async def wait(self) -> str:
+        """
+        Wait for the agent's response. Raises ``RunCancelledError`` if the run was
+        cancelled; cancelling the waiter does not cancel the run.
+        """
+        try:
+            return await asyncio.shield(self.task)
+        except asyncio.CancelledError:
+            if self.task.cancelled():
+                raise RunCancelledError(self.report())
+            raise
+
+    def report(self) -> dict:
+        end = self.finished if self.finished is not None else time.monotonic()
+        return {
+            "run_id": self.run_id,
+            "agent_file_id": self.agent_file_id,
+            "source": self.source,
+            "status": self.status,
+            "reason": self.reason,
+            "elapsed": round(end - self.started, 3),
+            "steps_executed": self.steps_completed,
+            "steps_abandoned": self.steps_started - self.steps_completed,
+            "tool_calls_executed": self.tool_calls_completed,
+            "tool_calls_abandoned": self.tool_calls_started - self.tool_calls_completed,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+        }
+
+
+class AgentRunManager:
+    """
+    Runs agent prompts as cancellable tasks with deadlines and keeps track of them.
+
+    Runs are cancelled when they exceed their deadline, when the client that
+    waits for them goes away or when it asks to cancel them. The agent work
+    finished and abandoned by cancelled runs is summed up in ``stats``, the
+    resources every run used are accounted in ``agent_usage``. Runs of agent
+    files over their token quota are rejected before they start when the
+    quota action is ``reject``.
+    """
+
+    def __init__(self, default_deadline: float = 0):
+        self.default_deadline = default_deadline
+        self._runs: Dict[str, AgentRun] = {}
+        self.counts = {"succeeded": 0, "failed": 0, "cancelled": 0, "deadline_exceeded": 0, "rejected": 0}
+        self.steps_executed = 0
+        self.steps_abandoned = 0
+        self.tool_calls_executed = 0
+        self.tool_calls_abandoned = 0
+
+    def start(self, agent_file_id: int, prompt_run: Awaitable[str], source: str,
+              deadline: Optional[float] = None, session: Optional[str] = None) -> AgentRun:
+        """
+        Start running ``prompt_run`` (e.g. ``agent.run(prompt)``) in a new task.
+        ``deadline`` is in seconds, None uses the default and 0 disables it.
+        ``session`` groups the run's usage, the source when not given.
+        """
+        if deadline is None:
+            deadline = self.default_deadline
+        run = AgentRun(agent_file_id, source, deadline or None, session)
+        self._runs[run.run_id] = run
+        run.task = asyncio.create_task(self._execute(run, prompt_run), name=f"agent-run:{run.run_id}")
+        run.task.add_done_callback(lambda task: self._finish(run, prompt_run))
+        return run
+
+    async def execute(self, agent_file_id: int, prompt_run: Awaitable[str], source: str,
+                      deadline: Optional[float] = None) -> str:
+        """Run a prompt and wait for it; cancelling the caller (e.g. a timeout) cancels the run."""
+        run = self.start(agent_file_id, prompt_run, source, deadline)
+        try:
+            return await run.wait()
+        except asyncio.CancelledError:
+            run.cancel("abandoned by the caller")
+            raise
+
+    @staticmethod
+    async def _execute(run: AgentRun, prompt_run: Awaitable[str]) -> str:
+        current_run.set(run)
+        label_task(agent=run.agent_file_id, run=run.run_id)
+        agent_usage.check_quota(run.agent_file_id)
+        deadline = None
+        if run.deadline:
+            deadline = asyncio.get_running_loop().call_later(run.deadline, run.expire)
+        try:
+            return await prompt_run
+        finally:
+            if deadline is not None:
+                deadline.cancel()
+
+    def _finish(self, run: AgentRun, prompt_run: Awaitable[str]) -> None:
+        if inspect.iscoroutine(prompt_run) and inspect.getcoroutinestate(prompt_run) == inspect.CORO_CREATED:
+            # Cancelled before the task got to start it
+            prompt_run.close()
+        if run.task.cancelled():
+            run.status = "deadline_exceeded" if run.expired else "cancelled"
+        elif isinstance(run.task.exception(), QuotaExceededError):
+            run.status = "rejected"
+        else:
+            run.status = "failed" if run.task.exception() is not None else "succeeded"
+        run.finished = time.monotonic()
+        self._runs.pop(run.run_id, None)
+        report = run.report()
+        self.counts[run.status] += 1
+        self.steps_executed += report["steps_executed"]
+        self.steps_abandoned += report["steps_abandoned"]
+        self.tool_calls_executed += report["tool_calls_executed"]
+        self.tool_calls_abandoned += report["tool_calls_abandoned"]
+        agent_usage.record_run(run)
+        if run.status in ("cancelled", "deadline_exceeded"):
+            logger.info(
+                f"Run {run.run_id} of agent {run.agent_file_id} {run.status.replace('_', ' ')} ({run.reason}): "
+                f"{report['steps_executed']} steps executed, {report['steps_abandoned']} abandoned, "
+                f"{report['tool_calls_abandoned']} tool calls abandoned"
+            )
+
+    def cancel_agent_runs(self, agent_file_id: int, reason: str) -> int:
+        """Cancel every run of an agent, e.g. when it is stopped."""
+        return sum(run.cancel(reason) for run in list(self._runs.values()) if run.agent_file_id == agent_file_id)
+
+    def active(self) -> List[dict]:
+        return [run.report() for run in self._runs.values()]
+
+    def stats(self) -> dict:
+        return {
+            "active": len(self._runs),
+            "runs": dict(self.counts),
+            "steps_executed": self.steps_executed,
+            "steps_abandoned": self.steps_abandoned,
+            "tool_calls_executed": self.tool_calls_executed,
+            "tool_calls_abandoned": self.tool_calls_abandoned,
+        }
+
+
+agent_runs = AgentRunManager(settings.AGENT_RUN_DEADLINE)
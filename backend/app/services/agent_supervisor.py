@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Optional, Set
+
+from app.db.session import SessionLocal
+from app.services.agent_registry import AgentRegistry
+from app.services.change_feed import ChangeFeed
+from app.services.mcp_agent_service import MCPAgentService
+
+if TYPE_CHECKING:
+    from mcp_use import MCPAgent
+
+logger = logging.getLogger(__name__)
+
+# Events after which the desired state may have changed
+_TRIGGER_EVENTS = {"agent.created", "agent.updated", "agent_file.deleted"}
+
+
+class AgentSupervisor:
+    """
+    Desired-state reconciler for running agents.
+
+    An agent file should be running when at least one of its agents is
+    ``is_active``. Each pass compares that desired state with the agents
+    running on this worker (or owned by another worker in the registry),
+    starts missing ones, most recently updated first, at most ``concurrency``
+    at a time, and stops local agents that are no longer wanted. Only agents
+    the supervisor started itself, or whose agents were active and no longer
+    are, are stopped: agents started on purpose (``POST /start``, a WebSocket,
+    a job or a fan-out) keep running. Failed starts are retried with
+    exponential backoff. Agents stopped by hand are suspended and left alone
+    until they are started again.
+
+    Passes run at startup, every ``interval`` seconds and whenever the change
+    feed reports an agent change.
+    """
+
+    def __init__(
+            self,
+            agents: Dict[int, "MCPAgent"],
+            registry: AgentRegistry,
+            feed: ChangeFeed,
+            start: Callable[[int, str], Awaitable[None]],
+            stop: Callable[[int], Awaitable[None]],
+            concurrency: int,
+            timeout: int,
+            interval: int,
+            max_backoff: int,
+    ):
+        self.agents = agents
+        self.registry = registry
+        self.feed = feed
+        self._start = start
+        self._stop = stop
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.interval = interval
+        self.max_backoff = max_backoff
+
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._starting: Dict[int, str] = {}
+        self._failures: Dict[int, dict] = {}
+        self._suspended: Set[int] = set()
+        # Agents this supervisor started, the only ones it stops when they are merely not wanted
+        self._managed: Set[int] = set()
+        self._desired: List[dict] = []
+        # Agents owned by any worker as of the last pass, read once per pass
+        self._owners: Dict[int, str] = {}
+        self._started_at: Optional[float] = None
+        self.converged_at: Optional[float] = None
+        self.passes = 0
+        self.started = 0
+        self.stopped = 0
+        self.last_pass_duration = 0.0
+
+    def _wanted(self) -> List[dict]:
+        return [
+            state for state in self._desired
+            if state["active"] and state["agent_file_id"] not in self._suspended
+        ]
+
+    def _is_running(self, agent_file_id: int) -> bool:
+        return agent_file_id in self.agents or agent_file_id in self._owners
+
+    def _load_desired_state(self) -> List[dict]:
+        with SessionLocal() as db:
+            return MCPAgentService(db).get_agent_file_states()
+
+    def _ready_to_retry(self, agent_file_id: int) -> bool:
+        failure = self._failures.get(agent_file_id)
+        return failure is None or time.monotonic() >= failure["retry_at"]
+
+    async def _start_one(self, state: dict, semaphore: asyncio.Semaphore) -> None:
+        agent_file_id = state["agent_file_id"]
+        async with semaphore:
+            if self._is_running(agent_file_id):
+                return
+            self._starting[agent_file_id] = state["name"]
+            started_at = time.perf_counter()
+            try:
+                await asyncio.wait_for(self._start(agent_file_id, state["name"]), timeout=self.timeout or None)
+            except (Exception, asyncio.TimeoutError) as e:
+                failure = self._failures.setdefault(agent_file_id, {"attempts": 0})
+                failure["attempts"] += 1
+                delay = min(self.interval * 2 ** (failure["attempts"] - 1), self.max_backoff)
+                error = str(e) or type(e).__name__
+                failure.update(error=error, retry_at=time.monotonic() + delay)
+                logger.error(f"Auto-start of agent {agent_file_id} failed, retrying in {delay}s: {error}")
+            else:
+                self._failures.pop(agent_file_id, None)
+                self._managed.add(agent_file_id)
+                self.started += 1
+                logger.info(f"Auto-started agent {agent_file_id} in {time.perf_counter() - started_at:.2f}s")
+            finally:
+                self._starting.pop(agent_file_id, None)
+
+    async def reconcile(self) -> None:
+        """Run a single pass bringing running agents in line with the desired state."""
+        pass_started = time.perf_counter()
+        previous = {state["agent_file_id"]: state["active"] for state in self._desired}
+        self._desired = await asyncio.to_thread(self._load_desired_state)
+        self._owners = await asyncio.to_thread(self.registry.owners)
+        current = {state["agent_file_id"]: state["active"] for state in self._desired}
+        wanted = {state["agent_file_id"] for state in self._wanted()}
+        self._managed &= set(self.agents) | set(self._starting)
+
+        # Stop the local agents this supervisor started that are no longer wanted, agents that were
+        # deactivated, and agents whose agent file is gone
+        unwanted = [
+            agent_file_id for agent_file_id in self.agents
+            if agent_file_id not in wanted and (
+                agent_file_id in self._managed
+                or agent_file_id not in current
+                or (previous.get(agent_file_id) and not current[agent_file_id])
+            )
+        ]
+        for agent_file_id in unwanted:
+            logger.info(f"Stopping agent {agent_file_id}, none of its agents is active")
+            try:
+                await self._stop(agent_file_id)
+                self.stopped += 1
+            except Exception as e:
+                logger.error(f"Failed to stop agent {agent_file_id}: {str(e)}", exc_info=True)
+            self._managed.discard(agent_file_id)
+        for agent_file_id in list(self._failures):
+            if agent_file_id not in wanted:
+                del self._failures[agent_file_id]
+
+        pending = [
+            state for state in self._wanted()
+            if not self._is_running(state["agent_file_id"])
+            and self._ready_to_retry(state["agent_file_id"])
+        ]
+        # Recently changed agents are the ones most likely to be used first
+        pending.sort(key=lambda state: state["updated_at"] or datetime.min, reverse=True)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*(self._start_one(state, semaphore) for state in pending))
+
+        self.passes += 1
+        self.last_pass_duration = time.perf_counter() - pass_started
+        if self.converged_at is None and self.status()["converged"]:
+            self.converged_at = time.monotonic()
+            logger.info(f"Agents converged in {self.converged_at - self._started_at:.2f}s")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error(f"Agent reconciliation pass failed: {str(e)}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _watch(self) -> None:
+        async for event in self.feed.subscribe():
+            if event["event"] in _TRIGGER_EVENTS:
+                self._wakeup.set()
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._started_at = time.monotonic()
+            self._tasks = [asyncio.create_task(self._run()), asyncio.create_task(self._watch())]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def suspend(self, agent_file_id: int) -> None:
+        """Keep an agent that was stopped by hand from being started again."""
+        self._suspended.add(agent_file_id)
+
+    def resume(self, agent_file_id: int) -> None:
+        """Called before an agent is started on purpose, which the supervisor then leaves running."""
+        self._suspended.discard(agent_file_id)
+        self._managed.discard(agent_file_id)
+
+    def status(self) -> dict:
+        wanted = self._wanted()
+        running = [
+            state["agent_file_id"] for state in wanted
+            if self._is_running(state["agent_file_id"]) and state["agent_file_id"] not in self._starting
+        ]
+        now = time.monotonic()
+        return {
+            "converged": bool(self.passes) and len(running) == len(wanted),
+            "desired": len(wanted),
+            "running": len(running),
+            "starting": sorted(self._starting),
+            "pending": sorted(
+                state["agent_file_id"] for state in wanted
+                if state["agent_file_id"] not in running and state["agent_file_id"] not in self._starting
+            ),
+            "failed": {
+                agent_file_id: {
+                    "attempts": failure["attempts"],
+                    "error": failure["error"],
+                    "retry_in_seconds": max(0.0, failure["retry_at"] - now)
+                }
+                for agent_file_id, failure in self._failures.items()
+            },
+            "suspended": sorted(self._suspended),
+            "passes": self.passes,
+            "started": self.started,
+            "stopped": self.stopped,
+            "last_pass_duration_seconds": self.last_pass_duration,
+            "time_to_converge_seconds": (
+                self.converged_at - self._started_at if self.converged_at is not None else None
+            ),
+        }
@@ -0,0 +1,443 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Set, Tuple
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import case, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.core.config import settings
+from app.db.session import SessionLocal, engine
+from app.models.agent_file import AgentFile
+from app.models.agent_usage import AgentUsageDay
+
+if TYPE_CHECKING:
+    from app.services.agent_runs import AgentRun
+
+logger = logging.getLogger(__name__)
+
+# Set in the environment of every MCP server process, so the process and its children can be told apart
+SERVER_MARKER_ENV = "MCP_AGENT_SERVER_ID"
+
+# Counters of runs, kept per agent file and per session
+RUN_COUNTERS = ("runs", "rejected_runs", "steps", "prompt_tokens", "completion_tokens", "wall_seconds")
+# Counters summed into the daily rollups, which also keep the peak RSS of the MCP servers
+COUNTERS = RUN_COUNTERS + ("mcp_cpu_seconds",)
+
+QUOTA_ACTIONS = ("reject", "deprioritize")
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+_PAGE_KB = os.sysconf("SC_PAGE_SIZE") // 1024 if hasattr(os, "sysconf") else 4
+
+
+class QuotaExceededError(Exception):
+    """Raised when a run is refused because its agent file used up its daily token quota."""
+
+    # Retrying a job before the quota resets fails the same way
+    retryable = False
+
+
+def _today() -> date:
+    return datetime.now(timezone.utc).date()
+
+
+def _usage() -> Dict[str, float]:
+    return {**dict.fromkeys(COUNTERS, 0), "mcp_peak_rss_kb": 0}
+
+
+def _read_process(pid: int) -> Optional[Tuple[int, int, float, int]]:
+    """Parent pid, start time (ticks after boot), CPU seconds and RSS in KB of a process, from /proc."""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as file:
+            stat = file.read()
+    except OSError:
+        return None
+    # The command name may contain spaces and parentheses, the fields after it do not
+    fields = stat[stat.rindex(")") + 2:].split()
+    cpu = (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+    return int(fields[1]), int(fields[19]), cpu, int(fields[21]) * _PAGE_KB
+
+
+def _read_marker(pid: int) -> Optional[str]:
+    prefix = f"{SERVER_MARKER_ENV}=".encode()
+    try:
+        with open(f"/proc/{pid}/environ", "rb") as file:
+            environ = file.read()
+    except OSError:
+        return None
+    for variable in environ.split(b"\0"):
+        if variable.startswith(prefix):
+            return variable[len(prefix):].decode()
+    return None
+
+
+def server_processes() -> Dict[str, List[Tuple[int, int, float, int]]]:
+    """
+    Descendants of this worker that run an MCP server, by marker: pid, start
+    time, CPU seconds and RSS in KB. Blocking, and empty where there is no /proc.
+    """
+    if not os.path.isdir("/proc"):
+        return {}
+    processes = {}
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            process = _read_process(int(name))
+            if process is not None:
+                processes[int(name)] = process
+    children: Dict[int, List[int]] = {}
+    for pid, process in processes.items():
+        children.setdefault(process[0], []).append(pid)
+
+    found: Dict[str, List[Tuple[int, int, float, int]]] = {}
+    pending = list(children.get(os.getpid(), []))
+    while pending:
+        pid = pending.pop()
+        pending.extend(children.get(pid, []))
+        # Children of a server (e.g. node under npx) inherit the marker
+        marker = _read_marker(pid)
+        if marker is not None:
+            found.setdefault(marker, []).append((pid, *processes[pid][1:]))
+    return found
+
+
+@lru_cache(maxsize=None)
+def _token_usage_hook() -> Tuple[type, ContextVar]:
+    """
+    The ``RunTokenUsage`` callback handler and the context variable that hands
+    it to every LLM call made while it is set (the executor is built by
+    mcp_use). Built on first use, LangChain is only loaded once an agent starts.
+    """
+    from langchain_core.callbacks import BaseCallbackHandler
+    from langchain_core.tracers.context import register_configure_hook
+
+    class RunTokenUsage(BaseCallbackHandler):
+        """
+        Adds the tokens of every LLM call to the agent run. Unlike langchain's
+        usage callback it does not need the model to report its name.
+        """
+
+        def __init__(self, run: "AgentRun"):
+            self.run = run
+
+        def on_llm_end(self, response, **kwargs) -> None:
+            generations = response.generations[0] if response.generations else []
+            usage = getattr(getattr(generations[0], "message", None), "usage_metadata", None) if generations else None
+            if usage:
+                self.run.prompt_tokens += usage.get("input_tokens", 0)
+                self.run.completion_tokens += usage.get("output_tokens", 0)
+
+    token_usage: ContextVar[Optional[RunTokenUsage]] = ContextVar("run_token_usage", default=None)
+    register_configure_hook(token_usage, inheritable=True)
+    return RunTokenUsage, token_usage
+
+
+@contextmanager
+def counting_tokens(run: Optional["AgentRun"]) -> Iterator[None]:
+    """Add the tokens of the LLM calls made in the block to ``run``, if there is one."""
+    if run is None:
+        yield
+        return
+    handler_class, token_usage = _token_usage_hook()
+    token = token_usage.set(handler_class(run))
+    try:
+        yield
+    finally:
+        token_usage.reset(token)
+
+
+@lru_cache(maxsize=None)
+def _insert():
+    """The upsert construct of the database's dialect; the rollups need ON CONFLICT."""
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif engine.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise ValueError(f"Usage rollups do not support {engine.dialect.name}")
+    return insert
+
+
+class AgentUsage:
+    """
+    Accounts the resources every agent file uses on this worker.
+
+    Finished runs add their LLM prompt and completion tokens, wall time and
+    steps to their agent file and to their session (a WebSocket connection, or
+    the source of the run for jobs, fan-out and forwarded messages). A sampler
+    reads the CPU time and RSS of the MCP server processes of running agents
+    from ``/proc`` every ``sample_interval`` seconds; the servers are found by
+    the marker in their environment. CPU a server uses after its last sample
+    before it exits is not counted.
+
+    Usage is summed per agent file and UTC day into ``agent_usage_daily``
+    every ``flush_interval`` seconds, adding up the usage of all workers. The
+    daily totals read back on every flush decide whether an agent file is over
+    its token quota: with the ``reject`` action its runs are refused, with
+    ``deprioritize`` its queued jobs only start when no other job is waiting.
+    """
+
+    def __init__(self, token_quota: int, quota_overrides: Dict[int, int], quota_action: str,
+                 sample_interval: int, flush_interval: int, max_sessions: int = 1000):
+        if quota_action not in QUOTA_ACTIONS:
+            raise ValueError(f"Unknown quota action '{quota_action}', use one of {', '.join(QUOTA_ACTIONS)}")
+        self.token_quota = token_quota
+        self.quota_overrides = quota_overrides
+        self.quota_action = quota_action
+        self.sample_interval = sample_interval
+        self.flush_interval = flush_interval
+        self.max_sessions = max_sessions
+        self.agents: Dict[int, object] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._totals: Dict[int, Dict[str, float]] = {}
+        self._sessions: OrderedDict[Tuple[int, str], Dict[str, float]] = OrderedDict()
+        self._pending: Dict[Tuple[int, date], Dict[str, float]] = {}
+        self._tokens_today: Tuple[Optional[date], Dict[int, int]] = (None, {})
+        self._markers: WeakKeyDictionary = WeakKeyDictionary()
+        self._cpu_seen: Dict[int, Tuple[int, float]] = {}
+        self._processes: Dict[int, Dict[str, int]] = {}
+        self._last_flush = time.monotonic()
+        self.flush_failures = 0
+
+    # MCP server processes
+
+    def mark_server_config(self, server_config: dict) -> Tuple[dict, Optional[str]]:
+        """Return a stdio server config that sets a new marker in the server's environment, and the marker."""
+        if "command" not in server_config:
+            return server_config, None
+        marker = os.urandom(8).hex()
+        return {**server_config, "env": {**(server_config.get("env") or {}), SERVER_MARKER_ENV: marker}}, marker
+
+    def register_server(self, connector, marker: Optional[str]) -> None:
+        if marker is not None:
+            self._markers[connector] = marker
+
+    def _running_markers(self) -> Dict[str, int]:
+        markers = {}
+        for agent_file_id, agent in list(self.agents.items()):
+            client = getattr(agent, "client", None)
+            for session in list(getattr(client, "sessions", {}).values()):
+                marker = self._markers.get(session.connector)
+                if marker is not None:
+                    markers[marker] = agent_file_id
+        return markers
+
+    async def sample(self) -> None:
+        """Add the CPU time the MCP servers of running agents used since the last sample, and their RSS."""
+        markers = self._running_markers()
+        found = await asyncio.to_thread(server_processes) if markers else {}
+        seen: Dict[int, Tuple[int, float]] = {}
+        processes: Dict[int, Dict[str, int]] = {}
+        for marker, agent_file_id in markers.items():
+            for pid, started, cpu, rss_kb in found.get(marker, []):
+                previous = self._cpu_seen.get(pid)
+                # A pid seen with another start time was reused, its CPU time starts over
+                used = cpu - previous[1] if previous and previous[0] == started else cpu
+                seen[pid] = (started, cpu)
+                current = processes.setdefault(agent_file_id, {"processes": 0, "rss_kb": 0, "cpu_seconds": 0.0})
+                current["processes"] += 1
+                current["rss_kb"] += rss_kb
+                current["cpu_seconds"] += used
+        self._cpu_seen = seen
+        self._processes = {
+            agent_file_id: {"processes": current["processes"], "rss_kb": current["rss_kb"]}
+            for agent_file_id, current in processes.items()
+        }
+        for agent_file_id, current in processes.items():
+            self._add(agent_file_id, mcp_cpu_seconds=current["cpu_seconds"], mcp_peak_rss_kb=current["rss_kb"])
+
+    # Runs
+
+    def _add(self, agent_file_id: int, session: Optional[str] = None, **values: float) -> None:
+        peak = values.pop("mcp_peak_rss_kb", None)
+        targets = [
+            self._totals.setdefault(agent_file_id, _usage()),
+            self._pending.setdefault((agent_file_id, _today()), _usage()),
+        ]
+        if session is not None:
+            # Sessions only see runs, the MCP servers are shared by all sessions of an agent
+            key = (agent_file_id, session)
+            targets.append(self._sessions.setdefault(key, dict.fromkeys(RUN_COUNTERS, 0)))
+            self._sessions.move_to_end(key)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        for target in targets:
+            for name, value in values.items():
+                target[name] += value
+            if peak is not None:
+                target["mcp_peak_rss_kb"] = max(target["mcp_peak_rss_kb"], peak)
+
+    def record_run(self, run: "AgentRun") -> None:
+        if run.forwarded:
+            # The worker owning the agent accounts for the work
+            return
+        if run.status == "rejected":
+            self._add(run.agent_file_id, run.session or run.source, rejected_runs=1)
+            return
+        self._add(
+            run.agent_file_id,
+            run.session or run.source,
+            runs=1,
+            steps=run.steps_completed,
+            prompt_tokens=run.prompt_tokens,
+            completion_tokens=run.completion_tokens,
+            wall_seconds=(run.finished or time.monotonic()) - run.started,
+        )
+
+    # Quotas
+
+    def quota_for(self, agent_file_id: int) -> int:
+        return self.quota_overrides.get(agent_file_id, self.token_quota)
+
+    def tokens_today(self, agent_file_id: int) -> int:
+        day = _today()
+        stored = self._tokens_today[1].get(agent_file_id, 0) if self._tokens_today[0] == day else 0
+        pending = self._pending.get((agent_file_id, day))
+        if pending is not None:
+            stored += pending["prompt_tokens"] + pending["completion_tokens"]
+        return int(stored)
+
+    def over_quota(self, agent_file_id: int) -> bool:
+        quota = self.quota_for(agent_file_id)
+        return bool(quota) and self.tokens_today(agent_file_id) >= quota
+
+    def check_quota(self, agent_file_id: int) -> None:
+        """Raise ``QuotaExceededError`` if runs of the agent file are refused, it is over its quota."""
+        if self.quota_action == "reject" and self.over_quota(agent_file_id):
+            raise QuotaExceededError(
+                f"Agent file {agent_file_id} used its daily quota of {self.quota_for(agent_file_id)} tokens"
+            )
+
+    def deprioritized_agents(self) -> Set[int]:
+        """Agent files whose queued jobs wait for the others, the ones over quota with the deprioritize action."""
+        if self.quota_action != "deprioritize":
+            return set()
+        known = set(self._tokens_today[1]) | {agent_file_id for agent_file_id, _ in self._pending}
+        return {agent_file_id for agent_file_id in known if self.over_quota(agent_file_id)}
+
+    # Daily rollups
+
+    def _write(self, pending: Dict[Tuple[int, date], Dict[str, float]]) -> Dict[int, int]:
+        """Add usage to the daily rollups and return today's tokens per agent file. Blocking."""
+        insert = _insert()
+        today = _today()
+        with SessionLocal() as db:
+            # Usage of deleted agent files is dropped
+            existing = set(db.scalars(
+                select(AgentFile.id).where(AgentFile.id.in_({agent_file_id for agent_file_id, _ in pending}))
+            )) if pending else set()
+            for (agent_file_id, day), values in pending.items():
+                if agent_file_id not in existing:
+                    continue
+                values = {**values, "mcp_peak_rss_kb": int(values["mcp_peak_rss_kb"])}
+                statement = insert(AgentUsageDay).values(agent_file_id=agent_file_id, day=day, **values)
+                updates = {name: getattr(AgentUsageDay, name) + getattr(statement.excluded, name) for name in COUNTERS}
+                updates["mcp_peak_rss_kb"] = case(
+                    (statement.excluded.mcp_peak_rss_kb > AgentUsageDay.mcp_peak_rss_kb, statement.excluded.mcp_peak_rss_kb),
+                    else_=AgentUsageDay.mcp_peak_rss_kb,
+                )
+                db.execute(statement.on_conflict_do_update(
+                    index_elements=[AgentUsageDay.agent_file_id, AgentUsageDay.day], set_=updates
+                ))
+            db.commit()
+            return dict(db.execute(
+                select(AgentUsageDay.agent_file_id, AgentUsageDay.prompt_tokens + AgentUsageDay.completion_tokens)
+                .where(AgentUsageDay.day == today)
+            ).all())
+
+    async def flush(self) -> None:
+        pending, self._pending = self._pending, {}
+        day = _today()
+        try:
+            self._tokens_today = (day, await asyncio.to_thread(self._write, pending))
+        except SQLAlchemyError as e:
+            # Keep the usage for the next flush
+            self.flush_failures += 1
+            logger.error(f"Could not write the usage rollups: {e}")
+            for key, values in pending.items():
+                target = self._pending.setdefault(key, _usage())
+                for name in COUNTERS:
+                    target[name] += values[name]
+                target["mcp_peak_rss_kb"] = max(target["mcp_peak_rss_kb"], values["mcp_peak_rss_kb"])
+        self._last_flush = time.monotonic()
+
+    def daily(self, agent_file_id: Optional[int], days: int) -> List[dict]:
+        """Daily rollups of the last ``days`` days, newest first. Blocking."""
+        with SessionLocal() as db:
+            query = db.query(AgentUsageDay).filter(AgentUsageDay.day > _today() - timedelta(days=days))
+            if agent_file_id is not None:
+                query = query.filter(AgentUsageDay.agent_file_id == agent_file_id)
+            return [row.to_dict() for row in query.order_by(AgentUsageDay.day.desc(), AgentUsageDay.agent_file_id)]
+
+    # Lifecycle
+
+    def start(self, agents: Dict[int, object]) -> None:
+        # Refuse an unsupported database at startup rather than failing every flush
+        _insert()
+        self.agents = agents
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        # Today's totals of other workers count towards the quotas from the start
+        await self.flush()
+        interval = min(filter(None, (self.sample_interval, self.flush_interval)), default=60)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if self.sample_interval:
+                    await self.sample()
+                if time.monotonic() - self._last_flush >= self.flush_interval:
+                    await self.flush()
+            except Exception as e:
+                logger.error(f"Usage accounting failed: {str(e)}", exc_info=True)
+
+    def stats(self, agent_file_id: Optional[int] = None) -> dict:
+        agent_file_ids = set(self._totals) | set(self._processes) | set(self.agents)
+        if agent_file_id is not None:
+            agent_file_ids &= {agent_file_id}
+        agents = {}
+        for current in sorted(agent_file_ids):
+            totals = self._totals.get(current, _usage())
+            agents[current] = {
+                **{name: round(value, 3) if isinstance(value, float) else value for name, value in totals.items()},
+                "mcp_processes": self._processes.get(current, {}).get("processes", 0),
+                "mcp_rss_kb": self._processes.get(current, {}).get("rss_kb", 0),
+                "tokens_today": self.tokens_today(current),
+                "token_quota": self.quota_for(current) or None,
+                "over_quota": self.over_quota(current),
+            }
+        sessions = [
+            {"agent_file_id": key[0], "session": key[1],
+             **{name: round(value, 3) if isinstance(value, float) else value for name, value in values.items()}}
+            for key, values in reversed(self._sessions.items())
+            if agent_file_id is None or key[0] == agent_file_id
+        ]
+        return {
+            "quota_action": self.quota_action,
+            "flush_failures": self.flush_failures,
+            "agents": agents,
+            "sessions": sessions[:100],
+        }
+
+
+agent_usage = AgentUsage(
+    settings.USAGE_DAILY_TOKEN_QUOTA,
+    settings.USAGE_TOKEN_QUOTA_OVERRIDES,
+    settings.USAGE_QUOTA_ACTION,
+    sample_interval=settings.USAGE_SAMPLE_INTERVAL,
+    flush_interval=settings.USAGE_FLUSH_INTERVAL,
+)
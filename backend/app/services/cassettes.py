@@ -0,0 +1,534 @@
+"""
+Record and replay the LLM and MCP traffic of agents.
+
+With ``CASSETTE_MODE=record`` every agent writes a cassette to
+``CASSETTE_DIR/<agent file>.json``: its runs, every LLM call and every MCP
+JSON-RPC request with its response and how long it took. With
+``CASSETTE_MODE=replay`` agents answer from their cassette instead: the LLM
+calls and the MCP servers are served from the recorded responses after the
+recorded latency times ``CASSETTE_TIME_SCALE``, without a network, an API key
+or a server process. Replay the recorded runs of a cassette outside the
+application, e.g. to compare the orchestration overhead of two revisions:
+
+    python -m app.services.cassettes cassettes/<agent file>.json [--time-scale 0] [--rounds 3]
+
+With ``--time-scale 0`` every response is served right away, so the time
+measured is the time spent in the agent itself.
+
+The executor of agent runs lives here too: it is what a replay measures, and
+it counts the steps of every run.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import deque
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, Optional, Set
+
+import anyio
+from langchain.agents import AgentExecutor
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, ChatResult
+from mcp import ClientSession
+from mcp.shared.exceptions import McpError
+from mcp.shared.message import SessionMessage
+from mcp.types import INVALID_REQUEST, ErrorData, JSONRPCError, JSONRPCMessage, JSONRPCRequest, JSONRPCResponse
+from mcp_use.connectors.base import BaseConnector
+from pydantic import PrivateAttr
+
+from app.core.config import settings
+from app.services.agent_runs import current_run
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_MODES = ("record", "replay")
+
+
+def _hash(value: Any) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def _llm_key(messages) -> str:
+    # Message ids are generated per run, the content is what the model answers to
+    return _hash([
+        [message.type, message.content, getattr(message, "tool_calls", None), getattr(message, "tool_call_id", None)]
+        for message in messages
+    ])
+
+
+def _mcp_key(request: dict) -> str:
+    return f"{request['method']}:{_hash(request.get('params'))}"
+
+
+class _Track:
+    """
+    Recorded exchanges, each served once: the next one recorded for the same
+    request, else the next one of the same kind (e.g. an MCP method), so small
+    differences such as generated ids do not end a replay.
+    """
+
+    def __init__(self, entries: List[dict], kind: Callable[[dict], str]):
+        self.entries = entries
+        self._by_key: Dict[str, Deque[int]] = {}
+        self._by_kind: Dict[str, Deque[int]] = {}
+        for index, entry in enumerate(entries):
+            self._by_key.setdefault(entry["key"], deque()).append(index)
+            self._by_kind.setdefault(kind(entry), deque()).append(index)
+        self._used: Set[int] = set()
+        self.matched = 0
+        self.unmatched = 0
+        self.missing = 0
+
+    def take(self, key: str, kind: str) -> Optional[dict]:
+        for queue, exact in ((self._by_key.get(key), True), (self._by_kind.get(kind), False)):
+            while queue and queue[0] in self._used:
+                queue.popleft()
+            if queue:
+                index = queue.popleft()
+                self._used.add(index)
+                if exact:
+                    self.matched += 1
+                else:
+                    self.unmatched += 1
+                return self.entries[index]
+        self.missing += 1
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "recorded": len(self.entries),
+            "matched": self.matched,
+            "unmatched": self.unmatched,
+            "missing": self.missing,
+        }
+
+
+class Cassette:
+    """
+    The recorded runs, LLM calls and MCP requests per server of an agent.
+
+    Recording cassettes are written after every run, to a temporary file first
+    so a crash never leaves a torn cassette. Replaying cassettes are read once
+    and serve every recorded response once.
+    """
+
+    def __init__(self, path: str, mode: str, time_scale: float = 1.0):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"Unknown cassette mode '{mode}', use one of {', '.join(CASSETTE_MODES)}")
+        self.path = path
+        self.mode = mode
+        self.time_scale = time_scale
+        self.recorded_at = datetime.now(timezone.utc).isoformat()
+        self.runs: List[dict] = []
+        self.llm: List[dict] = []
+        self.mcp: Dict[str, List[dict]] = {}
+        self._llm_track: Optional[_Track] = None
+        self._mcp_tracks: Dict[str, _Track] = {}
+        self._writing = asyncio.Lock()
+        if mode == "replay":
+            self._load()
+
+    @property
+    def recording(self) -> bool:
+        return self.mode == "record"
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+
+    def _load(self) -> None:
+        with open(self.path, "r") as file:
+            data = json.load(file)
+        self.recorded_at = data["recorded_at"]
+        self.runs = data["runs"]
+        self.llm = data["llm"]
+        self.mcp = data["mcp"]
+        self._llm_track = _Track(self.llm, lambda entry: "llm")
+        self._mcp_tracks = {
+            server_name: _Track(entries, lambda entry: entry["request"]["method"])
+            for server_name, entries in self.mcp.items()
+        }
+
+    # Recording
+
+    def record_llm(self, messages, seconds: float, result: ChatResult) -> None:
+        self.llm.append({
+            "key": _llm_key(messages),
+            "seconds": round(seconds, 4),
+            "generations": [
+                {"message": message_to_dict(generation.message), "generation_info": generation.generation_info}
+                for generation in result.generations
+            ],
+            "llm_output": result.llm_output,
+        })
+
+    def record_mcp(self, server_name: str, request: dict, seconds: float,
+                   result: Optional[dict] = None, error: Optional[dict] = None) -> None:
+        entry = {"key": _mcp_key(request), "seconds": round(seconds, 4), "request": request}
+        if error is not None:
+            entry["error"] = error
+        else:
+            entry["result"] = result
+        self.mcp.setdefault(server_name, []).append(entry)
+
+    async def record_run(self, query: str, response: str, seconds: float) -> None:
+        self.runs.append({"query": query, "response": response, "seconds": round(seconds, 4)})
+        async with self._writing:
+            await asyncio.to_thread(self._write, self.to_dict())
+
+    def to_dict(self) -> dict:
+        # Copies, so the cassette can be written in a thread while the agent keeps recording
+        return {
+            "recorded_at": self.recorded_at,
+            "runs": list(self.runs),
+            "llm": list(self.llm),
+            "mcp": {server_name: list(entries) for server_name, entries in self.mcp.items()},
+        }
+
+    def _write(self, data: dict) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(data, file, default=str)
+        os.replace(tmp_path, self.path)
+
+    def chat_model(self, llm: Optional[BaseChatModel] = None) -> "CassetteChatModel":
+        """A model recording the calls of ``llm``, or answering them when replaying."""
+        return CassetteChatModel(cassette=self, llm=llm)
+
+    # Replay
+
+    def take_llm(self, messages) -> Optional[dict]:
+        return self._llm_track.take(_llm_key(messages), "llm")
+
+    def take_mcp(self, server_name: str, request: dict) -> Optional[dict]:
+        track = self._mcp_tracks.get(server_name)
+        if track is None:
+            track = self._mcp_tracks[server_name] = _Track([], lambda entry: "")
+        return track.take(_mcp_key(request), request["method"])
+
+    async def delay(self, seconds: float) -> None:
+        """Wait the recorded latency of a response, scaled."""
+        if self.time_scale > 0:
+            await asyncio.sleep(seconds * self.time_scale)
+
+    def stats(self) -> dict:
+        stats = {"path": self.path, "mode": self.mode, "runs": len(self.runs)}
+        if self.replaying:
+            stats["time_scale"] = self.time_scale
+            stats["llm"] = self._llm_track.stats()
+            stats["mcp"] = {server_name: track.stats() for server_name, track in self._mcp_tracks.items()}
+        else:
+            stats["llm"] = {"recorded": len(self.llm)}
+            stats["mcp"] = {server_name: {"recorded": len(entries)} for server_name, entries in self.mcp.items()}
+        return stats
+
+
+class CassetteChatModel(BaseChatModel):
+    """
+    Records the calls of ``llm`` into the cassette, or answers them from the
+    cassette when it replays, in which case no ``llm`` is needed.
+    """
+
+    cassette: Any
+    llm: Optional[BaseChatModel] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "cassette"
+
+    def bind_tools(self, tools: Any, **kwargs: Any):
+        if self.llm is None:
+            # The recorded responses already carry the tool calls
+            return self
+        # Keep the provider's tool format, the calls still go through this model
+        return self.bind(**getattr(self.llm.bind_tools(tools, **kwargs), "kwargs", {}))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        raise NotImplementedError("Cassettes record and replay asynchronous LLM calls only")
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if self.cassette.recording:
+            started = time.perf_counter()
+            result = await self.llm._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            self.cassette.record_llm(messages, time.perf_counter() - started, result)
+            return result
+
+        entry = self.cassette.take_llm(messages)
+        if entry is None:
+            raise RuntimeError(f"No recorded LLM response left in {self.cassette.path}")
+        await self.cassette.delay(entry["seconds"])
+        return ChatResult(
+            generations=[
+                ChatGeneration(
+                    message=messages_from_dict([generation["message"]])[0],
+                    generation_info=generation["generation_info"],
+                )
+                for generation in entry["generations"]
+            ],
+            llm_output=entry["llm_output"],
+        )
+
+
+def _dump(model) -> dict:
+    return model.model_dump(by_alias=True, mode="json", exclude_none=True)
+
+
+class RecordingConnector(BaseConnector):
+    """Connects through ``connector`` and records every request the client sends, with its response."""
+
+    def __init__(self, connector: BaseConnector, cassette: Cassette, server_name: str):
+        super().__init__()
+        self.connector = connector
+        self.cassette = cassette
+        self.server_name = server_name
+
+    async def connect(self) -> None:
+        if self._connected:
+            return
+        await self.connector.connect()
+        self.client = self.connector.client
+        send_request = self.client.send_request
+
+        async def recorded_request(request, result_type, *args, **kwargs):
+            payload = _dump(request)
+            started = time.perf_counter()
+            try:
+                result = await send_request(request, result_type, *args, **kwargs)
+            except McpError as e:
+                self.cassette.record_mcp(self.server_name, payload, time.perf_counter() - started, error=_dump(e.error))
+                raise
+            self.cassette.record_mcp(self.server_name, payload, time.perf_counter() - started, result=_dump(result))
+            return result
+
+        # ClientSession sends every request (initialize, list_tools, call_tool) through send_request
+        self.client.send_request = recorded_request
+        self._connected = True
+
+    async def disconnect(self) -> None:
+        if not self._connected:
+            return
+        self.client = None
+        self._tools = None
+        await self.connector.disconnect()
+        self._connected = False
+
+
+class ReplayConnector(BaseConnector):
+    """
+    Stands in for an MCP server: a ClientSession talks JSON-RPC over memory
+    streams to a task that answers every request with the recorded response.
+    Requests nothing was recorded for get a JSON-RPC error.
+    """
+
+    def __init__(self, cassette: Cassette, server_name: str):
+        super().__init__()
+        self.cassette = cassette
+        self.server_name = server_name
+        self._streams: List[Any] = []
+        self._server: Optional[asyncio.Task] = None
+        self._answering: Set[asyncio.Task] = set()
+
+    async def connect(self) -> None:
+        if self._connected:
+            return
+        to_server, requests = anyio.create_memory_object_stream(0)
+        responses, from_server = anyio.create_memory_object_stream(0)
+        self._streams = [to_server, requests, responses, from_server]
+        self._server = asyncio.create_task(self._serve(requests, responses), name=f"mcp-replay:{self.server_name}")
+        self.client = ClientSession(from_server, to_server)
+        await self.client.__aenter__()
+        self._connected = True
+
+    async def _serve(self, requests, responses) -> None:
+        async for message in requests:
+            request = message.message.root
+            # Notifications (e.g. initialized) need no answer
+            if isinstance(request, JSONRPCRequest):
+                task = asyncio.create_task(self._answer(request, responses))
+                self._answering.add(task)
+                task.add_done_callback(self._answering.discard)
+
+    async def _answer(self, request: JSONRPCRequest, responses) -> None:
+        payload = {"method": request.method}
+        if request.params is not None:
+            payload["params"] = request.params
+        entry = self.cassette.take_mcp(self.server_name, payload)
+        if entry is None:
+            response = JSONRPCError(jsonrpc="2.0", id=request.id, error=ErrorData(
+                code=INVALID_REQUEST, message=f"No recorded response to {request.method} left in {self.cassette.path}"
+            ))
+        else:
+            # Concurrent calls are answered concurrently, each after its own latency
+            await self.cassette.delay(entry["seconds"])
+            if "error" in entry:
+                response = JSONRPCError(jsonrpc="2.0", id=request.id, error=ErrorData(**entry["error"]))
+            else:
+                response = JSONRPCResponse(jsonrpc="2.0", id=request.id, result=entry["result"])
+        await responses.send(SessionMessage(message=JSONRPCMessage(response)))
+
+    async def _cleanup_resources(self) -> None:
+        await super()._cleanup_resources()
+        tasks = [task for task in (self._server, *self._answering) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for stream in self._streams:
+            await stream.aclose()
+        self._streams = []
+        self._server = None
+
+
+# Cassettes of this process by path, so a restarted agent keeps recording into (or replaying from) the same one
+_cassettes: Dict[str, Cassette] = {}
+
+
+def open_cassette(name: str) -> Optional[Cassette]:
+    """The cassette of agent ``name`` for ``CASSETTE_MODE``, None when the mode is not set. Blocking."""
+    if not settings.CASSETTE_MODE:
+        return None
+    path = os.path.join(settings.CASSETTE_DIR, f"{name}.json")
+    if path not in _cassettes:
+        _cassettes[path] = Cassette(path, settings.CASSETTE_MODE, settings.CASSETTE_TIME_SCALE)
+        logger.info(f"{'Recording' if settings.CASSETTE_MODE == 'record' else 'Replaying'} cassette {path}")
+    return _cassettes[path]
+
+
+def cassette_stats() -> List[dict]:
+    return [cassette.stats() for cassette in _cassettes.values()]
+
+
+async def record_agent_run(client, query: str, response: str, seconds: float) -> None:
+    """Add a finished run to the cassette of the agent's client, if it records one."""
+    cassette = getattr(client, "cassette", None)
+    if cassette is not None and cassette.recording:
+        await cassette.record_run(query, response, seconds)
+
+
+class StepCountingAgentExecutor(AgentExecutor):
+    """
+    AgentExecutor that counts the steps it plans and executes for the current agent run.
+
+    The tool calls of one step run concurrently (``asyncio.gather`` in the base
+    executor), limited per MCP server by ``tool_call_limiter``, and their results
+    are returned in the order the LLM issued the calls. With ``TOOL_CALLS_PARALLEL``
+    disabled they run one after another, still in that order.
+    """
+
+    _sequential: asyncio.Lock = PrivateAttr(default_factory=asyncio.Lock)
+    # Called after every tool call returned
+    _on_tool_result: Optional[Callable[[], None]] = PrivateAttr(default=None)
+
+    async def _atake_next_step(self, *args, **kwargs):
+        run = current_run.get()
+        if run is None:
+            return await super()._atake_next_step(*args, **kwargs)
+
+        run.steps_started += 1
+        result = await super()._atake_next_step(*args, **kwargs)
+        run.steps_completed += 1
+        return result
+
+    async def _aperform_agent_action(self, *args, **kwargs):
+        if settings.TOOL_CALLS_PARALLEL:
+            result = await super()._aperform_agent_action(*args, **kwargs)
+        else:
+            # gather starts the calls in order and the lock is FIFO, so they keep their order
+            async with self._sequential:
+                result = await super()._aperform_agent_action(*args, **kwargs)
+        if self._on_tool_result is not None:
+            self._on_tool_result()
+        return result
+
+
+async def replay(path: str, time_scale: float) -> tuple[float, List[float], Cassette]:
+    """Replay the recorded runs of a cassette on a new agent. Returns the start time, the time of every run and the cassette."""
+    from app.services.tool_cache import CachedMCPClient, CachedLangChainAdapter
+    from app.services.tool_selector import ToolSelectingMCPAgent
+
+    cassette = Cassette(path, "replay", time_scale)
+    # Only the server names matter, the connectors never start a server
+    client = CachedMCPClient(config={"mcpServers": {name: {"cassette": name} for name in cassette.mcp}})
+    client.cassette = cassette
+    agent = ToolSelectingMCPAgent(
+        client=client, llm=cassette.chat_model(), max_steps=75,
+        memory_enabled=True, tool_index_name=f"cassette-{Path(path).stem}"
+    )
+    agent.adapter = CachedLangChainAdapter(disallowed_tools=agent.disallowed_tools)
+    started = time.perf_counter()
+    await agent.initialize()
+    startup = time.perf_counter() - started
+    runs = []
+    try:
+        for run in cassette.runs:
+            started = time.perf_counter()
+            response = await agent.run(run["query"])
+            runs.append(time.perf_counter() - started)
+            if response != run["response"]:
+                logger.warning(f"Replayed response differs from the recording: {response[:200]}")
+    finally:
+        await agent.close()
+    return startup, runs, cassette
+
+
+async def benchmark(path: str, time_scale: float, rounds: int) -> None:
+    from app.services.tool_cache import tool_cache
+    from app.services.tool_results import tool_result_cache
+
+    recorded = Cassette(path, "replay")
+    if not recorded.runs:
+        raise SystemExit(f"{path} has no recorded runs")
+    startups: List[float] = []
+    totals: List[float] = []
+    with tempfile.TemporaryDirectory() as directory:
+        # Every round starts like a new worker, the tool lists come from the cassette
+        tool_cache.cache_dir = Path(directory)
+        for _ in range(rounds):
+            tool_cache.invalidate()
+            tool_result_cache.invalidate()
+            startup, runs, cassette = await replay(path, time_scale)
+            startups.append(startup)
+            totals.append(sum(runs))
+
+    llm_seconds = sum(entry["seconds"] for entry in recorded.llm)
+    mcp_requests = sum(len(entries) for entries in recorded.mcp.values())
+    mcp_seconds = sum(entry["seconds"] for entries in recorded.mcp.values() for entry in entries)
+    print(f"{len(recorded.runs)} runs of {path} recorded {recorded.recorded_at}, "
+          f"replayed at {time_scale:g}x the recorded latency, median of {rounds} rounds")
+    for name, seconds in (
+            ("recorded runs", sum(run["seconds"] for run in recorded.runs)),
+            (f"  {len(recorded.llm)} LLM calls", llm_seconds),
+            (f"  {mcp_requests} MCP requests", mcp_seconds),
+            ("replayed start", statistics.median(startups)),
+            ("replayed runs", statistics.median(totals)),
+    ):
+        print(f"  {name:<32} {seconds:7.3f}s")
+    # Unmatched responses were served for requests that differ from the recording
+    stats = cassette.stats()
+    for name, track in (("LLM", stats["llm"]), *stats["mcp"].items()):
+        print(f"  {name + ' responses':<32} {track['matched']} matched, {track['unmatched']} unmatched, "
+              f"{track['missing']} missing")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("cassette", help="Cassette recorded with CASSETTE_MODE=record")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="Recorded latency multiplier, 0 answers every call right away")
+    parser.add_argument("--rounds", type=int, default=3, help="Replays measured")
+    args = parser.parse_args()
+    asyncio.run(benchmark(args.cassette, args.time_scale, args.rounds))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+import asyncio
+import itertools
+import json
+import logging
+from collections import deque
+from datetime import datetime
+from typing import AsyncIterator, Deque, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeFeed:
+    """
+    In-process publish/subscribe feed of agent and agent file changes.
+
+    Events carry a monotonically increasing id; the most recent ones are kept
+    in a ring buffer so reconnecting clients can resume from ``Last-Event-ID``.
+    ``publish`` may be called from the event loop or from the threadpool that
+    runs the sync endpoints.
+    """
+
+    def __init__(self, history_size: int = 1000, queue_size: int = 100):
+        self._ids = itertools.count(1)
+        self._history: Deque[dict] = deque(maxlen=history_size)
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._queue_size = queue_size
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def publish(self, event: str, **data) -> None:
+        entry = {
+            "id": next(self._ids),
+            "event": event,
+            "data": {**data, "timestamp": datetime.utcnow().isoformat()},
+        }
+
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if running_loop is not None and running_loop is self._loop:
+            self._dispatch(entry)
+        elif self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._dispatch, entry)
+        else:
+            # Nobody subscribed yet, only keep the event for replay
+            self._history.append(entry)
+
+    def _dispatch(self, entry: dict) -> None:
+        self._history.append(entry)
+        for queue in list(self._subscribers):
+            if queue.full():
+                # Drop the oldest event for slow consumers instead of blocking publishers
+                queue.get_nowait()
+            queue.put_nowait(entry)
+
+    def _replay(self, last_event_id: Optional[int]) -> List[dict]:
+        if last_event_id is None:
+            return []
+        return [entry for entry in self._history if entry["id"] > last_event_id]
+
+    async def subscribe(self, last_event_id: Optional[int] = None) -> AsyncIterator[Dict[str, str]]:
+        """Yield events formatted for ``EventSourceResponse``."""
+        self._loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self._queue_size)
+        self._subscribers.add(queue)
+        try:
+            for entry in self._replay(last_event_id):
+                yield self._format(entry)
+            while True:
+                yield self._format(await queue.get())
+        finally:
+            self._subscribers.discard(queue)
+
+    @staticmethod
+    def _format(entry: dict) -> Dict[str, str]:
+        return {"id": str(entry["id"]), "event": entry["event"], "data": json.dumps(entry["data"])}
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+
+change_feed = ChangeFeed()
@@ -0,0 +1,255 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+from app.core.loop_monitor import labelled_tasks
+from app.db.session import SessionLocal
+from app.models.agent_file import AgentFile
+from app.services.change_feed import ChangeFeed
+
+if TYPE_CHECKING:
+    from app.services.tool_selector import ToolSelectingMCPAgent
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ConfigDiff:
+    """Difference between the MCP servers an agent runs and the ones its config file declares."""
+
+    added: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    changed: List[str] = field(default_factory=list)
+    unchanged: List[str] = field(default_factory=list)
+
+    @property
+    def is_empty(self) -> bool:
+        return not (self.added or self.removed or self.changed)
+
+    def to_dict(self) -> dict:
+        return {
+            "added": self.added,
+            "removed": self.removed,
+            "changed": self.changed,
+            "unchanged": self.unchanged,
+        }
+
+
+def diff_server_configs(running: dict, desired: dict) -> ConfigDiff:
+    running_servers = running.get("mcpServers", {})
+    desired_servers = desired.get("mcpServers", {})
+
+    diff = ConfigDiff()
+    for name, server_config in desired_servers.items():
+        if name not in running_servers:
+            diff.added.append(name)
+        elif running_servers[name] != server_config:
+            diff.changed.append(name)
+        else:
+            diff.unchanged.append(name)
+    diff.removed = [name for name in running_servers if name not in desired_servers]
+    return diff
+
+
+class ConfigReconciler:
+    """
+    Applies agent config file changes to running agents without a cold start.
+
+    The config file an agent was started from is compared with the config its
+    ``MCPClient`` holds; only the sessions of servers that were added, removed
+    or changed are closed and (re)created. The agent object, its LLM and its
+    conversation memory are kept, and the tools, system message and executor
+    are rebuilt from the sessions afterwards. New runs wait during the reload
+    and runs in progress get ``drain_timeout`` seconds to finish before they
+    are cancelled through ``cancel_runs``.
+
+    Reloads are triggered by ``agent_file.updated`` events on the change feed,
+    by config files of running agents changing on disk (checked every
+    ``poll_interval`` seconds, catching updates handled by other workers) or
+    explicitly through ``reconcile``.
+    """
+
+    def __init__(
+            self,
+            agents: Dict[int, "ToolSelectingMCPAgent"],
+            feed: ChangeFeed,
+            cancel_runs: Callable[[int, str], int],
+            config_dir: str = "configs",
+            poll_interval: int = 0,
+            drain_timeout: float = 30,
+    ):
+        self.agents = agents
+        self.feed = feed
+        self.cancel_runs = cancel_runs
+        self.config_dir = config_dir
+        self.poll_interval = poll_interval
+        self.drain_timeout = drain_timeout
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._config_names: Dict[int, str] = {}
+        self._stamps: Dict[int, Tuple[int, int]] = {}
+        self._tasks: List[asyncio.Task] = []
+        self.reloads = 0
+        self.restarted_sessions = 0
+        self.failures = 0
+        self.cancelled_runs = 0
+        self.last_duration = 0.0
+
+    def _config_path(self, agent_file_id: int) -> Optional[str]:
+        # The name of an agent file never changes
+        name = self._config_names.get(agent_file_id)
+        if name is None:
+            with SessionLocal() as db:
+                agent_file = db.query(AgentFile.name).filter(AgentFile.id == agent_file_id).first()
+            if not agent_file:
+                return None
+            name = self._config_names[agent_file_id] = agent_file.name
+        return os.path.join(self.config_dir, name)
+
+    def _config_stamp(self, agent_file_id: int) -> Optional[Tuple[int, int]]:
+        config_path = self._config_path(agent_file_id)
+        try:
+            stat = os.stat(config_path) if config_path else None
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size) if stat else None
+
+    def _load_config(self, agent_file_id: int) -> Optional[dict]:
+        config_path = self._config_path(agent_file_id)
+        if not config_path or not os.path.exists(config_path):
+            return None
+        with open(config_path, "r") as file:
+            return json.load(file)
+
+    async def reconcile(self, agent_file_id: int) -> Optional[ConfigDiff]:
+        """
+        Bring a running agent in line with its config file.
+
+        Returns the applied diff, or None if the agent is not running here or
+        its config file is gone.
+        """
+        lock = self._locks.setdefault(agent_file_id, asyncio.Lock())
+        async with lock:
+            mcp_agent = self.agents.get(agent_file_id)
+            if mcp_agent is None:
+                return None
+
+            desired = await asyncio.to_thread(self._load_config, agent_file_id)
+            if desired is None:
+                logger.warning(f"Config file for agent {agent_file_id} not found, skipping reload")
+                return None
+
+            client = mcp_agent.client
+            diff = diff_server_configs(client.config, desired)
+            if diff.is_empty:
+                return diff
+
+            try:
+                with labelled_tasks(agent=agent_file_id):
+                    async with mcp_agent.paused(self.drain_timeout, lambda: self._cancel_busy_runs(agent_file_id)):
+                        started_at = time.perf_counter()
+                        restarted = await self._apply(mcp_agent, desired, diff)
+            except Exception:
+                self.failures += 1
+                raise
+
+            self.reloads += 1
+            self.restarted_sessions += restarted
+            self.last_duration = time.perf_counter() - started_at
+            logger.info(
+                f"Reloaded agent {agent_file_id} in {self.last_duration:.3f}s: "
+                f"added={diff.added} removed={diff.removed} changed={diff.changed}"
+            )
+            self.feed.publish("agent.reloaded", agent_file_id=agent_file_id, **diff.to_dict())
+            return diff
+
+    def _cancel_busy_runs(self, agent_file_id: int) -> None:
+        cancelled = self.cancel_runs(agent_file_id, "agent config reloaded")
+        self.cancelled_runs += cancelled
+        logger.warning(
+            f"Cancelled {cancelled} runs of agent {agent_file_id} still busy after {self.drain_timeout}s "
+            f"to reload its config"
+        )
+
+    async def _apply(self, mcp_agent: "ToolSelectingMCPAgent", desired: dict, diff: ConfigDiff) -> int:
+        client = mcp_agent.client
+        # Only agents that already connected have sessions to restart
+        had_sessions = bool(client.sessions)
+
+        for name in diff.removed + diff.changed:
+            await client.close_session(name)
+        client.config = desired
+
+        restarted = 0
+        if had_sessions:
+            for name in diff.changed + diff.added:
+                await client.create_session(name)
+                restarted += 1
+
+        if mcp_agent._initialized:
+            await self._rebuild_tools(mcp_agent)
+        return restarted
+
+    @staticmethod
+    async def _rebuild_tools(mcp_agent: "ToolSelectingMCPAgent") -> None:
+        # Same steps as MCPAgent.initialize, minus session creation; the
+        # conversation history is kept, only its system message is replaced
+        mcp_agent._sessions = mcp_agent.client.get_all_active_sessions()
+        mcp_agent._tools = await mcp_agent.adapter.create_tools(mcp_agent.client)
+        await mcp_agent._create_system_message_from_tools(mcp_agent._tools)
+        mcp_agent._agent_executor = mcp_agent._create_agent()
+
+    async def _watch(self) -> None:
+        async for event in self.feed.subscribe():
+            if event["event"] != "agent_file.updated":
+                continue
+            agent_file_id = json.loads(event["data"])["agent_file_id"]
+            if agent_file_id not in self.agents:
+                continue
+            try:
+                await self.reconcile(agent_file_id)
+            except Exception as e:
+                logger.error(f"Failed to reload agent {agent_file_id}: {str(e)}", exc_info=True)
+
+    async def _poll(self) -> None:
+        # The change feed is per worker, the config files are shared
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            for agent_file_id in list(self.agents):
+                try:
+                    stamp = await asyncio.to_thread(self._config_stamp, agent_file_id)
+                    if stamp is None or stamp == self._stamps.get(agent_file_id):
+                        continue
+                    await self.reconcile(agent_file_id)
+                    self._stamps[agent_file_id] = stamp
+                except Exception as e:
+                    logger.error(f"Failed to reload agent {agent_file_id}: {str(e)}", exc_info=True)
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._watch())]
+            if self.poll_interval > 0:
+                self._tasks.append(asyncio.create_task(self._poll()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def forget(self, agent_file_id: int) -> None:
+        self._locks.pop(agent_file_id, None)
+        self._config_names.pop(agent_file_id, None)
+        self._stamps.pop(agent_file_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "reloads": self.reloads,
+            "restarted_sessions": self.restarted_sessions,
+            "failures": self.failures,
+            "cancelled_runs": self.cancelled_runs,
+            "last_duration_seconds": self.last_duration,
+        }
@@ -0,0 +1,76 @@
+import resource
+import time
+from typing import Dict, List, Optional
+
+from fastapi import WebSocket
+
+
+class ConnectionManager:
+    """
+    Tracks open chat websockets per agent, enforces connection caps and
+    records churn metrics (opens, closes, rejections, idle disconnects and
+    connection lifetimes).
+    """
+
+    def __init__(self, max_connections: int, max_connections_per_agent: int):
+        self.max_connections = max_connections
+        self.max_connections_per_agent = max_connections_per_agent
+        self.connections: Dict[int, List[WebSocket]] = {}
+        self._opened_at: Dict[int, float] = {}
+        self.opened = 0
+        self.closed = 0
+        self.idle_closed = 0
+        self.rejected: Dict[str, int] = {"global_limit": 0, "agent_limit": 0}
+        self.peak = 0
+        self.total_duration = 0.0
+
+    @property
+    def total(self) -> int:
+        return sum(len(sockets) for sockets in self.connections.values())
+
+    def check_capacity(self, agent_file_id: int) -> Optional[str]:
+        """Return the reason a new connection must be rejected, or None if it fits."""
+        if self.max_connections and self.total >= self.max_connections:
+            self.rejected["global_limit"] += 1
+            return "Server connection limit reached"
+        if self.max_connections_per_agent and \
+                len(self.connections.get(agent_file_id, [])) >= self.max_connections_per_agent:
+            self.rejected["agent_limit"] += 1
+            return "Agent connection limit reached"
+        return None
+
+    def add(self, agent_file_id: int, websocket: WebSocket) -> None:
+        self.connections.setdefault(agent_file_id, []).append(websocket)
+        self._opened_at[id(websocket)] = time.monotonic()
+        self.opened += 1
+        self.peak = max(self.peak, self.total)
+
+    def remove(self, agent_file_id: int, websocket: WebSocket, idle: bool = False) -> None:
+        sockets = self.connections.get(agent_file_id)
+        if not sockets or websocket not in sockets:
+            return
+
+        sockets.remove(websocket)
+        if not sockets:
+            del self.connections[agent_file_id]
+
+        opened_at = self._opened_at.pop(id(websocket), None)
+        if opened_at is not None:
+            self.total_duration += time.monotonic() - opened_at
+        self.closed += 1
+        if idle:
+            self.idle_closed += 1
+
+    def stats(self) -> dict:
+        return {
+            "current": self.total,
+            "per_agent": {agent_file_id: len(sockets) for agent_file_id, sockets in self.connections.items()},
+            "peak": self.peak,
+            "opened": self.opened,
+            "closed": self.closed,
+            "idle_closed": self.idle_closed,
+            "rejected": dict(self.rejected),
+            "avg_duration_seconds": self.total_duration / self.closed if self.closed else 0.0,
+            # ru_maxrss is reported in kilobytes on Linux
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
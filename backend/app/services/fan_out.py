@@ -0,0 +1,87 @@
+import asyncio
+import json
+import logging
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+class FanOut:
+    """
+    Sends one prompt to several agent files at once and collects their answers.
+
+    Every agent runs concurrently under ``asyncio.gather`` with its own
+    timeout, so the whole fan-out takes as long as the slowest agent instead of
+    the sum of all of them. A failing or slow agent only fails its own result.
+    Results are available one by one as agents finish through ``stream`` and
+    all together, in the requested order, from ``run``.
+    """
+
+    def __init__(
+            self,
+            run: Callable[[int, str], Awaitable[str]],
+            prompt: str,
+            agent_files: Dict[int, str],
+            timeouts: Dict[int, float],
+    ):
+        self._run_prompt = run
+        self.prompt = prompt
+        self.agent_files = agent_files
+        self.timeouts = timeouts
+        self._finished: asyncio.Queue = asyncio.Queue()
+
+    async def _run_one(self, agent_file_id: int) -> dict:
+        timeout = self.timeouts[agent_file_id]
+        started = time.perf_counter()
+        result = {"agent_file_id": agent_file_id, "agent_file": self.agent_files[agent_file_id]}
+        try:
+            response = await asyncio.wait_for(self._run_prompt(agent_file_id, self.prompt), timeout)
+            result.update(status="succeeded", response=response, error=None)
+        except asyncio.TimeoutError:
+            result.update(status="timeout", response=None, error=f"No response within {timeout:g} seconds")
+        except Exception as e:
+            logger.warning(f"Fan-out to agent {agent_file_id} failed: {str(e)}")
+            result.update(status="failed", response=None, error=str(e))
+        result["elapsed"] = round(time.perf_counter() - started, 3)
+        self._finished.put_nowait(result)
+        return result
+
+    async def run(self) -> dict:
+        """Run the prompt on every agent file and return the combined response."""
+        started = time.perf_counter()
+        results = await asyncio.gather(*(self._run_one(agent_file_id) for agent_file_id in self.agent_files))
+        return self.combine(results, time.perf_counter() - started)
+
+    async def stream(self) -> AsyncIterator[Dict[str, str]]:
+        """
+        Yield a ``result`` event for every agent as soon as it finished, then a
+        ``done`` event with the combined response. Events are formatted for
+        ``EventSourceResponse``; closing the stream cancels the agents still running.
+        """
+        task = asyncio.create_task(self.run())
+        try:
+            for _ in self.agent_files:
+                yield {"event": "result", "data": json.dumps(await self._finished.get())}
+            yield {"event": "done", "data": json.dumps(await task)}
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+    def combine(self, results: List[dict], elapsed: float) -> dict:
+        statuses = [result["status"] for result in results]
+        # Answers merged into one text, one section per agent file
+        combined = "\n\n".join(
+            f"## {result['agent_file']}\n\n{result['response']}"
+            for result in results if result["status"] == "succeeded"
+        )
+        return {
+            "prompt": self.prompt,
+            "results": results,
+            "combined": combined,
+            "succeeded": statuses.count("succeeded"),
+            "failed": statuses.count("failed"),
+            "timed_out": statuses.count("timeout"),
+            "elapsed": round(elapsed, 3),
+        }
@@ -0,0 +1,431 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import and_, delete, func, select, update
+
+from app.db.session import SessionLocal
+from app.models.agent_job import AgentJob
+from app.services.change_feed import ChangeFeed
+
+logger = logging.getLogger(__name__)
+
+JOB_STATUSES = ("queued", "running", "succeeded", "failed", "cancelled")
+FINISHED_STATUSES = ("succeeded", "failed", "cancelled")
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class JobQueue:
+    """
+    Database backed queue of agent prompts, run by a bounded pool of tasks.
+
+    Jobs are stored in ``agent_jobs`` so their results can be polled, and
+    every state change is published on the change feed for subscribers. Each
+    worker process claims queued jobs (highest priority first, then oldest)
+    with a single conditional UPDATE, so several workers and hosts can share
+    the queue. Running jobs hold a lease that is renewed while they run; jobs
+    of a worker that died are queued again once their lease expires.
+
+    At most ``workers`` jobs run at a time, at most ``per_agent_limit`` of them
+    for the same agent file, and with ``yield_to_chat`` no job of an agent file
+    is started while that agent answers interactive WebSocket messages. Jobs of
+    the same agent file share its agent, each run with its own tools and
+    executor and without the chat memory. Jobs of the agent files
+    ``deprioritized`` returns only start when no other job is waiting. Failed
+    runs are retried with exponential backoff up to the job's ``max_attempts``,
+    unless their error is marked as not ``retryable``.
+    """
+
+    def __init__(
+            self,
+            run: Callable[[int, str], Awaitable[str]],
+            feed: ChangeFeed,
+            worker_id: str,
+            workers: int,
+            per_agent_limit: int,
+            yield_to_chat: bool,
+            retry_delay: int,
+            poll_interval: int,
+            lease: int,
+            retention: int,
+            deprioritized: Optional[Callable[[], Set[int]]] = None,
+    ):
+        self._run_prompt = run
+        self.feed = feed
+        self.worker_id = worker_id
+        self.workers = max(1, workers)
+        self.per_agent_limit = per_agent_limit
+        self.yield_to_chat = yield_to_chat
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.retention = retention
+        self.deprioritized = deprioritized or set
+
+        self._wakeup = asyncio.Event()
+        self._event_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._running: Dict[int, Tuple[int, asyncio.Task]] = {}
+        self._running_per_agent: Counter = Counter()
+        self._interactive: Counter = Counter()
+        self._last_maintenance = 0.0
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+        self.recovered = 0
+        self.cancelled = 0
+
+    # Submission and queries, called from the sync endpoints' threadpool
+
+    def submit(self, agent_file_id: int, prompts: List[str], priority: int, max_attempts: int) -> List[dict]:
+        """Store the prompts as queued jobs of one batch and return them."""
+        batch_id = uuid.uuid4().hex
+        with SessionLocal() as db:
+            jobs = [
+                AgentJob(
+                    agent_file_id=agent_file_id,
+                    batch_id=batch_id,
+                    prompt=prompt,
+                    priority=priority,
+                    max_attempts=max_attempts,
+                    available_at=_now(),
+                )
+                for prompt in prompts
+            ]
+            db.add_all(jobs)
+            db.commit()
+            result = [job.to_dict() for job in jobs]
+
+        self.feed.publish(
+            "job.queued", agent_file_id=agent_file_id, batch_id=batch_id, job_ids=[job["id"] for job in result]
+        )
+        self.notify()
+        return result
+
+    def get(self, job_id: int) -> Optional[dict]:
+        with SessionLocal() as db:
+            job = db.get(AgentJob, job_id)
+            return job.to_dict() if job else None
+
+    def list(
+            self,
+            agent_file_id: int,
+            status: Optional[str] = None,
+            batch_id: Optional[str] = None,
+            cursor: Optional[int] = None,
+            limit: int = 100,
+    ) -> Tuple[List[dict], Optional[int]]:
+        """Jobs of an agent file by ascending id, with the cursor of the next page."""
+        with SessionLocal() as db:
+            query = db.query(AgentJob).filter(AgentJob.agent_file_id == agent_file_id)
+            if status is not None:
+                query = query.filter(AgentJob.status == status)
+            if batch_id is not None:
+                query = query.filter(AgentJob.batch_id == batch_id)
+            if cursor is not None:
+                query = query.filter(AgentJob.id > cursor)
+            jobs = query.order_by(AgentJob.id).limit(limit + 1).all()
+            next_cursor = jobs[limit - 1].id if len(jobs) > limit else None
+            return [job.to_dict() for job in jobs[:limit]], next_cursor
+
+    def cancel(self, job_id: int) -> Optional[dict]:
+        """
+        Cancel a queued or running job. Returns the job, whose status tells whether
+        it was cancelled. Running jobs are stopped right away on this worker, and
+        within a maintenance interval on others.
+        """
+        with SessionLocal() as db:
+            cancelled = db.execute(
+                update(AgentJob)
+                .where(AgentJob.id == job_id, AgentJob.status.in_(("queued", "running")))
+                .values(status="cancelled", finished_at=_now())
+            ).rowcount
+            db.commit()
+            job = db.get(AgentJob, job_id)
+            if job is None:
+                return None
+            result = job.to_dict()
+
+        if cancelled:
+            self._publish("job.cancelled", result)
+            self._cancel_running([job_id])
+        return result
+
+    def _cancel_running(self, job_ids: List[int]) -> None:
+        """Cancel the tasks of jobs running on this worker, safe to call from any thread."""
+        tasks = [self._running[job_id][1] for job_id in job_ids if job_id in self._running]
+        if not tasks or self._event_loop is None or self._event_loop.is_closed():
+            return
+        self.cancelled += len(tasks)
+        for task in tasks:
+            self._event_loop.call_soon_threadsafe(task.cancel)
+
+    # Interactive traffic
+
+    @asynccontextmanager
+    async def interactive(self, agent_file_id: int) -> AsyncIterator[None]:
+        """Mark an agent as answering a chat message, its queued jobs wait until it is done."""
+        self._interactive[agent_file_id] += 1
+        try:
+            yield
+        finally:
+            self._interactive[agent_file_id] -= 1
+            if not self._interactive[agent_file_id]:
+                del self._interactive[agent_file_id]
+                self.notify()
+
+    # Dispatching
+
+    def notify(self) -> None:
+        """Wake up the dispatcher, safe to call from any thread."""
+        loop = self._event_loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is loop:
+            self._wakeup.set()
+        else:
+            loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _load_candidates(self, limit: int, deferred: Set[int]) -> List[Tuple[int, int]]:
+        query = (
+            select(AgentJob.id, AgentJob.agent_file_id)
+            .where(AgentJob.status == "queued", AgentJob.available_at <= _now())
+            .order_by(AgentJob.priority.desc(), AgentJob.id)
+        )
+        with SessionLocal() as db:
+            if not deferred:
+                return [tuple(row) for row in db.execute(query.limit(limit)).all()]
+            # Jobs of deferred agent files only fill the slots the others leave
+            rows = db.execute(query.where(AgentJob.agent_file_id.notin_(deferred)).limit(limit)).all()
+            if len(rows) < limit:
+                rows += db.execute(query.where(AgentJob.agent_file_id.in_(deferred)).limit(limit - len(rows))).all()
+            return [tuple(row) for row in rows]
+
+    def _claim(self, job_ids: List[int]) -> List[AgentJob]:
+        # Only jobs still queued are claimed, other workers may have taken some of them
+        now = _now()
+        with SessionLocal() as db:
+            claimed = db.execute(
+                update(AgentJob)
+                .where(AgentJob.id.in_(job_ids), AgentJob.status == "queued")
+                .values(
+                    status="running",
+                    worker_id=self.worker_id,
+                    attempts=AgentJob.attempts + 1,
+                    started_at=now,
+                    lease_until=now + timedelta(seconds=self.lease),
+                )
+                .returning(AgentJob.id)
+            ).scalars().all()
+            db.commit()
+            jobs = db.query(AgentJob).filter(AgentJob.id.in_(claimed)).all() if claimed else []
+            db.expunge_all()
+            return jobs
+
+    async def _dispatch(self) -> None:
+        free = self.workers - len(self._running)
+        if free <= 0:
+            return
+        # Load more candidates than slots, some may belong to agents at their limit
+        candidates = await asyncio.to_thread(self._load_candidates, free * 4, self.deprioritized())
+
+        selected: List[int] = []
+        planned: Counter = Counter()
+        for job_id, agent_file_id in candidates:
+            if len(selected) >= free:
+                break
+            if job_id in self._running:
+                continue
+            if self.yield_to_chat and self._interactive[agent_file_id]:
+                continue
+            if self.per_agent_limit and self._running_per_agent[agent_file_id] + planned[agent_file_id] >= self.per_agent_limit:
+                continue
+            selected.append(job_id)
+            planned[agent_file_id] += 1
+        if not selected:
+            return
+
+        for job in sorted(await asyncio.to_thread(self._claim, selected), key=lambda job: (-job.priority, job.id)):
+            self._running_per_agent[job.agent_file_id] += 1
+            task = asyncio.create_task(self._execute(job), name=f"agent-job:{job.id}")
+            self._running[job.id] = (job.agent_file_id, task)
+            self._publish("job.started", job.to_dict())
+
+    async def _execute(self, job: AgentJob) -> None:
+        try:
+            result = await self._run_prompt(job.agent_file_id, job.prompt)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            logger.warning(f"Job {job.id} of agent {job.agent_file_id} failed (attempt {job.attempts}): {error}")
+            finished = await asyncio.to_thread(self._finish_failed, job, error, getattr(e, "retryable", True))
+        else:
+            finished = await asyncio.to_thread(self._finish_succeeded, job, result)
+        finally:
+            self._running.pop(job.id, None)
+            self._running_per_agent[job.agent_file_id] -= 1
+            if not self._running_per_agent[job.agent_file_id]:
+                del self._running_per_agent[job.agent_file_id]
+            self._wakeup.set()
+
+        if finished is None:
+            # Taken over by another worker after the lease expired
+            return
+        if finished["status"] == "queued":
+            self.retried += 1
+            self._publish("job.retrying", finished)
+        else:
+            if finished["status"] == "succeeded":
+                self.succeeded += 1
+            else:
+                self.failed += 1
+            self._publish(f"job.{finished['status']}", finished)
+
+    def _finish_succeeded(self, job: AgentJob, result: str) -> Optional[dict]:
+        return self._store_outcome(job, status="succeeded", result=result, error=None, finished_at=_now())
+
+    def _finish_failed(self, job: AgentJob, error: str, retryable: bool = True) -> Optional[dict]:
+        if retryable and job.attempts < job.max_attempts:
+            delay = self.retry_delay * 2 ** (job.attempts - 1)
+            return self._store_outcome(
+                job, status="queued", error=error, worker_id=None, lease_until=None,
+                available_at=_now() + timedelta(seconds=delay),
+            )
+        return self._store_outcome(job, status="failed", error=error, finished_at=_now())
+
+    def _store_outcome(self, job: AgentJob, **values) -> Optional[dict]:
+        with SessionLocal() as db:
+            # The job may have been taken over after its lease expired, keep the newer owner's state
+            updated = db.execute(
+                update(AgentJob)
+                .where(AgentJob.id == job.id, AgentJob.status == "running", AgentJob.worker_id == self.worker_id)
+                .values(**values)
+            ).rowcount
+            db.commit()
+            stored = db.get(AgentJob, job.id) if updated else None
+            return stored.to_dict() if stored else None
+
+    def _maintain(self) -> None:
+        """Renew the leases of running jobs, requeue expired ones and purge old results."""
+        now = _now()
+        with SessionLocal() as db:
+            if self._running:
+                # Jobs cancelled through another worker
+                self._cancel_running(db.execute(
+                    select(AgentJob.id)
+                    .where(AgentJob.id.in_(list(self._running)), AgentJob.status == "cancelled")
+                ).scalars().all())
+                db.execute(
+                    update(AgentJob)
+                    .where(AgentJob.id.in_(list(self._running)), AgentJob.worker_id == self.worker_id)
+                    .values(lease_until=now + timedelta(seconds=self.lease))
+                )
+
+            expired = and_(AgentJob.status == "running", AgentJob.lease_until < now)
+            exhausted = db.execute(
+                update(AgentJob)
+                .where(expired, AgentJob.attempts >= AgentJob.max_attempts)
+                .values(status="failed", error="Worker stopped while running the job", finished_at=now)
+            ).rowcount
+            requeued = db.execute(
+                update(AgentJob)
+                .where(expired)
+                .values(status="queued", worker_id=None, lease_until=None, available_at=now)
+            ).rowcount
+
+            if self.retention:
+                db.execute(
+                    delete(AgentJob).where(
+                        AgentJob.status.in_(FINISHED_STATUSES),
+                        AgentJob.finished_at < now - timedelta(seconds=self.retention),
+                    )
+                )
+            db.commit()
+
+        if exhausted or requeued:
+            self.recovered += requeued
+            logger.info(f"Recovered jobs of stopped workers: {requeued} queued again, {exhausted} failed")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if time.monotonic() - self._last_maintenance >= max(1, self.lease // 3):
+                    await asyncio.to_thread(self._maintain)
+                    self._last_maintenance = time.monotonic()
+                await self._dispatch()
+            except Exception as e:
+                logger.error(f"Job dispatch failed: {str(e)}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def _publish(self, event: str, job: dict) -> None:
+        self.feed.publish(
+            event,
+            job_id=job["id"],
+            agent_file_id=job["agent_file_id"],
+            batch_id=job["batch_id"],
+            status=job["status"],
+            attempts=job["attempts"],
+        )
+
+    def start(self) -> None:
+        if self._task is None:
+            self._event_loop = asyncio.get_running_loop()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop dispatching and cancel running jobs, they are queued again for the next start."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        running = [task for _, task in self._running.values()]
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        if running:
+            await asyncio.to_thread(self._release_running)
+
+    def _release_running(self) -> None:
+        with SessionLocal() as db:
+            db.execute(
+                update(AgentJob)
+                .where(AgentJob.status == "running", AgentJob.worker_id == self.worker_id)
+                .values(
+                    status="queued", worker_id=None, lease_until=None, available_at=_now(),
+                    # The interrupted attempt does not count
+                    attempts=AgentJob.attempts - 1,
+                )
+            )
+            db.commit()
+
+    def stats(self) -> dict:
+        with SessionLocal() as db:
+            counts = dict(db.query(AgentJob.status, func.count(AgentJob.id)).group_by(AgentJob.status).all())
+        return {
+            "workers": self.workers,
+            "running": len(self._running),
+            "running_per_agent": dict(self._running_per_agent),
+            "interactive": dict(self._interactive),
+            "jobs": {status: counts.get(status, 0) for status in JOB_STATUSES},
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "retried": self.retried,
+            "recovered": self.recovered,
+            "cancelled": self.cancelled,
+        }
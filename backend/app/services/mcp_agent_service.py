@@ -1,16 +1,20 @@
 import logging
 
+from sqlalchemy import case, func
 from sqlalchemy.orm import Session
 from app.models.mcp_agent import MCPAgent
 from app.models.agent_file import AgentFile  # Import the new AgentFile model
-from app.models.schemas import MCPAgentCreate, MCPAgentUpdate, MCPAgentBase, MCPAgentInDB
-from typing import List, Optional
+from app.models.schemas import MCPAgentCreate, MCPAgentUpdate, MCPAgentBase, MCPAgentBulkFilter, MCPAgentBulkChanges
+from app.services.secret_store import referenced_secrets, secret_resolver
+from typing import Dict, List, Optional, Tuple
 import subprocess
 import os
 import json
 from pathlib import Path
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
+
 
 class MCPAgentService:
     def __init__(self, db: Session):
@@ -29,8 +33,10 @@ class MCPAgentService:
                 if existing_agent:
                     raise ValueError(f"Agent with name '{agent.name}' already exists")
 
-                # Create new agent instance
-                db_agent = MCPAgent(**agent.dict())
+                # Create new agent instance, its env values are kept in the secret store
+                agent_data = agent.dict()
+                agent_data["env"] = secret_resolver.store_env(agent.name, agent.env)
+                db_agent = MCPAgent(**agent_data)
                 self.db.add(db_agent)
                 self.db.commit()
                 self.db.refresh(db_agent)
@@ -56,13 +62,14 @@ class MCPAgentService:
         self._save_all_agents_config(all_agents_config, config_file_path)
 
         # Save the new agent file entry in the database (but do it only once)
-        agent_ids = [str(agent.id) for agent in created_agents]
-        agent_file = AgentFile(name=config_filename, mcp_agents=",".join(agent_ids))
+        agent_file = AgentFile(name=config_filename)
         self.db.add(agent_file)
         self.db.commit()
         self.db.refresh(agent_file)
 
         # Commit changes to the database to update `file_id` and `file_name`
+        for agent in created_agents:
+            agent.agent_file_id = agent_file.id
         self.db.commit()
 
         # Return only the created agents, no agent file details
@@ -76,36 +83,204 @@ class MCPAgentService:
     def get_agent(self, agent_id: int) -> Optional[MCPAgent]:
         return self.db.query(AgentFile).filter(AgentFile.id == agent_id).first()
 
-    def get_agents(self, skip: int = 0, limit: int = 100) -> List[MCPAgentInDB]:
-        # Fetch all MCP agents and include the associated agent file
-        agents = self.db.query(MCPAgent).offset(skip).limit(limit).all()
+    # Columns that can be selected through the `fields` projection of the agent listing
+    AGENT_LIST_FIELDS = (
+        "name", "agent_type", "command", "args", "env", "is_active",
+        "id", "created_at", "updated_at", "file_name", "file_id"
+    )
+
+    def get_agents(
+            self,
+            skip: int = 0,
+            limit: int = 100,
+            cursor: Optional[int] = None,
+            agent_type: Optional[str] = None,
+            is_active: Optional[bool] = None,
+            file_id: Optional[int] = None,
+            fields: Optional[List[str]] = None,
+            include_total: bool = False
+    ) -> Tuple[List[dict], Optional[int], Optional[int]]:
+        """
+        List agents with keyset pagination on id, filters and field projection.
 
-        # Retrieve associated file names for each agent
-        for agent in agents:
-            agent_file = self.db.query(AgentFile).filter(AgentFile.mcp_agents.like(f"%{agent.id}%")).first()
-            if agent_file:
-                agent.file_name = agent_file.name
-                agent.file_id = agent_file.id
-            else:
-                agent.file_name = None
-                agent.file_id = 0# No associated file
+        Returns the agents as dicts holding only the requested fields, the cursor
+        for the next page (None on the last page) and the total count of matching
+        agents when requested.
+        """
+        fields = list(fields or self.AGENT_LIST_FIELDS)
+        unknown = set(fields) - set(self.AGENT_LIST_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+        # Only select the requested columns, the id is always needed for the cursor
+        column_names = ["id"] + [f for f in fields if f not in ("id", "file_name", "file_id")]
+        columns = [getattr(MCPAgent, name) for name in column_names]
+        if "file_id" in fields:
+            column_names.append("file_id")
+            columns.append(func.coalesce(MCPAgent.agent_file_id, 0))  # 0 means no associated file
+        if "file_name" in fields:
+            column_names.append("file_name")
+            columns.append(AgentFile.name)
+        query = self.db.query(*columns)
+        if "file_name" in fields:
+            query = query.outerjoin(AgentFile, MCPAgent.agent_file_id == AgentFile.id)
+
+        if agent_type is not None:
+            query = query.filter(MCPAgent.agent_type == agent_type)
+        if is_active is not None:
+            query = query.filter(MCPAgent.is_active == is_active)
+        if file_id is not None:
+            query = query.filter(MCPAgent.agent_file_id == file_id)
+
+        total = query.order_by(None).count() if include_total else None
+
+        query = query.order_by(MCPAgent.id)
+        if cursor is not None:
+            query = query.filter(MCPAgent.id > cursor)
+        elif skip:
+            query = query.offset(skip)
+        rows = query.limit(limit + 1).all()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1].id
+
+        # Build plain dicts straight from the selected rows, no ORM objects or per-row validation
+        column_index = [(field, column_names.index(field)) for field in fields]
+        agents = [{field: row[index] for field, index in column_index} for row in rows]
+
+        return agents, next_cursor, total
+
+    def get_agents_version(
+            self,
+            agent_type: Optional[str] = None,
+            is_active: Optional[bool] = None,
+            file_id: Optional[int] = None
+    ) -> tuple:
+        """
+        Cheap signature of the agents matching the listing filters, used as ETag input.
+
+        Creates and deletes change the count and max id, updates bump the per-row version.
+        """
+        query = self.db.query(
+            func.count(MCPAgent.id), func.max(MCPAgent.id), func.sum(MCPAgent.version), func.max(MCPAgent.updated_at)
+        )
+        if agent_type is not None:
+            query = query.filter(MCPAgent.agent_type == agent_type)
+        if is_active is not None:
+            query = query.filter(MCPAgent.is_active == is_active)
+        if file_id is not None:
+            query = query.filter(MCPAgent.agent_file_id == file_id)
+
+        files = self.db.query(func.count(AgentFile.id), func.max(AgentFile.id)).one()
+        return tuple(query.one()) + tuple(files)
+
+    def get_agent_file_states(self) -> List[dict]:
+        """
+        Desired state of every agent file: it should be running when at least one
+        of its agents is active. ``updated_at`` is the latest change of its agents.
+        """
+        rows = self.db.query(
+            AgentFile.id,
+            AgentFile.name,
+            func.max(case((MCPAgent.is_active == True, 1), else_=0)),  # noqa: E712
+            func.max(MCPAgent.updated_at)
+        ).join(MCPAgent, MCPAgent.agent_file_id == AgentFile.id).group_by(AgentFile.id, AgentFile.name).all()
+
+        return [
+            {"agent_file_id": agent_file_id, "name": name, "active": bool(active), "updated_at": updated_at}
+            for agent_file_id, name, active, updated_at in rows
+        ]
+
+    def get_agent_details(self, agent_id: int) -> Optional[MCPAgent]:
+        """Retrieve an MCP agent by id together with its associated file name and id."""
+        db_agent = self.db.query(MCPAgent).filter(MCPAgent.id == agent_id).first()
+        if not db_agent:
+            return None
 
-        return agents
+        agent_file = db_agent.agent_file
+        db_agent.file_name = agent_file.name if agent_file else None
+        db_agent.file_id = agent_file.id if agent_file else 0  # No associated file
+        return db_agent
 
     def update_agent(self, agent_id: int, agent: MCPAgentUpdate) -> Optional[MCPAgent]:
-        db_agent = self.get_agent(agent_id)
+        db_agent = self.get_agent_details(agent_id)
         if not db_agent:
             return None
 
         update_data = agent.dict(exclude_unset=True)
+        if update_data.get("env") is not None:
+            update_data["env"] = secret_resolver.store_env(update_data.get("name") or db_agent.name, update_data["env"])
         for field, value in update_data.items():
             setattr(db_agent, field, value)
+        # Incremented in the UPDATE itself, so concurrent updates both count
+        db_agent.version = MCPAgent.version + 1
 
         self.db.commit()
         self.db.refresh(db_agent)
-        self._save_agent_config(db_agent)
+        if "env" in update_data:
+            self._prune_secrets()
+
+        # Regenerate the config file the agent is started from
+        if db_agent.agent_file:
+            self._regenerate_agent_file_config(db_agent.agent_file)
         return db_agent
 
+    def _bulk_filter_query(self, agent_filter: MCPAgentBulkFilter):
+        criteria = agent_filter.model_dump(exclude_none=True)
+        if not criteria:
+            raise ValueError("At least one filter criterion is required for bulk operations")
+
+        query = self.db.query(MCPAgent)
+        if agent_filter.ids is not None:
+            query = query.filter(MCPAgent.id.in_(agent_filter.ids))
+        if agent_filter.agent_type is not None:
+            query = query.filter(MCPAgent.agent_type == agent_filter.agent_type)
+        if agent_filter.is_active is not None:
+            query = query.filter(MCPAgent.is_active == agent_filter.is_active)
+        if agent_filter.file_id is not None:
+            query = query.filter(MCPAgent.agent_file_id == agent_filter.file_id)
+        return query
+
+    def bulk_update_agents(self, agent_filter: MCPAgentBulkFilter, changes: MCPAgentBulkChanges) -> dict:
+        """
+        Apply the same changes to every agent matching the filter with a single UPDATE statement.
+
+        Config files are regenerated once per affected agent file.
+        """
+        update_data = changes.model_dump(exclude_unset=True)
+        if not update_data:
+            raise ValueError("No fields to update")
+        if update_data.get("env") is not None:
+            # Every matching agent references the same stored values
+            update_data["env"] = secret_resolver.store_shared_env(update_data["env"])
+
+        query = self._bulk_filter_query(agent_filter)
+        try:
+            rows = query.with_entities(MCPAgent.id, MCPAgent.agent_file_id).all()
+            agent_ids = [row.id for row in rows]
+            if agent_ids:
+                # Same version bump as update_agent
+                update_data.update(version=MCPAgent.version + 1, updated_at=datetime.utcnow())
+                self.db.query(MCPAgent).filter(MCPAgent.id.in_(agent_ids)).update(
+                    update_data, synchronize_session=False
+                )
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+
+        if "env" in update_data:
+            self._prune_secrets()
+
+        # Regenerate each affected agent file once
+        affected_file_ids = sorted({row.agent_file_id for row in rows if row.agent_file_id is not None})
+        for agent_file in self.db.query(AgentFile).filter(AgentFile.id.in_(affected_file_ids)).all():
+            self._regenerate_agent_file_config(agent_file)
+
+        return {"matched": len(agent_ids), "agent_ids": agent_ids, "agent_file_ids": affected_file_ids}
+
     def delete_agent_file(self, agent_file_id: int) -> bool:
         """
         Delete agents associated with a given agent_file_id and the agent file itself.
@@ -114,51 +289,71 @@ class MCPAgentService:
 
         Returns True if deletion was successful, or False if not found.
         """
-        # Fetch the agent file from the database
-        agent_file = self.db.query(AgentFile).filter(AgentFile.id == agent_file_id).first()
-        if not agent_file:
-            return False  # Return False if the agent file is not found
-
-        # Extract the agent ids from the mcp_agents column (comma-separated values)
-        agent_ids = [int(agent_id) for agent_id in agent_file.mcp_agents.split(',')]
-
-        # Delete each agent associated with this agent file
-        for agent_id in agent_ids:
-            db_agent = self.db.query(MCPAgent).filter(MCPAgent.id == agent_id).first()
-            if db_agent:
-                # Delete the agent from the database
-                self.db.delete(db_agent)
-                self.db.commit()
-                self._delete_agent_config(db_agent)
+        return bool(self.delete_agent_files([agent_file_id])["deleted_files"])
 
-        # Delete the agent file configuration file from the filesystem
-        config_file_path = self.config_dir / agent_file.name
-        if config_file_path.exists():
-            config_file_path.unlink()  # Delete the file
-
-        # Delete the agent file entry from the database
-        self.db.delete(agent_file)
-        self.db.commit()
+    def delete_agent_files(self, agent_file_ids: List[int]) -> dict:
+        """
+        Delete several agent files and all their agents in one transaction.
 
-        return True
+        The agent files are removed with one DELETE statement and the database
+        deletes their agents through ON DELETE CASCADE, then the config files are
+        removed from the filesystem.
+        """
+        agent_files = self.db.query(AgentFile.id, AgentFile.name).filter(AgentFile.id.in_(agent_file_ids)).all()
+        found_ids = [agent_file.id for agent_file in agent_files]
+        file_names = [agent_file.name for agent_file in agent_files]
 
-    def _save_agent_config(self, agent: MCPAgent) -> None:
-        config = {
-            "mcpServers": {
-                agent.name: {
-                    "command": agent.command,
-                    "args": agent.args,
-                    "env": agent.env
-                }
-            }
+        try:
+            agent_names = [
+                row.name for row in self.db.query(MCPAgent.name).filter(MCPAgent.agent_file_id.in_(found_ids)).all()
+            ]
+            self.db.query(AgentFile).filter(AgentFile.id.in_(found_ids)).delete(synchronize_session=False)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+
+        self._prune_secrets()
+
+        # Delete the configuration files from the filesystem
+        for name in agent_names:
+            self._delete_agent_config(name)
+        for file_name in file_names:
+            config_file_path = self.config_dir / file_name
+            if config_file_path.exists():
+                config_file_path.unlink()  # Delete the file
+
+        return {
+            "deleted_files": len(found_ids),
+            "deleted_agents": len(agent_names),
+            "agent_file_ids": found_ids,
+            "not_found": sorted(set(agent_file_ids) - set(found_ids))
         }
 
-        config_path = self.config_dir / f"{agent.name}_mcp.json"
-        with open(config_path, "w") as f:
-            json.dump(config, f, indent=2)
+    def _regenerate_agent_file_config(self, agent_file: AgentFile) -> None:
+        agents = self.db.query(MCPAgent).filter(MCPAgent.agent_file_id == agent_file.id).order_by(MCPAgent.id).all()
 
-    def _delete_agent_config(self, agent: MCPAgent) -> None:
-        config_path = self.config_dir / f"{agent.name}_mcp.json"
+        all_agents_config = {"mcpServers": {}}
+        for agent in agents:
+            all_agents_config["mcpServers"][agent.name] = {
+                "command": agent.command,
+                "args": agent.args,
+                "env": agent.env
+            }
+        self._save_all_agents_config(all_agents_config, self.config_dir / agent_file.name)
+
+    def _prune_secrets(self) -> None:
+        """Delete the stored env values no agent references anymore."""
+        referenced = set()
+        for (env,) in self.db.query(MCPAgent.env).all():
+            referenced |= referenced_secrets(env)
+        unused = secret_resolver.prune(referenced)
+        if unused:
+            logger.debug(f"Deleted {len(unused)} unused secrets")
+
+    def _delete_agent_config(self, agent_name: str) -> None:
+        # Per-agent config files were written by earlier versions on update
+        config_path = self.config_dir / f"{agent_name}_mcp.json"
         if config_path.exists():
             config_path.unlink()
 
@@ -170,7 +365,7 @@ class MCPAgentService:
         try:
             process = subprocess.Popen(
                 [agent.command] + agent.args,
-                env={**os.environ, **agent.env},
+                env={**os.environ, **secret_resolver.resolve_env(agent.env)},
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE
             )
@@ -193,4 +388,9 @@ class MCPAgentService:
             return agent_file.name
 
         # If no agent file is found, return None
-        return None
\ No newline at end of file
+        return None
+
+    def get_agent_file_names(self, agent_file_ids: List[int]) -> Dict[int, str]:
+        """Retrieve the file names of several agent files at once, missing IDs are left out."""
+        rows = self.db.query(AgentFile.id, AgentFile.name).filter(AgentFile.id.in_(agent_file_ids)).all()
+        return {agent_file_id: name for agent_file_id, name in rows}
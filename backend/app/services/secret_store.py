@@ -0,0 +1,335 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# A reference to a stored secret inside an env value, e.g. "${secret:agents/slack-agent-1/SLACK_BOT_TOKEN}"
+SECRET_REFERENCE = re.compile(r"\$\{secret:([A-Za-z0-9_.\-/]+)\}")
+
+# Prefix of the secrets the service stores for agents, everything below it is pruned when unreferenced
+AGENT_SECRET_PREFIX = "agents/"
+
+
+class SecretNotFoundError(KeyError):
+    """Raised when a referenced secret does not exist in the store."""
+
+
+class SecretProvider(ABC):
+    """Backend that stores secret values by name."""
+
+    # False for the "none" backend, env values are then kept in plain text
+    stores_secrets = True
+
+    @abstractmethod
+    def get(self, name: str) -> Optional[str]:
+        """Return the value of a secret, or None if it does not exist."""
+
+    @abstractmethod
+    def put(self, name: str, value: str) -> None:
+        """Create or replace a secret."""
+
+    @abstractmethod
+    def delete(self, name: str) -> None:
+        """Delete a secret, if it exists."""
+
+    @abstractmethod
+    def names(self) -> List[str]:
+        """Return the names of all stored secrets."""
+
+    def put_many(self, values: Dict[str, str]) -> None:
+        for name, value in values.items():
+            self.put(name, value)
+
+    def delete_many(self, names: Iterable[str]) -> None:
+        for name in names:
+            self.delete(name)
+
+
+class EncryptedFileSecretProvider(SecretProvider):
+    """
+    Secrets kept in a single local file encrypted with Fernet (AES-128-CBC + HMAC).
+
+    The key comes from ``SECRETS_KEY`` or, when unset, from a key file that is
+    generated on first use with owner-only permissions. Nothing is read or
+    written before the first secret is.
+    """
+
+    def __init__(self, path: str, key: Optional[str] = None, key_path: Optional[str] = None):
+        self.path = Path(path)
+        self._key = key
+        self._key_path = Path(key_path) if key_path else None
+        self._fernet = None
+        self._lock = threading.Lock()
+
+    def _get_fernet(self):
+        # Called with the lock held
+        if self._fernet is None:
+            from cryptography.fernet import Fernet
+
+            key = self._key.encode() if self._key else self._load_or_create_key(self._key_path, Fernet)
+            self._fernet = Fernet(key)
+        return self._fernet
+
+    @staticmethod
+    def _load_or_create_key(key_path: Path, fernet_cls) -> bytes:
+        if key_path.exists():
+            return key_path.read_bytes().strip()
+        key_path.parent.mkdir(parents=True, exist_ok=True)
+        key = fernet_cls.generate_key()
+        fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as file:
+            file.write(key)
+        logger.warning(f"Generated a new secrets key at {key_path}, set SECRETS_KEY to manage it yourself")
+        return key
+
+    def _read(self) -> Dict[str, str]:
+        if not self.path.exists():
+            return {}
+        return json.loads(self._get_fernet().decrypt(self.path.read_bytes()))
+
+    def _write(self, secrets: Dict[str, str]) -> None:
+        # Write and rename so readers never see a partial file
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as file:
+            file.write(self._get_fernet().encrypt(json.dumps(secrets).encode()))
+        os.replace(tmp_path, self.path)
+
+    def get(self, name: str) -> Optional[str]:
+        with self._lock:
+            return self._read().get(name)
+
+    def put(self, name: str, value: str) -> None:
+        with self._lock:
+            secrets = self._read()
+            secrets[name] = value
+            self._write(secrets)
+
+    def put_many(self, values: Dict[str, str]) -> None:
+        with self._lock:
+            secrets = self._read()
+            secrets.update(values)
+            self._write(secrets)
+
+    def delete(self, name: str) -> None:
+        self.delete_many([name])
+
+    def delete_many(self, names: Iterable[str]) -> None:
+        with self._lock:
+            secrets = self._read()
+            removed = [name for name in names if secrets.pop(name, None) is not None]
+            if removed:
+                self._write(secrets)
+
+    def names(self) -> List[str]:
+        with self._lock:
+            return sorted(self._read())
+
+
+class VaultSecretProvider(SecretProvider):
+    """
+    Secrets in a HashiCorp Vault (or API compatible stand-in such as OpenBao or
+    ``vault server -dev``) KV version 2 engine, one entry per secret holding a
+    ``value`` key under ``<mount>/<prefix>/<name>``.
+    """
+
+    def __init__(self, url: str, token: str, mount: str = "secret", prefix: str = "mcp-agent"):
+        import httpx
+
+        self.mount = mount.strip("/")
+        self.prefix = prefix.strip("/")
+        self._client = httpx.Client(base_url=url.rstrip("/"), headers={"X-Vault-Token": token}, timeout=10)
+
+    def _path(self, kind: str, name: str = "") -> str:
+        return f"/v1/{self.mount}/{kind}/{self.prefix}/{name}".rstrip("/")
+
+    def get(self, name: str) -> Optional[str]:
+        response = self._client.get(self._path("data", name))
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()["data"]["data"].get("value")
+
+    def put(self, name: str, value: str) -> None:
+        self._client.post(self._path("data", name), json={"data": {"value": value}}).raise_for_status()
+
+    def delete(self, name: str) -> None:
+        response = self._client.delete(self._path("metadata", name))
+        if response.status_code != 404:
+            response.raise_for_status()
+
+    def names(self) -> List[str]:
+        # Entries are nested by "/", so walk the folders returned by LIST
+        names: List[str] = []
+        folders = [""]
+        while folders:
+            folder = folders.pop()
+            response = self._client.request("LIST", self._path("metadata", folder))
+            if response.status_code == 404:
+                continue
+            response.raise_for_status()
+            for key in response.json()["data"]["keys"]:
+                if key.endswith("/"):
+                    folders.append(folder + key)
+                else:
+                    names.append(folder + key)
+        return sorted(names)
+
+
+class SecretResolver:
+    """
+    Replaces ``${secret:name}`` references in env values with the stored secrets.
+
+    Secrets are fetched from the provider once and cached for ``ttl`` seconds
+    (0 caches them until invalidated). Resolved values are only ever handed to
+    the processes that need them, such as MCP server subprocesses, and never
+    written back to the database, config files or this process' environment.
+    """
+
+    def __init__(self, provider: SecretProvider, ttl: int = 0):
+        self.provider = provider
+        self.ttl = ttl
+        self._cache: Dict[str, Tuple[str, float]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name: str) -> str:
+        with self._lock:
+            cached = self._cache.get(name)
+            if cached is not None and (not self.ttl or time.monotonic() - cached[1] < self.ttl):
+                self.hits += 1
+                return cached[0]
+
+        value = self.provider.get(name)
+        if value is None:
+            raise SecretNotFoundError(f"Secret '{name}' not found")
+        with self._lock:
+            self.misses += 1
+            self._cache[name] = (value, time.monotonic())
+        return value
+
+    def resolve(self, value: str) -> str:
+        """Return ``value`` with every secret reference replaced by the secret."""
+        if "${secret:" not in value:
+            return value
+        return SECRET_REFERENCE.sub(lambda match: self.get(match.group(1)), value)
+
+    def resolve_env(self, env: Optional[Dict[str, str]]) -> Optional[Dict[str, str]]:
+        if env is None:
+            return None
+        return {key: self.resolve(value) for key, value in env.items()}
+
+    def resolve_server_config(self, server_config: dict) -> dict:
+        """Return a copy of an ``mcpServers`` entry with its env resolved, for spawning the server."""
+        if not server_config.get("env"):
+            return server_config
+        return {**server_config, "env": self.resolve_env(server_config["env"])}
+
+    def store_env(self, owner: str, env: Dict[str, str]) -> Dict[str, str]:
+        """
+        Move the plain values of an env into the store under ``agents/<owner>/<key>``
+        and return the env with references in their place. Values that already
+        contain a reference are kept as they are.
+        """
+        if not self.provider.stores_secrets:
+            return dict(env)
+
+        references = {}
+        values = {}
+        for key, value in env.items():
+            if SECRET_REFERENCE.search(value):
+                references[key] = value
+                continue
+            name = f"{AGENT_SECRET_PREFIX}{owner}/{key}"
+            values[name] = value
+            references[key] = f"${{secret:{name}}}"
+
+        if values:
+            self.provider.put_many(values)
+            self.invalidate(*values)
+        return references
+
+    def store_shared_env(self, env: Dict[str, str]) -> Dict[str, str]:
+        """Store an env set on several agents at once (bulk updates) under a fresh owner."""
+        return self.store_env(f"shared-{uuid.uuid4().hex[:12]}", env)
+
+    def prune(self, referenced: Set[str]) -> List[str]:
+        """Delete the agent secrets that no env references anymore, returns their names."""
+        unused = [
+            name for name in self.provider.names()
+            if name.startswith(AGENT_SECRET_PREFIX) and name not in referenced
+        ]
+        if unused:
+            self.provider.delete_many(unused)
+            self.invalidate(*unused)
+        return unused
+
+    def invalidate(self, *names: str) -> None:
+        """Drop cached values, all of them when no name is given (e.g. after rotating secrets)."""
+        with self._lock:
+            if not names:
+                self._cache.clear()
+            for name in names:
+                self._cache.pop(name, None)
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self.provider).__name__,
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def referenced_secrets(env: Optional[Dict[str, str]]) -> Set[str]:
+    """Names of the secrets referenced by an env."""
+    return {name for value in (env or {}).values() for name in SECRET_REFERENCE.findall(value)}
+
+
+class _NoSecretProvider(SecretProvider):
+    """Used when ``SECRETS_BACKEND`` is "none": env values stay in plain text, references cannot resolve."""
+
+    stores_secrets = False
+
+    def get(self, name: str) -> Optional[str]:
+        return None
+
+    def put(self, name: str, value: str) -> None:
+        raise RuntimeError("No secrets backend configured, set SECRETS_BACKEND")
+
+    def delete(self, name: str) -> None:
+        pass
+
+    def names(self) -> List[str]:
+        return []
+
+
+def get_secret_resolver() -> SecretResolver:
+    backend = settings.SECRETS_BACKEND
+    if backend == "file":
+        provider = EncryptedFileSecretProvider(settings.SECRETS_FILE, settings.SECRETS_KEY, settings.SECRETS_KEY_FILE)
+    elif backend == "vault":
+        provider = VaultSecretProvider(
+            settings.SECRETS_VAULT_URL, settings.SECRETS_VAULT_TOKEN,
+            settings.SECRETS_VAULT_MOUNT, settings.SECRETS_VAULT_PREFIX
+        )
+    elif backend == "none":
+        provider = _NoSecretProvider()
+    else:
+        raise ValueError(f"Unknown secrets backend: {backend}")
+    return SecretResolver(provider, settings.SECRETS_CACHE_TTL)
+
+
+secret_resolver = get_secret_resolver()
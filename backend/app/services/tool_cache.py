@@ -0,0 +1,507 @@
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+import os
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, NoReturn, Optional
+from weakref import WeakKeyDictionary
+
+from jsonschema_pydantic import jsonschema_to_pydantic
+from langchain_core.tools import BaseTool
+from mcp.types import (
+    CallToolResult, CancelledNotification, CancelledNotificationParams, ClientNotification, InitializeResult, Tool
+)
+from mcp_use import MCPClient
+from mcp_use.adapters.langchain_adapter import LangChainAdapter
+from mcp_use.config import create_connector_from_config
+from mcp_use.connectors.base import BaseConnector
+from mcp_use.session import MCPSession
+from pydantic import BaseModel, Field
+
+from app.core.config import settings
+from app.core.loop_monitor import labelled_tasks
+from app.services.agent_runs import current_run
+from app.services.agent_usage import agent_usage
+from app.services.cassettes import Cassette, RecordingConnector, ReplayConnector
+from app.services.secret_store import secret_resolver
+from app.services.tool_outputs import READ_TOOL_OUTPUT, tool_output_store
+from app.services.tool_results import tool_result_cache
+
+logger = logging.getLogger(__name__)
+
+
+class ToolSchemaCache:
+    """
+    Cache of discovered MCP tool lists and their converted argument models.
+
+    Tool lists are persisted on disk, one file per server, keyed by the server
+    identity (a hash of its command, args and env). Each entry also stores a
+    fingerprint of what the server reported during ``initialize`` (server
+    name/version, protocol version and capabilities); when the fingerprint
+    changes the entry is discarded and ``list_tools`` runs again.
+
+    Converted pydantic argument models only live in memory and are keyed by a
+    hash of the JSON schema, so identical schemas are converted once per process.
+    """
+
+    def __init__(self, cache_dir: str, enabled: bool = True):
+        self.cache_dir = Path(cache_dir)
+        self.enabled = enabled
+        self._tools: Dict[str, Dict[str, Any]] = {}
+        self._models: Dict[str, type[BaseModel]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _hash(value: Any) -> str:
+        payload = json.dumps(value, sort_keys=True, default=str).encode()
+        return hashlib.sha256(payload).hexdigest()
+
+    def server_key(self, server_config: dict) -> str:
+        return self._hash(server_config)[:32]
+
+    def fingerprint(self, init_result: InitializeResult) -> str:
+        return self._hash({
+            "server_info": init_result.serverInfo.model_dump(mode="json"),
+            "protocol_version": init_result.protocolVersion,
+            "capabilities": init_result.capabilities.model_dump(mode="json", exclude_none=True),
+        })
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def get_tools(self, key: str, fingerprint: str) -> Optional[List[Tool]]:
+        if not self.enabled:
+            return None
+
+        entry = self._tools.get(key)
+        if entry is None:
+            path = self._path(key)
+            if path.exists():
+                try:
+                    with open(path, "r") as file:
+                        entry = json.load(file)
+                    self._tools[key] = entry
+                except (OSError, json.JSONDecodeError) as e:
+                    logger.warning(f"Ignoring unreadable tool cache file {path}: {e}")
+
+        if not entry or entry.get("fingerprint") != fingerprint:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return [Tool.model_validate(tool) for tool in entry["tools"]]
+
+    def put_tools(self, key: str, fingerprint: str, tools: List[Tool]) -> None:
+        if not self.enabled:
+            return
+
+        entry = {
+            "fingerprint": fingerprint,
+            "tools": [tool.model_dump(mode="json", exclude_none=True) for tool in tools],
+        }
+        self._tools[key] = entry
+
+        # Write to a temporary file first so a crash never leaves a torn entry
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            path = self._path(key)
+            tmp_path = path.with_suffix(".tmp")
+            with open(tmp_path, "w") as file:
+                json.dump(entry, file)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to persist tool cache for server {key}: {e}")
+
+    def invalidate(self, key: Optional[str] = None) -> None:
+        """Drop one server entry, or every entry when no key is given."""
+        keys = [key] if key else list(self._tools.keys())
+        if not key and self.cache_dir.exists():
+            keys += [path.stem for path in self.cache_dir.glob("*.json")]
+
+        for cache_key in set(keys):
+            self._tools.pop(cache_key, None)
+            path = self._path(cache_key)
+            if path.exists():
+                path.unlink()
+
+    def get_args_model(self, schema: dict, fix_schema) -> type[BaseModel]:
+        schema_key = self._hash(schema)
+        model = self._models.get(schema_key)
+        if model is None:
+            # fix_schema mutates its input, so never hand it the cached tool schema
+            model = jsonschema_to_pydantic(fix_schema(copy.deepcopy(schema)))
+            self._models[schema_key] = model
+        return model
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "servers": len(self._tools),
+            "models": len(self._models),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+tool_cache = ToolSchemaCache(settings.TOOL_CACHE_DIR, enabled=settings.TOOL_CACHE_ENABLED)
+
+
+class ToolCallLimiter:
+    """
+    Bounds the number of tool calls in flight on each MCP server session.
+
+    The agent executor runs the tool calls of one step concurrently, so calls
+    to different servers overlap freely while calls to the same server wait for
+    one of its slots. The limit of a server is its entry in
+    ``TOOL_CALL_CONCURRENCY_OVERRIDES`` (by server name) or
+    ``TOOL_CALL_CONCURRENCY_PER_SERVER``; 0 removes it.
+    """
+
+    def __init__(self, default_limit: int):
+        self.default_limit = default_limit
+        self._semaphores: WeakKeyDictionary[BaseConnector, Optional[asyncio.Semaphore]] = WeakKeyDictionary()
+        self.calls = 0
+        self.queued = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def register(self, connector: BaseConnector, limit: Optional[int] = None) -> None:
+        if limit is None:
+            limit = self.default_limit
+        self._semaphores[connector] = asyncio.Semaphore(limit) if limit > 0 else None
+
+    @asynccontextmanager
+    async def slot(self, connector: BaseConnector) -> AsyncIterator[None]:
+        """Wait for a free slot on the connector's server and hold it for one call."""
+        if connector not in self._semaphores:
+            self.register(connector)
+        semaphore = self._semaphores[connector]
+        self.calls += 1
+        if semaphore is not None:
+            if semaphore.locked():
+                self.queued += 1
+            await semaphore.acquire()
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if semaphore is not None:
+                semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "default_limit": self.default_limit,
+            "calls": self.calls,
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+        }
+
+
+tool_call_limiter = ToolCallLimiter(settings.TOOL_CALL_CONCURRENCY_PER_SERVER)
+
+
+class CachedMCPClient(MCPClient):
+    """
+    MCPClient that serves ``list_tools`` results from the tool schema cache and
+    keeps every server session in its own task, so sessions can be restarted
+    individually and closed from any task.
+    """
+
+    async def _initialize_session(self, session: MCPSession, server_config: dict) -> InitializeResult:
+        connector = session.connector
+        if not session.is_connected:
+            await session.connect()
+
+        # The MCP handshake is always required, only tool discovery can be skipped
+        init_result = await connector.client.initialize()
+
+        key = tool_cache.server_key(server_config)
+        fingerprint = tool_cache.fingerprint(init_result)
+        # Recorded cassettes carry the tool lists, so they replay without the cache
+        tools = None if isinstance(connector, RecordingConnector) else tool_cache.get_tools(key, fingerprint)
+        if tools is None:
+            tools = (await connector.client.list_tools()).tools
+            tool_cache.put_tools(key, fingerprint, tools)
+            logger.debug(f"Discovered {len(tools)} tools for server {key}")
+        else:
+            logger.debug(f"Loaded {len(tools)} cached tools for server {key}")
+
+        connector._tools = tools
+        session.session_info = init_result
+        session.tools = tools
+        return init_result
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._session_tasks: Dict[str, tuple[asyncio.Task, asyncio.Event]] = {}
+        # Set to record the servers' traffic into a cassette, or to answer from it instead of starting them
+        self.cassette: Optional[Cassette] = None
+
+    async def _session_lifetime(self, session: MCPSession, server_config: dict,
+                                ready: asyncio.Future, closing: asyncio.Event) -> None:
+        # The MCP ClientSession is an anyio task group: it must be exited by the task that
+        # entered it, in LIFO order. Owning each session in its own task lets single servers
+        # be restarted (and sessions be closed from any request) without touching the others.
+        try:
+            await self._initialize_session(session, server_config)
+        except BaseException as e:
+            if not ready.done():
+                ready.set_exception(e)
+            await session.disconnect()
+            return
+
+        ready.set_result(None)
+        try:
+            await closing.wait()
+        finally:
+            await session.disconnect()
+
+    async def _new_session(self, server_name: str) -> tuple[MCPSession, dict]:
+        servers = self.config.get("mcpServers", {})
+        if not servers:
+            raise ValueError("No MCP servers defined in config")
+
+        if server_name not in servers:
+            raise ValueError(f"Server '{server_name}' not found in config")
+
+        server_config = servers[server_name]
+        marker = None
+        if self.cassette is not None and self.cassette.replaying:
+            # No server process, so no secrets either
+            connector = ReplayConnector(self.cassette, server_name)
+        else:
+            # Secrets only exist in the server's environment, the config keeps the references
+            resolved_config = await asyncio.to_thread(secret_resolver.resolve_server_config, server_config)
+            # Lets the usage sampler attribute the server's processes to the agent
+            resolved_config, marker = agent_usage.mark_server_config(resolved_config)
+            connector = create_connector_from_config(resolved_config)
+            if self.cassette is not None:
+                connector = RecordingConnector(connector, self.cassette, server_name)
+        session = MCPSession(connector)
+        agent_usage.register_server(session.connector, marker)
+        tool_call_limiter.register(session.connector, settings.TOOL_CALL_CONCURRENCY_OVERRIDES.get(server_name))
+        cached_tools = await asyncio.to_thread(tool_result_cache.policy_for, server_name)
+        tool_result_cache.register(session.connector, tool_cache.server_key(server_config), cached_tools)
+        return session, server_config
+
+    def _start_session(self, server_name: str, session: MCPSession, server_config: dict) -> tuple[asyncio.Task, asyncio.Future]:
+        ready = asyncio.get_running_loop().create_future()
+        closing = asyncio.Event()
+        # The session outlives the run or connection that started it, it only belongs to the agent
+        with labelled_tasks(server=server_name, run=None, websocket=None):
+            task = asyncio.create_task(
+                self._session_lifetime(session, server_config, ready, closing),
+                name=f"mcp-session:{server_name}"
+            )
+        self._session_tasks[server_name] = (task, closing)
+        return task, ready
+
+    def _add_session(self, server_name: str, session: MCPSession) -> None:
+        self.sessions[server_name] = session
+        if server_name not in self.active_sessions:
+            self.active_sessions.append(server_name)
+
+    async def create_session(self, server_name: str, auto_initialize: bool = True) -> MCPSession:
+        session, server_config = await self._new_session(server_name)
+        if auto_initialize:
+            task, ready = self._start_session(server_name, session, server_config)
+            try:
+                await ready
+            except BaseException:
+                # Startup failed or the caller gave up waiting, don't leave the server behind
+                self._session_tasks.pop(server_name, None)
+                task.cancel()
+                raise
+        self._add_session(server_name, session)
+        return session
+
+    async def restore_session(self, server_name: str, tools: List[Tool]) -> MCPSession:
+        """
+        Create the session of a server whose tools are already known, e.g. from a
+        hibernation snapshot, and connect it in the background. The tools can be
+        built right away; calling one waits until the server is connected.
+        """
+        session, server_config = await self._new_session(server_name)
+        session.connector._tools = tools
+        session.tools = tools
+        _, ready = self._start_session(server_name, session, server_config)
+        _connecting[session.connector] = ready
+
+        def connected(future: asyncio.Future) -> None:
+            if not future.cancelled() and future.exception() is not None:
+                logger.error(f"Reconnecting server '{server_name}' failed: {future.exception()}")
+
+        ready.add_done_callback(connected)
+        self._add_session(server_name, session)
+        return session
+
+    async def close_session(self, server_name: str) -> None:
+        owner = self._session_tasks.pop(server_name, None)
+        if owner is None:
+            await super().close_session(server_name)
+            return
+
+        task, closing = owner
+        closing.set()
+        try:
+            await task
+        except Exception as e:
+            logger.error(f"Error closing session for server '{server_name}': {e}")
+        finally:
+            self.sessions.pop(server_name, None)
+            if server_name in self.active_sessions:
+                self.active_sessions.remove(server_name)
+
+    async def create_all_sessions(self, auto_initialize: bool = True) -> Dict[str, MCPSession]:
+        servers = self.config.get("mcpServers", {})
+        if not servers:
+            raise ValueError("No MCP servers defined in config")
+
+        # Unlike the base client, initialize each session exactly once
+        for name in servers:
+            await self.create_session(name, auto_initialize)
+
+        return self.sessions
+
+
+# Connections of restored sessions still being established, tool calls wait for them
+_connecting: WeakKeyDictionary[BaseConnector, asyncio.Future] = WeakKeyDictionary()
+
+
+async def call_tool(connector: BaseConnector, name: str, arguments: Dict[str, Any]) -> CallToolResult:
+    """
+    Call an MCP tool within its server's concurrency limit and, if the call is
+    cancelled, tell the server to stop working on it. The MCP client itself
+    only stops waiting for the response. Results of read-only tools are served
+    from ``tool_result_cache`` while they are fresh.
+    """
+    cached = tool_result_cache.get(connector, name, arguments)
+    if cached is not None:
+        return cached
+
+    connecting = _connecting.get(connector)
+    if connecting is not None:
+        await asyncio.shield(connecting)
+        _connecting.pop(connector, None)
+
+    async with tool_call_limiter.slot(connector):
+        session = connector.client
+        # send_request takes this id before its first await, so it is the id of our request
+        request_id = session._request_id if session is not None else None
+        try:
+            result = await connector.call_tool(name, arguments)
+        except asyncio.CancelledError:
+            if request_id is not None and settings.MCP_NOTIFY_CANCELLED:
+                notification = ClientNotification(CancelledNotification(
+                    method="notifications/cancelled",
+                    params=CancelledNotificationParams(requestId=request_id, reason="Agent run cancelled"),
+                ))
+                try:
+                    await asyncio.wait_for(session.send_notification(notification), timeout=1)
+                except Exception as e:
+                    logger.debug(f"Could not send the cancellation of tool call '{name}': {e}")
+            raise
+
+    tool_result_cache.put(connector, name, arguments, result)
+    return result
+
+
+class ReadToolOutputArgs(BaseModel):
+    handle: str = Field(..., description="Handle of the truncated output")
+    offset: int = Field(0, description="Position to continue reading from, as given after the truncated output")
+
+
+class ReadToolOutputTool(BaseTool):
+    """Lets the LLM page through tool outputs that were too large to return in full."""
+
+    name: str = READ_TOOL_OUTPUT
+    description: str = (
+        "Read the next page of a tool output that was truncated because it was too large. "
+        "Only call it when the truncated part is needed to answer."
+    )
+    args_schema: type[BaseModel] = ReadToolOutputArgs
+
+    def _run(self, **kwargs: Any) -> NoReturn:
+        raise NotImplementedError("Stored tool outputs are only read asynchronously")
+
+    async def _arun(self, handle: str, offset: int = 0) -> str:
+        return await asyncio.to_thread(tool_output_store.read, handle, offset)
+
+
+class MCPTool(BaseTool):
+    """
+    LangChain tool calling an MCP tool. Defined once instead of as a new class
+    per tool (as the mcp_use adapter does), which made building the tools of
+    an agent cost about 10ms per tool.
+    """
+
+    tool_connector: BaseConnector
+    adapter: LangChainAdapter
+    handle_tool_error: bool = True
+
+    def __repr__(self) -> str:
+        return f"MCP tool: {self.name}: {self.description}"
+
+    # mcp_use formats every loaded tool while logging, pydantic's default is slow
+    __str__ = __repr__
+
+    def _run(self, **kwargs: Any) -> NoReturn:
+        raise NotImplementedError("MCP tools only support async operations")
+
+    async def _arun(self, **kwargs: Any) -> Any:
+        run = current_run.get()
+        if run is not None:
+            run.tool_calls_started += 1
+        try:
+            tool_result: CallToolResult = await call_tool(self.tool_connector, self.name, kwargs)
+        except Exception as e:
+            if run is not None:
+                run.tool_calls_completed += 1
+            if self.handle_tool_error:
+                return f"Error executing MCP tool: {str(e)}"
+            raise
+        if run is not None:
+            run.tool_calls_completed += 1
+
+        try:
+            output = self.adapter._parse_mcp_tool_result(tool_result)
+        except Exception as e:
+            logger.error(f"Error parsing tool result: {e}")
+            output = f"Error parsing result: {e!s}; Raw content: {tool_result.content!r}"
+        if tool_output_store.fits(output):
+            return output
+        # Writing a spilled output of several MB would block the event loop
+        return await asyncio.to_thread(tool_output_store.limit, self.name, output)
+
+
+class CachedLangChainAdapter(LangChainAdapter):
+    """
+    LangChainAdapter that reuses converted argument models from the tool schema
+    cache and hands huge tool outputs to the LLM one page at a time.
+    """
+
+    async def _create_tools_from_connectors(self, connectors: List[BaseConnector]) -> List[BaseTool]:
+        tools = await super()._create_tools_from_connectors(connectors)
+        if tool_output_store.inline_limit:
+            tools.append(ReadToolOutputTool())
+        return tools
+
+    def _convert_tool(self, mcp_tool: Tool, connector: BaseConnector) -> Optional[BaseTool]:
+        # Skip disallowed tools
+        if mcp_tool.name in self.disallowed_tools:
+            return None
+
+        return MCPTool(
+            name=mcp_tool.name or "NO NAME",
+            description=mcp_tool.description or "",
+            args_schema=tool_cache.get_args_model(mcp_tool.inputSchema, self.fix_schema),
+            tool_connector=connector,
+            adapter=self,
+        )
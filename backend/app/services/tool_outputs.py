@@ -0,0 +1,186 @@
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Name of the tool the LLM pages through spilled outputs with
+READ_TOOL_OUTPUT = "read_tool_output"
+
+
+@dataclass
+class SpilledOutput:
+    path: str
+    size: int
+    tool: str
+    expires: float
+
+
+def _char_boundary(data, position: int) -> int:
+    """Move a byte position forward to the start of the next UTF-8 character."""
+    while position < len(data) and data[position] & 0xC0 == 0x80:
+        position += 1
+    return position
+
+
+class ToolOutputStore:
+    """
+    Keeps huge tool outputs out of agent memory and the LLM prompt.
+
+    Outputs longer than ``inline_limit`` characters are written to a temporary
+    file and the agent gets their first page with a handle instead. The LLM
+    reads further pages with the ``read_tool_output`` tool; pages are sliced
+    out of a memory map of the file, so only the page read is ever loaded.
+    Positions are byte offsets into the UTF-8 encoded output. Spilled outputs
+    expire after ``ttl`` seconds and the oldest ones are deleted once the store
+    exceeds ``max_bytes``.
+
+    Outputs are spilled and read in worker threads, the index of stored
+    outputs is guarded by a lock.
+    """
+
+    def __init__(self, inline_limit: int, page_size: int, max_bytes: int, ttl: float,
+                 directory: Optional[str] = None):
+        self.inline_limit = inline_limit
+        self.page_size = page_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._configured_directory = directory
+        self._directory: Optional[str] = None
+        self._outputs: OrderedDict[str, SpilledOutput] = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes_stored = 0
+        self.spilled = 0
+        self.bytes_spilled = 0
+        self.pages_read = 0
+        self.evictions = 0
+
+    def _get_directory(self) -> str:
+        if self._directory is None:
+            if self._configured_directory:
+                os.makedirs(self._configured_directory, exist_ok=True)
+            self._directory = tempfile.mkdtemp(prefix="tool-outputs-", dir=self._configured_directory)
+        return self._directory
+
+    def fits(self, output: str) -> bool:
+        """Whether ``output`` is returned as is, without being spilled."""
+        return not self.inline_limit or len(output) <= self.inline_limit
+
+    def limit(self, tool_name: str, output: str) -> str:
+        """Return ``output`` as is when it is short enough, otherwise spill it and return its first page. Blocking."""
+        if self.fits(output):
+            return output
+
+        data = output.encode()
+        handle = uuid.uuid4().hex[:16]
+        with self._lock:
+            path = os.path.join(self._get_directory(), handle)
+        try:
+            with open(path, "wb") as file:
+                file.write(data)
+        except OSError as e:
+            logger.error(f"Could not spill the output of tool '{tool_name}' to {path}: {e}")
+            end = _char_boundary(data, self.page_size)
+            return data[:end].decode() + f"\n\n[Output truncated: {end} of {len(data)} bytes shown]"
+
+        with self._lock:
+            self._purge()
+            self._outputs[handle] = SpilledOutput(path, len(data), tool_name, time.monotonic() + self.ttl)
+            self.bytes_stored += len(data)
+            self.spilled += 1
+            self.bytes_spilled += len(data)
+            self._evict()
+        logger.info(f"Spilled {len(data)} bytes of output from tool '{tool_name}' as {handle}")
+        return self._page(handle, data, 0)
+
+    def read(self, handle: str, offset: int = 0) -> str:
+        """Return the page of a spilled output starting at byte ``offset``. Blocking."""
+        with self._lock:
+            self._purge()
+            output = self._outputs.get(handle)
+            if output is not None and 0 <= offset < output.size:
+                self.pages_read += 1
+        if output is None:
+            return f"No stored tool output with handle '{handle}', it may have expired"
+        if offset < 0 or offset >= output.size:
+            return f"Offset {offset} is outside the stored output of {output.size} bytes"
+
+        try:
+            with open(output.path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return self._page(handle, data, offset)
+        except FileNotFoundError:
+            # Evicted by another spill after the lookup
+            return f"No stored tool output with handle '{handle}', it may have expired"
+
+    def _page(self, handle: str, data, offset: int) -> str:
+        start = _char_boundary(data, offset)
+        end = _char_boundary(data, min(start + self.page_size, len(data)))
+        page = data[start:end].decode()
+        if end >= len(data):
+            return page + f"\n\n[End of output {handle}: bytes {start}-{end} of {len(data)}]"
+        return page + (
+            f"\n\n[Output truncated: bytes {start}-{end} of {len(data)} shown. "
+            f"Call {READ_TOOL_OUTPUT} with handle=\"{handle}\" and offset={end} to read the next page.]"
+        )
+
+    # Called with the lock held
+
+    def _remove(self, handle: str) -> None:
+        output = self._outputs.pop(handle, None)
+        if output is None:
+            return
+        self.bytes_stored -= output.size
+        try:
+            os.unlink(output.path)
+        except OSError as e:
+            logger.warning(f"Could not delete spilled tool output {output.path}: {e}")
+
+    def _purge(self) -> None:
+        now = time.monotonic()
+        for handle in [handle for handle, output in self._outputs.items() if output.expires <= now]:
+            self._remove(handle)
+
+    def _evict(self) -> None:
+        # Keep the newest output even when it alone exceeds the limit, the LLM is about to page through it
+        while self.bytes_stored > self.max_bytes and len(self._outputs) > 1:
+            self._remove(next(iter(self._outputs)))
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """Delete every spilled output, e.g. on shutdown."""
+        with self._lock:
+            self._outputs.clear()
+            self.bytes_stored = 0
+            if self._directory is not None:
+                shutil.rmtree(self._directory, ignore_errors=True)
+                self._directory = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "inline_limit": self.inline_limit,
+            "stored": len(self._outputs),
+            "bytes_stored": self.bytes_stored,
+            "spilled": self.spilled,
+            "bytes_spilled": self.bytes_spilled,
+            "pages_read": self.pages_read,
+            "evictions": self.evictions,
+        }
+
+
+tool_output_store = ToolOutputStore(
+    settings.TOOL_OUTPUT_INLINE_LIMIT,
+    settings.TOOL_OUTPUT_PAGE_SIZE,
+    settings.TOOL_OUTPUT_STORE_MAX_BYTES,
+    settings.TOOL_OUTPUT_TTL,
+    directory=settings.TOOL_OUTPUT_STORE_DIR,
+)
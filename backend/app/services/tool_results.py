@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from weakref import WeakKeyDictionary
+
+from mcp.types import CallToolResult
+from mcp_use.connectors.base import BaseConnector
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.models.mcp_agent import MCPAgent
+
+logger = logging.getLogger(__name__)
+
+
+def _result_size(result: CallToolResult) -> int:
+    size = 0
+    for item in result.content:
+        resource = getattr(item, "resource", None)
+        size += len(getattr(item, "text", None) or getattr(item, "data", None)
+                    or getattr(resource, "text", None) or getattr(resource, "blob", None) or "")
+    return size
+
+
+class ToolResultCache:
+    """
+    LRU cache of MCP tool call results for read-only tools.
+
+    Only tools listed under ``cached_tools`` of the server's agent type in
+    ``agent-types.json`` are cached, each with its own TTL in seconds::
+
+        {"name": "slack", ..., "cached_tools": {"slack_list_channels": 300}}
+
+    Entries are keyed by the server identity (the same hash the tool schema
+    cache uses), the tool name and the arguments, so identical calls are shared
+    across conversations and across agent files running the same server.
+    Failed calls and outputs too large to hand to the LLM inline are never
+    cached. The cache holds at most ``max_entries`` results and evicts the
+    least recently used one first.
+    """
+
+    def __init__(self, agent_types_file: str, max_entries: int, enabled: bool = True):
+        self.agent_types_file = agent_types_file
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._entries: OrderedDict[Tuple[str, str, str], Tuple[float, CallToolResult]] = OrderedDict()
+        self._servers: WeakKeyDictionary[BaseConnector, Tuple[str, Dict[str, float]]] = WeakKeyDictionary()
+        self._policies: Dict[str, Dict[str, float]] = {}
+        self._policies_mtime: Optional[float] = None
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.too_large = 0
+        self._tools: Dict[str, Dict[str, int]] = {}
+
+    def _load_policies(self) -> Dict[str, Dict[str, float]]:
+        """Cached tools and their TTLs per agent type, re-read when the file changes."""
+        try:
+            mtime = os.path.getmtime(self.agent_types_file)
+            if mtime != self._policies_mtime:
+                with open(self.agent_types_file, "r") as file:
+                    agent_types = json.load(file)
+                self._policies = {
+                    agent_type["name"]: {tool: float(ttl) for tool, ttl in agent_type.get("cached_tools", {}).items()}
+                    for agent_type in agent_types
+                }
+                self._policies_mtime = mtime
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            logger.warning(f"Could not read cached tools from {self.agent_types_file}: {e}")
+        return self._policies
+
+    def policy_for(self, server_name: str) -> Dict[str, float]:
+        """Cached tools of the agent type of a server (an agent name). Blocking, run it in a thread."""
+        if not self.enabled:
+            return {}
+        try:
+            with SessionLocal() as db:
+                agent_type = db.query(MCPAgent.agent_type).filter(MCPAgent.name == server_name).scalar()
+        except SQLAlchemyError as e:
+            logger.warning(f"Could not look up the agent type of server '{server_name}', not caching its results: {e}")
+            return {}
+        return dict(self._load_policies().get(agent_type, {}))
+
+    def register(self, connector: BaseConnector, server_key: str, policy: Dict[str, float]) -> None:
+        if policy:
+            self._servers[connector] = (server_key, policy)
+
+    def _lookup(self, connector: BaseConnector, name: str, arguments: Dict[str, Any]) -> Optional[Tuple[Tuple[str, str, str], float]]:
+        server = self._servers.get(connector)
+        if not self.enabled or server is None or name not in server[1]:
+            return None
+        server_key, policy = server
+        key = (server_key, name, json.dumps(arguments, sort_keys=True, default=str))
+        return key, policy[name]
+
+    def _count(self, name: str, outcome: str) -> None:
+        counts = self._tools.setdefault(name, {"hits": 0, "misses": 0})
+        counts[outcome] += 1
+
+    def get(self, connector: BaseConnector, name: str, arguments: Dict[str, Any]) -> Optional[CallToolResult]:
+        """Return the cached result of a call, or None when it has to go to the server."""
+        lookup = self._lookup(connector, name, arguments)
+        if lookup is None:
+            return None
+        key, _ = lookup
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            del self._entries[key]
+            self.expired += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            self._count(name, "misses")
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self._count(name, "hits")
+        return entry[1]
+
+    def put(self, connector: BaseConnector, name: str, arguments: Dict[str, Any], result: CallToolResult) -> None:
+        lookup = self._lookup(connector, name, arguments)
+        if lookup is None or result.isError:
+            return
+        if settings.TOOL_OUTPUT_INLINE_LIMIT and _result_size(result) > settings.TOOL_OUTPUT_INLINE_LIMIT:
+            # Outputs that big are spilled to disk, keeping them here would defeat that
+            self.too_large += 1
+            return
+        key, ttl = lookup
+        self._entries[key] = (time.monotonic() + ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, name: Optional[str] = None) -> int:
+        """Drop the cached results of one tool, or all of them, returns how many were dropped."""
+        keys = [key for key in self._entries if name is None or key[1] == name]
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "too_large": self.too_large,
+            "tools": {name: dict(counts) for name, counts in self._tools.items()},
+        }
+
+
+tool_result_cache = ToolResultCache(
+    settings.AGENT_TYPES_FILE, settings.TOOL_RESULT_CACHE_MAX_ENTRIES, enabled=settings.TOOL_RESULT_CACHE_ENABLED
+)
@@ -0,0 +1,442 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain.agents import AgentExecutor
+from langchain_core.messages import BaseMessage, SystemMessage, messages_from_dict, messages_to_dict
+from langchain_core.tools import BaseTool
+from mcp.types import Tool
+from mcp_use import MCPAgent
+from mcp_use.agents.prompts.system_prompt_builder import create_system_message
+from mcp_use.agents.prompts.templates import DEFAULT_SYSTEM_PROMPT_TEMPLATE, SERVER_MANAGER_SYSTEM_PROMPT_TEMPLATE
+
+from app.core.config import settings
+from app.services.agent_hibernation import read_snapshot, write_snapshot
+from app.services.agent_runs import current_run
+from app.services.agent_usage import counting_tokens
+from app.services.cassettes import StepCountingAgentExecutor, record_agent_run
+from app.services.tool_cache import tool_cache
+from app.services.tool_outputs import READ_TOOL_OUTPUT
+
+logger = logging.getLogger(__name__)
+
+
+# Messages of the run in progress, they only reach the conversation memory once the run is answered
+_run_messages: ContextVar[Optional[List[BaseMessage]]] = ContextVar("run_messages", default=None)
+
+
+@dataclass
+class _RunTools:
+    """Tools of one run, pre-selected or all of the agent's, with the system message and executor built for them."""
+
+    agent: "ToolSelectingMCPAgent"
+    tools: List[BaseTool]
+    system_message: SystemMessage
+    executor: Optional[AgentExecutor] = None
+
+
+# Tools of the run in progress, the agent's own tools stay untouched for the runs next to it
+_run_tools: ContextVar[Optional[_RunTools]] = ContextVar("run_tools", default=None)
+
+
+def _tool_text(tool: BaseTool) -> str:
+    return f"{tool.name}: {tool.description}"
+
+
+def _estimate_tokens(tools: List[BaseTool]) -> int:
+    """Rough prompt size of the tool definitions (about four characters per token)."""
+    size = 0
+    for tool in tools:
+        schema = tool.args_schema.model_json_schema() if tool.args_schema else {}
+        size += len(_tool_text(tool)) + len(json.dumps(schema))
+    return size // 4
+
+
+class ToolSelector:
+    """
+    Picks the tools most relevant to a message using local CPU embeddings.
+
+    Tool descriptions are embedded once per agent file with fastembed. The
+    resulting vector index is kept in memory and persisted under
+    ``TOOL_SELECTION_CACHE_DIR`` so restarts skip the embedding pass; the index
+    is rebuilt whenever the set of tools (or the model) changes.
+    """
+
+    def __init__(self, model_name: str, cache_dir: str):
+        self.model_name = model_name
+        self.cache_dir = Path(cache_dir)
+        self._model = None
+        self._indexes: Dict[str, Tuple[str, np.ndarray]] = {}
+        self._lock = asyncio.Lock()
+        self.selections = 0
+        self.prompt_tokens_full = 0
+        self.prompt_tokens_selected = 0
+
+    def _get_model(self):
+        if self._model is None:
+            from fastembed import TextEmbedding
+
+            logger.info(f"Loading tool selection embedding model {self.model_name}")
+            self._model = TextEmbedding(model_name=self.model_name)
+        return self._model
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _digest(self, tools: List[BaseTool]) -> str:
+        payload = json.dumps([self.model_name] + [_tool_text(tool) for tool in tools])
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _load_or_build_index(self, index_name: str, tools: List[BaseTool]) -> np.ndarray:
+        digest = self._digest(tools)
+        cached = self._indexes.get(index_name)
+        if cached and cached[0] == digest:
+            return cached[1]
+
+        path = self.cache_dir / f"{index_name}.npz"
+        vectors = None
+        if path.exists():
+            try:
+                with np.load(path) as data:
+                    if str(data["digest"]) == digest:
+                        vectors = data["vectors"]
+            except (OSError, KeyError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable tool index {path}: {e}")
+
+        if vectors is None:
+            logger.info(f"Embedding {len(tools)} tool descriptions for {index_name}")
+            embeddings = list(self._get_model().embed([_tool_text(tool) for tool in tools]))
+            vectors = self._normalize(np.array(embeddings, dtype=np.float32))
+            try:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                np.savez(path, digest=np.array(digest), vectors=vectors)
+            except OSError as e:
+                logger.warning(f"Failed to persist tool index {path}: {e}")
+
+        self._indexes[index_name] = (digest, vectors)
+        return vectors
+
+    def _rank(self, index_name: str, tools: List[BaseTool], query: str, top_k: int) -> List[BaseTool]:
+        vectors = self._load_or_build_index(index_name, tools)
+        query_vector = self._normalize(np.array(next(iter(self._get_model().query_embed(query))), dtype=np.float32))
+        scores = vectors @ query_vector
+        best = np.argsort(-scores)[:top_k]
+        # Keep the original tool order so the prompt stays stable between messages
+        return [tools[i] for i in sorted(best)]
+
+    async def select(self, index_name: str, tools: List[BaseTool], query: str, top_k: int) -> List[BaseTool]:
+        # Embedding is CPU bound, keep it off the event loop
+        async with self._lock:
+            selected = await asyncio.to_thread(self._rank, index_name, tools, query, top_k)
+
+        self.selections += 1
+        self.prompt_tokens_full += _estimate_tokens(tools)
+        self.prompt_tokens_selected += _estimate_tokens(selected)
+        return selected
+
+    def invalidate(self, index_name: str) -> None:
+        self._indexes.pop(index_name, None)
+        path = self.cache_dir / f"{index_name}.npz"
+        if path.exists():
+            path.unlink()
+
+    def stats(self) -> dict:
+        saved = self.prompt_tokens_full - self.prompt_tokens_selected
+        return {
+            "selections": self.selections,
+            "estimated_tool_tokens_full": self.prompt_tokens_full,
+            "estimated_tool_tokens_selected": self.prompt_tokens_selected,
+            "estimated_reduction": saved / self.prompt_tokens_full if self.prompt_tokens_full else 0.0,
+        }
+
+
+tool_selector = ToolSelector(settings.TOOL_SELECTION_MODEL, settings.TOOL_SELECTION_CACHE_DIR)
+
+
+class ToolSelectingMCPAgent(MCPAgent):
+    """
+    MCPAgent that only exposes the top-k most relevant tools for each message.
+
+    Pre-selection only kicks in once the agent has more than
+    ``TOOL_SELECTION_MIN_TOOLS`` tools, which in practice means grouped agent
+    files combining several MCP servers.
+
+    Several prompts may run on the agent at once. Each run gets its own
+    tools, system message and executor, and keeps its messages to
+    itself until it is answered, then adds them to the conversation memory,
+    unless it was run with ``memory=False`` (jobs and fan-out prompts).
+
+    An idle agent can be hibernated: its conversation memory and tool lists are
+    written to a snapshot on disk and its MCP sessions are closed. The next
+    ``run`` restores both from the snapshot.
+    """
+
+    def __init__(self, *args, tool_index_name: str, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tool_index_name = tool_index_name
+        self._initialize_lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+        self._active_runs = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        # Cleared while the agent is paused, new runs wait for it
+        self._accepting = asyncio.Event()
+        self._accepting.set()
+        self._snapshot_path: Optional[str] = None
+        self._on_restore: Optional[Callable[[float], None]] = None
+        self._on_first_tool_result: Optional[Callable[[float], None]] = None
+        self._restored_at: Optional[float] = None
+
+    def _current_run_tools(self) -> Optional[_RunTools]:
+        run_tools = _run_tools.get()
+        return run_tools if run_tools is not None and run_tools.agent is self else None
+
+    # MCPAgent.run reads these on every step: a run sees its own,
+    # assignments (initialize, close, config reloads) change the agent's
+    @property
+    def _tools(self) -> List[BaseTool]:
+        run_tools = self._current_run_tools()
+        return run_tools.tools if run_tools is not None else self._own_tools
+
+    @_tools.setter
+    def _tools(self, tools: List[BaseTool]) -> None:
+        self._own_tools = tools
+
+    @property
+    def _system_message(self) -> Optional[SystemMessage]:
+        run_tools = self._current_run_tools()
+        return run_tools.system_message if run_tools is not None else self._own_system_message
+
+    @_system_message.setter
+    def _system_message(self, message: Optional[SystemMessage]) -> None:
+        self._own_system_message = message
+
+    @property
+    def _agent_executor(self) -> Optional[AgentExecutor]:
+        run_tools = self._current_run_tools()
+        return run_tools.executor if run_tools is not None else self._own_agent_executor
+
+    @_agent_executor.setter
+    def _agent_executor(self, executor: Optional[AgentExecutor]) -> None:
+        self._own_agent_executor = executor
+
+    @property
+    def hibernated(self) -> bool:
+        return self._snapshot_path is not None
+
+    @property
+    def busy(self) -> bool:
+        return self._active_runs > 0
+
+    @asynccontextmanager
+    async def paused(self, timeout: float, on_timeout: Callable[[], None]) -> AsyncIterator[None]:
+        """
+        Hold new runs back and wait for the ones in progress, e.g. while MCP
+        sessions are replaced. When runs are still busy after ``timeout``
+        seconds, ``on_timeout`` is called to cancel them.
+        """
+        self._accepting.clear()
+        try:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                on_timeout()
+                await self._idle.wait()
+            # Not hibernated or restored meanwhile
+            async with self._initialize_lock:
+                yield
+        finally:
+            self._accepting.set()
+
+    async def initialize(self) -> None:
+        # A message may arrive while the supervisor is still warming the agent up
+        async with self._initialize_lock:
+            if self._initialized:
+                return
+            started = time.perf_counter()
+            if self._snapshot_path is not None and await self._restore():
+                if self._on_restore is not None:
+                    self._on_restore(time.perf_counter() - started)
+                self._restored_at = started
+            else:
+                await super().initialize()
+                self._on_first_tool_result = None
+            self._on_restore = None
+
+    async def hibernate(self, snapshot_path: str, on_restore: Optional[Callable[[float], None]] = None,
+                        on_first_tool_result: Optional[Callable[[float], None]] = None) -> Optional[int]:
+        """
+        Write the conversation memory and tool lists to ``snapshot_path`` and
+        close the MCP sessions. ``on_restore`` is called with the restore time once the agent
+        is woken up, ``on_first_tool_result`` with the time from the restore until the first
+        tool call returned. Returns the snapshot size, or None when the agent is busy
+        or not connected.
+        """
+        async with self._initialize_lock:
+            if not self._initialized or self.busy:
+                return None
+            history = [message for message in self._conversation_history if not isinstance(message, SystemMessage)]
+            servers = self.client.config.get("mcpServers", {})
+            snapshot = {
+                "version": 1,
+                # Tool lists per server, valid as long as the server config stays the same
+                "servers": {
+                    name: {
+                        "key": tool_cache.server_key(servers[name]),
+                        "tools": [tool.model_dump(mode="json", exclude_none=True) for tool in session.tools or []],
+                    }
+                    for name, session in self.client.get_all_active_sessions().items() if name in servers
+                },
+                "history": messages_to_dict(history),
+            }
+            size = await asyncio.to_thread(write_snapshot, snapshot_path, snapshot)
+            if self.busy:
+                # A message arrived while the snapshot was written
+                await asyncio.to_thread(os.unlink, snapshot_path)
+                return None
+
+            # From here on a new message waits for the lock and then restores the agent
+            self._snapshot_path = snapshot_path
+            self._on_restore = on_restore
+            self._on_first_tool_result = on_first_tool_result
+            self._restored_at = None
+            self._initialized = False
+            await self.close()
+            self._conversation_history = []
+            return size
+
+    async def _restore(self) -> bool:
+        """
+        Rebuild the agent from its snapshot. The tools come from the snapshot, so
+        the agent is ready before its MCP servers are: they reconnect in the
+        background while the LLM plans, and tool calls wait for their server.
+        """
+        path, self._snapshot_path = self._snapshot_path, None
+        try:
+            snapshot = await asyncio.to_thread(read_snapshot, path)
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not restore {self.tool_index_name} from {path}, starting afresh: {e}")
+            return False
+
+        for name, server_config in self.client.config.get("mcpServers", {}).items():
+            saved = snapshot["servers"].get(name)
+            if saved and saved["key"] == tool_cache.server_key(server_config):
+                await self.client.restore_session(name, [Tool.model_validate(tool) for tool in saved["tools"]])
+            else:
+                # Added or changed while the agent was hibernated
+                await self.client.create_session(name)
+
+        # Same steps as MCPAgent.initialize, with the memory put back before the system message
+        if self.memory_enabled:
+            self._conversation_history = messages_from_dict(snapshot["history"])
+        self._sessions = self.client.get_all_active_sessions()
+        self._tools = await self.adapter.create_tools(self.client)
+        await self._create_system_message_from_tools(self._tools)
+        self._agent_executor = self._create_agent()
+        self._initialized = True
+        logger.info(f"Restored {self.tool_index_name} with {len(snapshot['history'])} messages of memory")
+        return True
+
+    def _create_agent(self) -> AgentExecutor:
+        executor = super()._create_agent()
+        executor = StepCountingAgentExecutor(
+            agent=executor.agent, tools=executor.tools, max_iterations=executor.max_iterations, verbose=executor.verbose
+        )
+        executor._on_tool_result = self._tool_result_returned
+        return executor
+
+    def _tool_result_returned(self) -> None:
+        # The first result after a restore waited for its MCP server to restart
+        if self._restored_at is None:
+            return
+        if self._on_first_tool_result is not None:
+            self._on_first_tool_result(time.perf_counter() - self._restored_at)
+        self._restored_at = None
+        self._on_first_tool_result = None
+
+    async def _select_tools(self, query: str) -> _RunTools:
+        """Pick the tools for a run on ``query``."""
+        tools = self._own_tools
+        if not settings.TOOL_SELECTION_ENABLED or len(tools) <= settings.TOOL_SELECTION_MIN_TOOLS:
+            return _RunTools(self, tools, self._own_system_message)
+
+        try:
+            selected = await tool_selector.select(self.tool_index_name, tools, query, settings.TOOL_SELECTION_TOP_K)
+        except Exception as e:
+            logger.error(f"Tool pre-selection failed for {self.tool_index_name}, using all tools: {e}")
+            return _RunTools(self, tools, self._own_system_message)
+        # Truncated outputs of the selected tools still have to be readable
+        selected = selected + [tool for tool in tools if tool.name == READ_TOOL_OUTPUT and tool not in selected]
+
+        logger.debug(f"Tool pre-selection for {self.tool_index_name}: {len(selected)}/{len(tools)} tools")
+        # Same system message as MCPAgent._create_system_message_from_tools, without touching the memory
+        system_message = create_system_message(
+            tools=selected,
+            system_prompt_template=self.system_prompt_template_override or DEFAULT_SYSTEM_PROMPT_TEMPLATE,
+            server_manager_template=SERVER_MANAGER_SYSTEM_PROMPT_TEMPLATE,
+            use_server_manager=self.use_server_manager,
+            disallowed_tools=self.disallowed_tools,
+            user_provided_prompt=self.system_prompt,
+            additional_instructions=self.additional_instructions,
+        )
+        return _RunTools(self, selected, system_message)
+
+    def add_to_history(self, message: BaseMessage) -> None:
+        messages = _run_messages.get()
+        if messages is None:
+            super().add_to_history(message)
+        else:
+            messages.append(message)
+
+    async def run(self, query: str, max_steps: Optional[int] = None, manage_connector: bool = True,
+                  external_history=None, memory: bool = True) -> str:
+        """
+        Run ``query`` on the agent. With ``memory=False`` the run neither sees
+        nor extends the conversation memory.
+        """
+        await self._accepting.wait()
+        # Counted before the next await, so the agent is not hibernated under the message
+        self._active_runs += 1
+        self._idle.clear()
+        try:
+            if manage_connector and not self._initialized:
+                await self.initialize()
+            run_tools = await self._select_tools(query) if self._initialized else None
+
+            messages: List[BaseMessage] = []
+            messages_token = _run_messages.set(messages)
+            tools_token = _run_tools.set(run_tools)
+            started = time.perf_counter()
+            try:
+                if run_tools is not None:
+                    # Reads the run's tools and system message. Not shared, MCPAgent.run sets its
+                    # max_iterations and sequential tool calls hold its lock
+                    run_tools.executor = self._create_agent()
+                with counting_tokens(current_run.get()):
+                    response = await super().run(query, max_steps=max_steps, manage_connector=manage_connector,
+                                                 external_history=external_history if memory else [])
+            finally:
+                _run_tools.reset(tools_token)
+                _run_messages.reset(messages_token)
+            # A cancelled or failed run leaves the memory as it was, the next message should not pick it up
+            if memory:
+                for message in messages:
+                    super().add_to_history(message)
+            await record_agent_run(self.client, query, response, time.perf_counter() - started)
+            return response
+        finally:
+            self._active_runs -= 1
+            if not self._active_runs:
+                self._idle.set()
+            self.last_used = time.monotonic()
@@ -0,0 +1,208 @@
+"""
+Agent listing and detail response times, ORM and pydantic path vs plain rows and orjson.
+
+    python -m benchmarks.agent_listing_benchmark [--agents 10000] [--page-size 1000] [--rounds 5]
+
+Fills a temporary SQLite database with ``--agents`` agents spread over agent
+files and builds the response bodies of ``GET /api/v1/agents/`` (every page)
+and ``GET /api/v1/agents/{agent_id}`` (``--details`` agents) twice:
+
+- ORM: what the endpoints did before, ``MCPAgent`` objects with their file
+  loaded in the same query, validated into ``MCPAgentInDB`` with
+  ``from_attributes``, dumped and rendered by ``JSONResponse``, the way FastAPI
+  handles a ``response_model``. The listing pages with ``skip``.
+- rows: ``MCPAgentService`` as the endpoints call it now, plain rows paged with
+  the cursor and serialized by ``ORJSONResponse``.
+
+Both paths must produce the same JSON. The configured database is not used.
+"""
+import argparse
+import json
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, List
+
+AGENTS_PER_FILE = 5
+
+
+def populate(db, agents: int) -> None:
+    """Insert ``agents`` agents, in groups of AGENTS_PER_FILE per agent file, and a few without a file."""
+    from sqlalchemy import insert
+
+    from app.models.agent_file import AgentFile
+    from app.models.mcp_agent import MCPAgent
+
+    files = (agents + AGENTS_PER_FILE - 1) // AGENTS_PER_FILE
+    db.execute(insert(AgentFile), [
+        {"id": index + 1, "name": f"mcp_agents_{index:05d}_20260101_120000.json"} for index in range(files)
+    ])
+    created = datetime(2026, 1, 1, 12, 0, 0, 123456)
+    db.execute(insert(MCPAgent), [
+        {
+            "name": f"agent-{index:05d}",
+            "agent_type": ("slack", "github", "jira")[index % 3],
+            "command": "npx",
+            "args": ["-y", "@modelcontextprotocol/server-slack", "--workspace", f"team-{index % 50}"],
+            "env": {"SLACK_BOT_TOKEN": f"${{secret:agent-{index:05d}/SLACK_BOT_TOKEN}}", "SLACK_TEAM_ID": "T01234567"},
+            "is_active": index % 4 != 0,
+            "created_at": created + timedelta(seconds=index),
+            "updated_at": created + timedelta(seconds=index, microseconds=index % 1000),
+            # Every hundredth agent has no agent file
+            "agent_file_id": None if index % 100 == 99 else index // AGENTS_PER_FILE + 1,
+            "version": 1,
+        }
+        for index in range(agents)
+    ])
+    db.commit()
+
+
+def orm_pages(db, page_size: int) -> List[bytes]:
+    from fastapi.responses import JSONResponse
+    from pydantic import TypeAdapter
+    from sqlalchemy.orm import joinedload
+
+    from app.models.mcp_agent import MCPAgent
+    from app.models.schemas import MCPAgentInDB
+
+    adapter = TypeAdapter(List[MCPAgentInDB])
+    bodies = []
+    skip = 0
+    while True:
+        agents = (
+            db.query(MCPAgent).options(joinedload(MCPAgent.agent_file))
+            .order_by(MCPAgent.id).offset(skip).limit(page_size).all()
+        )
+        if not agents:
+            return bodies
+        for agent in agents:
+            agent.file_name = agent.agent_file.name if agent.agent_file else None
+            agent.file_id = agent.agent_file.id if agent.agent_file else 0
+        value = adapter.validate_python(agents, from_attributes=True)
+        bodies.append(JSONResponse(adapter.dump_python(value, mode="json")).body)
+        skip += page_size
+
+
+def row_pages(db, page_size: int) -> List[bytes]:
+    from fastapi.responses import ORJSONResponse
+
+    from app.services.mcp_agent_service import MCPAgentService
+
+    service = MCPAgentService(db)
+    bodies = []
+    cursor = None
+    while True:
+        agents, cursor, _ = service.get_agents(limit=page_size, cursor=cursor)
+        if agents:
+            bodies.append(ORJSONResponse(agents).body)
+        if cursor is None:
+            return bodies
+
+
+def orm_details(db, agent_ids: List[int]) -> List[bytes]:
+    from fastapi.responses import JSONResponse
+    from pydantic import TypeAdapter
+
+    from app.models.schemas import MCPAgentInDB
+    from app.services.mcp_agent_service import MCPAgentService
+
+    adapter = TypeAdapter(MCPAgentInDB)
+    service = MCPAgentService(db)
+    bodies = []
+    for agent_id in agent_ids:
+        value = adapter.validate_python(service.get_agent_details(agent_id), from_attributes=True)
+        bodies.append(JSONResponse(adapter.dump_python(value, mode="json")).body)
+    return bodies
+
+
+def row_details(db, agent_ids: List[int]) -> List[bytes]:
+    from fastapi.responses import ORJSONResponse
+
+    from app.services.mcp_agent_service import MCPAgentService
+
+    service = MCPAgentService(db)
+    bodies = []
+    for agent_id in agent_ids:
+        agent = service.get_agent_details(agent_id)
+        bodies.append(ORJSONResponse({field: getattr(agent, field) for field in MCPAgentService.AGENT_LIST_FIELDS}).body)
+    return bodies
+
+
+def measure(session_factory, build: Callable, argument, rounds: int) -> tuple:
+    """Return the median seconds of ``rounds`` builds, each in a new session, and the bodies of the last one."""
+    timings = []
+    bodies = []
+    for _ in range(rounds):
+        # A new session each round, so no round reuses the ORM objects of the previous one
+        db = session_factory()
+        try:
+            start = time.perf_counter()
+            bodies = build(db, argument)
+            timings.append(time.perf_counter() - start)
+        finally:
+            db.close()
+    return statistics.median(timings), bodies
+
+
+def benchmark(agents: int, page_size: int, details: int, rounds: int) -> None:
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    from app.db import init_db  # noqa: F401, registers the tables on Base.metadata
+    from app.db.base_class import Base
+
+    with tempfile.TemporaryDirectory(prefix="agent-listing-") as directory:
+        engine = create_engine(f"sqlite:///{Path(directory) / 'agents.db'}")
+        Base.metadata.create_all(engine)
+        session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        db = session_factory()
+        try:
+            populate(db, agents)
+        finally:
+            db.close()
+
+        # Spread the detail lookups over the whole table
+        agent_ids = [1 + index * agents // details for index in range(details)]
+        pages = (agents + page_size - 1) // page_size
+        print(f"{agents} agents, SQLite, median of {rounds} rounds")
+
+        for name, argument, unit, paths in (
+            (f"list, {pages} pages of {page_size}", page_size, "page", (("ORM", orm_pages), ("rows", row_pages))),
+            (f"detail, {details} agents", agent_ids, "agent", (("ORM", orm_details), ("rows", row_details))),
+        ):
+            print(f"  {name}")
+            baseline = None
+            expected = None
+            for path, build in paths:
+                seconds, bodies = measure(session_factory, build, argument, rounds)
+                decoded = [json.loads(body) for body in bodies]
+                if expected is not None and decoded != expected:
+                    raise RuntimeError(f"The {path} path returned different JSON for {name}")
+                expected = decoded
+                baseline = baseline or seconds
+                print(f"    {path:<5} {seconds * 1000:9.1f} ms  {seconds * 1000 / len(bodies):7.2f} ms per {unit:<5}"
+                      f"  {baseline / seconds:5.1f}x")
+        engine.dispose()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--agents", type=int, default=10000, help="Agents in the database")
+    parser.add_argument("--page-size", type=int, default=1000, help="Listing page size, at most 1000 like the endpoint")
+    parser.add_argument("--details", type=int, default=1000, help="Agents fetched one by one")
+    parser.add_argument("--rounds", type=int, default=5, help="Rounds per path, the median is reported")
+    args = parser.parse_args()
+
+    if args.agents < 1 or args.details < 1 or args.rounds < 1:
+        parser.error("--agents, --details and --rounds must be at least 1")
+    if not 1 <= args.page_size <= 1000:
+        parser.error("--page-size must be between 1 and 1000")
+    benchmark(args.agents, args.page_size, min(args.details, args.agents), args.rounds)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+Time to restore a hibernated agent compared to starting it from scratch.
+
+    python -m benchmarks.hibernation_benchmark [--servers 2] [--tools 30] [--messages 40] [--rounds 3]
+
+Starts local fake MCP servers (this module with ``--serve``) with ``--tools``
+tools each and measures, as the median of ``--rounds`` runs:
+
+- a cold start: a new agent on a worker without cached tool schemas
+- a start with the tool schemas cached, which still loses the memory
+- a restore from hibernation, with ``--messages`` messages of memory, and
+  the time until a tool call after the restore is answered, which waits for
+  the server started in the background
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List
+
+from app.core.config import settings
+
+
+def serve(name: str, tools: int) -> None:
+    """Run a fake MCP server over stdio with ``tools`` tools."""
+    from mcp.server.fastmcp import FastMCP
+
+    server = FastMCP(f"benchmark-{name}", log_level="WARNING")
+
+    def add_tool(index: int) -> None:
+        async def lookup(key: str, limit: int = 10, include_archived: bool = False) -> str:
+            return f"{name}:{index}:{key}"
+
+        server.add_tool(lookup, name=f"{name}_lookup_{index}", description=f"Look up records of kind {index} by key")
+
+    for index in range(tools):
+        add_tool(index)
+    server.run()
+
+
+async def _timed(step: Callable) -> float:
+    started = time.perf_counter()
+    await step()
+    return time.perf_counter() - started
+
+
+async def benchmark(servers: int, tools: int, messages: int, rounds: int) -> None:
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    from app.services.tool_cache import CachedMCPClient, CachedLangChainAdapter, tool_cache
+    from benchmarks.tool_call_benchmark import scripted_llm
+    from app.services.tool_results import tool_result_cache
+    from app.services.tool_selector import ToolSelectingMCPAgent
+
+    names = [f"s{i}" for i in range(servers)]
+    config = {"mcpServers": {
+        name: {
+            "command": sys.executable,
+            "args": ["-m", "benchmarks.hibernation_benchmark", "--serve", name, "--tools", str(tools)],
+        }
+        for name in names
+    }}
+    settings.TOOL_SELECTION_ENABLED = False
+    tool_result_cache.enabled = False
+
+    def new_agent() -> ToolSelectingMCPAgent:
+        agent = ToolSelectingMCPAgent(
+            client=CachedMCPClient(config=config), llm=scripted_llm(names, 0, 0), max_steps=3,
+            memory_enabled=True, tool_index_name="hibernation-benchmark"
+        )
+        agent.adapter = CachedLangChainAdapter(disallowed_tools=agent.disallowed_tools)
+        return agent
+
+    with tempfile.TemporaryDirectory() as directory:
+        tool_cache.cache_dir = Path(directory)
+        cold: List[float] = []
+        warm: List[float] = []
+        restore: List[float] = []
+        first_call: List[float] = []
+        snapshot_size = 0
+        for _ in range(rounds):
+            # A worker that never ran these servers: nothing cached on disk or in memory
+            tool_cache.invalidate()
+            tool_cache._models.clear()
+            agent = new_agent()
+            cold.append(await _timed(agent.initialize))
+            await agent.close()
+
+            agent = new_agent()
+            warm.append(await _timed(agent.initialize))
+            for index in range(messages // 2):
+                agent.add_to_history(HumanMessage(content=f"Question {index} about the records of kind {index}"))
+                agent.add_to_history(AIMessage(content=f"Answer {index}: " + "details " * 40))
+            snapshot_size = await agent.hibernate(os.path.join(directory, "agent.json.gz"))
+            started = time.perf_counter()
+            await agent.initialize()
+            restore.append(time.perf_counter() - started)
+            await agent._tools[0].ainvoke({"key": "benchmark"})
+            first_call.append(time.perf_counter() - started)
+            restored = len(agent.get_conversation_history()) - 1
+            if restored != messages // 2 * 2:
+                raise RuntimeError(f"Restored {restored} of {messages} messages")
+            await agent.close()
+
+    print(f"{servers} servers with {tools} tools each, median of {rounds} runs")
+    for name, seconds in (
+            ("cold start", cold),
+            ("start, cached tool schemas", warm),
+            (f"restore, {messages} messages kept", restore),
+            ("restore and first tool call", first_call),
+    ):
+        print(f"  {name:<32} {statistics.median(seconds):7.3f}s")
+    print(f"  snapshot size                    {snapshot_size} bytes")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--servers", type=int, default=2, help="Fake MCP servers")
+    parser.add_argument("--tools", type=int, default=30, help="Tools per server")
+    parser.add_argument("--messages", type=int, default=40, help="Messages of conversation memory")
+    parser.add_argument("--rounds", type=int, default=3, help="Runs measured")
+    parser.add_argument("--serve", metavar="NAME", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.tools)
+        return 0
+    asyncio.run(benchmark(args.servers, args.tools, args.messages, args.rounds))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+Step latency of an agent step that issues several tool calls.
+
+    python -m benchmarks.tool_call_benchmark [--servers 2] [--calls 6] [--delay 0.5] [--rounds 3]
+
+Starts local fake MCP servers (this module with ``--serve``) whose only tool
+sleeps for ``--delay`` seconds, and runs an agent whose scripted LLM issues
+``--calls`` tool calls spread over the servers in a single step. The step runs
+one call after another, concurrently with one call per server and concurrently
+with the per-server limit; the median step latency of each mode is printed.
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+import uuid
+from typing import Any, List, Optional
+
+from app.core.config import settings
+
+MODES = (
+    # name, run the calls of a step concurrently, calls in flight per server
+    ("sequential", False, 0),
+    ("concurrent, 1 per server", True, 1),
+    ("concurrent, per-server limit", True, None),
+)
+
+
+def serve(name: str) -> None:
+    """Run a fake MCP server over stdio with one ``fetch_<name>`` tool."""
+    from mcp.server.fastmcp import FastMCP
+
+    server = FastMCP(f"benchmark-{name}", log_level="WARNING")
+
+    @server.tool(name=f"fetch_{name}", description="Fetch a record after a delay")
+    async def fetch(key: str, delay: float) -> str:
+        await asyncio.sleep(delay)
+        return f"{name}:{key}"
+
+    server.run()
+
+
+def scripted_llm(servers: List[str], calls: int, delay: float):
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+
+    class ScriptedChatModel(BaseChatModel):
+        """Issues every tool call in its first step, then answers with the results in order."""
+
+        @property
+        def _llm_type(self) -> str:
+            return "scripted"
+
+        def bind_tools(self, tools: Any, **kwargs: Any) -> "ScriptedChatModel":
+            return self
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+            results = [message.content for message in messages if message.type == "tool"]
+            if results:
+                message = AIMessage(content=",".join(results))
+            else:
+                message = AIMessage(content="", tool_calls=[
+                    {
+                        "name": f"fetch_{servers[i % len(servers)]}",
+                        "args": {"key": str(i), "delay": delay},
+                        "id": uuid.uuid4().hex,
+                        "type": "tool_call",
+                    }
+                    for i in range(calls)
+                ])
+            return ChatResult(generations=[ChatGeneration(message=message)])
+
+    return ScriptedChatModel()
+
+
+async def measure(servers: int, calls: int, delay: float, rounds: int,
+                  parallel: bool, limit: Optional[int]) -> List[float]:
+    """Return the latency of ``rounds`` agent runs of one tool step each."""
+    from app.services.tool_cache import CachedMCPClient, CachedLangChainAdapter, tool_cache
+    from app.services.tool_results import tool_result_cache
+    from app.services.tool_selector import ToolSelectingMCPAgent
+
+    names = [f"s{i}" for i in range(servers)]
+    config = {"mcpServers": {
+        name: {"command": sys.executable, "args": ["-m", "benchmarks.tool_call_benchmark", "--serve", name]}
+        for name in names
+    }}
+    tool_cache.enabled = False
+    tool_result_cache.enabled = False
+    settings.TOOL_CALLS_PARALLEL = parallel
+    settings.TOOL_CALL_CONCURRENCY_OVERRIDES = {name: limit for name in names} if limit is not None else {}
+
+    client = CachedMCPClient(config=config)
+    agent = ToolSelectingMCPAgent(
+        client=client, llm=scripted_llm(names, calls, delay), max_steps=3,
+        memory_enabled=False, tool_index_name="tool-call-benchmark"
+    )
+    agent.adapter = CachedLangChainAdapter(disallowed_tools=agent.disallowed_tools)
+    await agent.initialize()
+    expected = ",".join(f"{names[i % servers]}:{i}" for i in range(calls))
+    latencies = []
+    try:
+        for _ in range(rounds):
+            started = time.perf_counter()
+            response = await agent.run("benchmark")
+            latencies.append(time.perf_counter() - started)
+            if response != expected:
+                raise RuntimeError(f"Tool results out of order: {response}")
+    finally:
+        await agent.close()
+    return latencies
+
+
+async def benchmark(servers: int, calls: int, delay: float, rounds: int) -> None:
+    print(f"{calls} tool calls of {delay:g}s over {servers} servers, "
+          f"per-server limit {settings.TOOL_CALL_CONCURRENCY_PER_SERVER or 'off'}, median of {rounds} steps")
+    baseline = None
+    for name, parallel, limit in MODES:
+        latency = statistics.median(await measure(servers, calls, delay, rounds, parallel, limit))
+        baseline = baseline or latency
+        print(f"  {name:<30} {latency:7.3f}s  {baseline / latency:5.1f}x")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--servers", type=int, default=2, help="Fake MCP servers")
+    parser.add_argument("--calls", type=int, default=6, help="Tool calls in the step, spread over the servers")
+    parser.add_argument("--delay", type=float, default=0.5, help="Seconds every tool call takes")
+    parser.add_argument("--rounds", type=int, default=3, help="Steps measured per mode")
+    parser.add_argument("--serve", metavar="NAME", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return 0
+    asyncio.run(benchmark(args.servers, args.calls, args.delay, args.rounds))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
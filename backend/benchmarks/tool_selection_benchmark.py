@@ -0,0 +1,203 @@
+"""
+Prompt size of a grouped agent with and without tool pre-selection.
+
+    python -m benchmarks.tool_selection_benchmark [--servers slack,github,jira] [--top-k 8]
+
+Starts local fake MCP servers (this module with ``--serve``) that expose the
+tools of a Slack, GitHub and Jira server, and sends the same messages to an
+agent combining them, once with ``TOOL_SELECTION_ENABLED`` off and once on.
+The scripted LLM answers right away and records the prompt it was sent: the
+system message, the messages and the tool definitions. Tokens are estimated
+at four characters per token, like the selection stats. Pre-selection needs
+the ``TOOL_SELECTION_MODEL`` embedding model, which fastembed downloads on
+first use.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from app.core.config import settings
+
+TOOLS: Dict[str, List[Tuple[str, str]]] = {
+    "slack": [
+        ("list_channels", "List the public channels of the Slack workspace"),
+        ("post_message", "Post a message to a Slack channel"),
+        ("reply_to_thread", "Reply to a message thread in a Slack channel"),
+        ("add_reaction", "Add an emoji reaction to a Slack message"),
+        ("get_reactions", "Get the emoji reactions of a Slack message"),
+        ("get_channel_history", "Read the recent messages of a Slack channel"),
+        ("get_thread_replies", "Read all replies of a Slack message thread"),
+        ("get_users", "List the members of the Slack workspace"),
+        ("get_user_profile", "Get the profile of a Slack user"),
+        ("search_messages", "Search Slack messages by text"),
+        ("set_channel_topic", "Set the topic of a Slack channel"),
+        ("upload_file", "Upload a file to a Slack channel"),
+    ],
+    "github": [
+        ("create_issue", "Open an issue in a GitHub repository"),
+        ("get_issue", "Get a GitHub issue with its comments"),
+        ("list_issues", "List the issues of a GitHub repository, filtered by state or label"),
+        ("add_issue_comment", "Comment on a GitHub issue"),
+        ("list_pull_requests", "List the open pull requests of a GitHub repository, optionally those awaiting review by a user"),
+        ("get_pull_request", "Get the details of a GitHub pull request"),
+        ("get_pull_request_diff", "Get the diff of a GitHub pull request"),
+        ("create_pull_request_review", "Review a GitHub pull request: approve, comment or request changes"),
+        ("merge_pull_request", "Merge a GitHub pull request"),
+        ("search_code", "Search code across GitHub repositories"),
+        ("get_file_contents", "Read a file from a GitHub repository"),
+        ("list_commits", "List the commits of a branch in a GitHub repository"),
+    ],
+    "jira": [
+        ("get_issue", "Get a Jira issue by its key, with status, assignee and description"),
+        ("search_issues", "Search Jira issues with JQL, e.g. by assignee or due date"),
+        ("create_issue", "Create a Jira issue in a project"),
+        ("update_issue", "Update fields of a Jira issue"),
+        ("transition_issue", "Move a Jira issue to another status, e.g. In Progress or Done"),
+        ("add_comment", "Comment on a Jira issue"),
+        ("assign_issue", "Assign a Jira issue to a user"),
+        ("list_projects", "List the Jira projects"),
+        ("get_sprint", "Get the active sprint of a Jira board"),
+        ("add_worklog", "Log time spent on a Jira issue"),
+        ("link_issues", "Link two Jira issues"),
+        ("get_transitions", "List the statuses a Jira issue can move to"),
+    ],
+}
+
+# Message and the tool that answers it
+MESSAGES = [
+    ("Post the release notes to the #announcements channel", "slack_post_message"),
+    ("Who reacted to my last message in #general?", "slack_get_reactions"),
+    ("Which pull requests are waiting for my review?", "github_list_pull_requests"),
+    ("Show me the diff of pull request 482", "github_get_pull_request_diff"),
+    ("Open an issue in the backend repo about the flaky login test", "github_create_issue"),
+    ("What's the status of ticket PROJ-1234?", "jira_get_issue"),
+    ("Move PROJ-88 to In Progress", "jira_transition_issue"),
+    ("Find the issues assigned to me that are due this week", "jira_search_issues"),
+]
+
+
+def serve(name: str) -> None:
+    """Run a fake MCP server over stdio with the tools of ``name``."""
+    from mcp.server.fastmcp import FastMCP
+
+    server = FastMCP(f"benchmark-{name}", log_level="WARNING")
+
+    async def call(query: str) -> str:
+        return "ok"
+
+    for tool, description in TOOLS[name]:
+        server.add_tool(call, name=f"{name}_{tool}", description=description)
+    server.run()
+
+
+def recording_llm():
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+    from langchain_core.utils.function_calling import convert_to_openai_tool
+
+    class RecordingChatModel(BaseChatModel):
+        """Answers right away and records the size of the prompt it was sent."""
+
+        tool_names: List[str] = []
+        tool_chars: int = 0
+        prompt_chars: int = 0
+
+        @property
+        def _llm_type(self) -> str:
+            return "recording"
+
+        def bind_tools(self, tools: Any, **kwargs: Any) -> "RecordingChatModel":
+            # Every run binds the tools it was given
+            self.tool_names = [tool.name for tool in tools]
+            self.tool_chars = len(json.dumps([convert_to_openai_tool(tool) for tool in tools]))
+            return self
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+            self.prompt_chars = sum(len(str(message.content)) for message in messages) + self.tool_chars
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content="ok"))])
+
+    return RecordingChatModel()
+
+
+async def measure(servers: List[str], messages: List[Tuple[str, str]], selection: bool) -> List[Tuple[int, int, bool]]:
+    """Return the estimated prompt and tool tokens of every message, and whether its tool was offered."""
+    from app.services.tool_cache import CachedMCPClient, CachedLangChainAdapter, tool_cache
+    from app.services.tool_selector import ToolSelectingMCPAgent, tool_selector
+
+    config = {"mcpServers": {
+        name: {"command": sys.executable, "args": ["-m", "benchmarks.tool_selection_benchmark", "--serve", name]}
+        for name in servers
+    }}
+    tool_cache.enabled = False
+    settings.TOOL_SELECTION_ENABLED = selection
+
+    llm = recording_llm()
+    client = CachedMCPClient(config=config)
+    agent = ToolSelectingMCPAgent(
+        client=client, llm=llm, max_steps=1, memory_enabled=False, tool_index_name="tool-selection-benchmark"
+    )
+    agent.adapter = CachedLangChainAdapter(disallowed_tools=agent.disallowed_tools)
+    await agent.initialize()
+    results = []
+    try:
+        for message, expected in messages:
+            selections = tool_selector.selections
+            await agent.run(message)
+            if selection and tool_selector.selections == selections:
+                raise RuntimeError("Tool pre-selection failed and fell back to all tools, see the log")
+            results.append((llm.prompt_chars // 4, llm.tool_chars // 4, expected in llm.tool_names))
+    finally:
+        await agent.close()
+    return results
+
+
+async def benchmark(servers: List[str], top_k: int) -> None:
+    from app.services.tool_selector import tool_selector
+
+    messages = [(message, tool) for message, tool in MESSAGES if tool.split("_", 1)[0] in servers]
+    tools = sum(len(TOOLS[name]) for name in servers)
+    settings.TOOL_SELECTION_TOP_K = top_k
+    print(f"{tools} tools over {len(servers)} servers, top {top_k}, median of {len(messages)} messages")
+
+    baseline = None
+    with tempfile.TemporaryDirectory(prefix="tool-index-") as index_dir:
+        # Embedded once on the first message, like a restarted worker without a persisted index
+        tool_selector.cache_dir = Path(index_dir)
+        for name, selection in (("selection off", False), ("selection on", True)):
+            results = await measure(servers, messages, selection)
+            prompt = statistics.median(tokens for tokens, _, _ in results)
+            tool_tokens = statistics.median(tokens for _, tokens, _ in results)
+            offered = sum(1 for _, _, found in results if found)
+            baseline = baseline or prompt
+            print(f"  {name:<15} {prompt:7.0f} prompt tokens  {tool_tokens:7.0f} in tools  "
+                  f"{1 - prompt / baseline:4.0%} fewer  answering tool offered {offered}/{len(results)}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--servers", default=",".join(TOOLS), help="Fake MCP servers, out of " + ", ".join(TOOLS))
+    parser.add_argument("--top-k", type=int, default=settings.TOOL_SELECTION_TOP_K, help="Tools selected per message")
+    parser.add_argument("--serve", metavar="NAME", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return 0
+    servers = [name for name in args.servers.split(",") if name]
+    unknown = set(servers) - set(TOOLS)
+    if unknown:
+        parser.error(f"Unknown servers: {', '.join(sorted(unknown))}")
+    if sum(len(TOOLS[name]) for name in servers) <= settings.TOOL_SELECTION_MIN_TOOLS:
+        parser.error(f"Pre-selection only starts above TOOL_SELECTION_MIN_TOOLS ({settings.TOOL_SELECTION_MIN_TOOLS}) tools")
+    asyncio.run(benchmark(servers, args.top_k))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())